@@ -0,0 +1,152 @@
+"""Cached verification of access tokens and their revocation.
+
+Decoding a JWT checks its HS256 signature and parses its claims; with the
+agenda event streams, chart fan-out and polling tablets the same token is
+verified thousands of times an hour. ``TokenVerifier`` decodes a token once
+and keeps the resulting ``Principal`` in an LRU cache keyed by the token's
+SHA-256, until the token expires. The principal carries the ambulatori as a
+frozenset, so the access check of every route is a set lookup.
+
+Revocation does not need a restart: a single token (its ``jti``) or every
+token of a user issued before a moment (a lost tablet) can be revoked. The
+revocations are kept in memory and checked in O(1) on every request, cached
+or not; they are stored in the ``revocations`` collection, from which every
+worker reloads the new ones every ``POLL_SECONDS``.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, FrozenSet, Optional
+
+import jwt
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 4096
+POLL_SECONDS = 5
+# Revocations written by other workers are read again with this margin
+POLL_OVERLAP = timedelta(seconds=60)
+
+
+@dataclass(frozen=True)
+class Principal:
+    username: str
+    ambulatori: FrozenSet[str]
+    jti: Optional[str]
+    issued_at: float
+    expires_at: float
+
+
+class TokenVerifier:
+    def __init__(self, decode: Callable[[str], dict], lifetime: timedelta, cache_size: int = CACHE_SIZE) -> None:
+        self.decode = decode
+        # Revocations can be forgotten once every token they cover has expired
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[bytes, Principal]" = OrderedDict()
+        # verify() may be called from threadpool dependencies as well as the event loop
+        self._lock = threading.Lock()
+        self.revoked_tokens: Dict[str, float] = {}   # jti -> expiry
+        self.revoked_users: Dict[str, float] = {}    # username -> tokens issued before are revoked
+        self.polled_at: Optional[datetime] = None
+
+    @staticmethod
+    def new_jti() -> str:
+        return uuid.uuid4().hex
+
+    def verify(self, token: str) -> Principal:
+        """The principal of a valid token; raises 401 otherwise."""
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            principal = self.cache.get(key)
+            if principal is not None:
+                if principal.expires_at <= time.time():
+                    self.cache.pop(key, None)
+                    raise HTTPException(status_code=401, detail="Token scaduto")
+                self.cache.move_to_end(key)
+        if principal is None:
+            principal = self._decode(token)
+            with self._lock:
+                self.cache[key] = principal
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        if self.is_revoked(principal):
+            raise HTTPException(status_code=401, detail="Sessione revocata, effettua di nuovo il login")
+        return principal
+
+    def _decode(self, token: str) -> Principal:
+        try:
+            payload = self.decode(token)
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token scaduto")
+        except jwt.InvalidTokenError:
+            raise HTTPException(status_code=401, detail="Token non valido")
+        return Principal(
+            username=payload["sub"],
+            ambulatori=frozenset(payload["ambulatori"]),
+            jti=payload.get("jti"),
+            # Tokens issued before revocation support carry neither claim
+            issued_at=float(payload.get("iat", 0)),
+            expires_at=float(payload["exp"]),
+        )
+
+    def is_valid(self, principal: Principal) -> bool:
+        """Whether an already verified principal is still usable (for long
+        lived connections, which verify their token only when they open)."""
+        return principal.expires_at > time.time() and not self.is_revoked(principal)
+
+    def is_revoked(self, principal: Principal) -> bool:
+        if principal.jti is not None and principal.jti in self.revoked_tokens:
+            return True
+        before = self.revoked_users.get(principal.username)
+        return before is not None and principal.issued_at < before
+
+    def _apply(self, doc: dict) -> None:
+        if doc["kind"] == "token":
+            self.revoked_tokens[doc["value"]] = doc["until"]
+        else:
+            self.revoked_users[doc["value"]] = max(doc["before"], self.revoked_users.get(doc["value"], 0))
+
+    async def _store(self, db, doc: dict) -> None:
+        now = datetime.now(timezone.utc)
+        doc = {**doc, "revoked_at": now.isoformat(), "expires_at": now + self.lifetime}
+        self._apply(doc)
+        await db.revocations.replace_one({"_id": f"{doc['kind']}:{doc['value']}"}, doc, upsert=True)
+
+    async def revoke_token(self, db, principal: Principal) -> None:
+        if principal.jti is not None:
+            await self._store(db, {"kind": "token", "value": principal.jti, "until": principal.expires_at})
+
+    async def revoke_user(self, db, username: str) -> None:
+        """Revoke every token of the user issued until now."""
+        await self._store(db, {"kind": "user", "value": username, "before": time.time()})
+
+    async def load_revocations(self, db) -> None:
+        """Read the revocations stored since the previous call (all, the first time)."""
+        started = datetime.now(timezone.utc)
+        query = {}
+        if self.polled_at is not None:
+            query["revoked_at"] = {"$gte": (self.polled_at - POLL_OVERLAP).isoformat()}
+        async for doc in db.revocations.find(query):
+            self._apply(doc)
+        self.polled_at = started
+        # Forget revocations whose tokens have all expired
+        now = time.time()
+        oldest = now - self.lifetime.total_seconds()
+        self.revoked_tokens = {jti: until for jti, until in self.revoked_tokens.items() if until > now}
+        self.revoked_users = {user: before for user, before in self.revoked_users.items() if before > oldest}
+
+    async def poll_revocations(self, db) -> None:
+        while True:
+            try:
+                await self.load_revocations(db)
+            except Exception:
+                logger.exception("Could not read the token revocations")
+            await asyncio.sleep(POLL_SECONDS)
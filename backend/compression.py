@@ -0,0 +1,44 @@
+"""Negotiated response compression.
+
+JSON lists compress by an order of magnitude, so responses above
+``minimum_size`` bytes are sent with brotli when the client accepts it and
+``brotli-asgi`` is installed, and with gzip otherwise. Paths that serve
+already-compressed binaries (photos, thumbnails) or must not be buffered
+(event streams) are matched by ``excluded`` and passed through untouched.
+"""
+import logging
+import re
+from typing import Sequence
+
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # optional: gzip only
+    BrotliMiddleware = None
+
+MINIMUM_SIZE = 1000
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, excluded: Sequence[str] = (), minimum_size: int = MINIMUM_SIZE) -> None:
+        self.app = app
+        self.excluded = re.compile("|".join(f"(?:{pattern})" for pattern in excluded)) if excluded else None
+        if BrotliMiddleware is not None:
+            # Falls back to gzip for clients that do not accept br
+            self.compressed = BrotliMiddleware(app, quality=BROTLI_QUALITY, minimum_size=minimum_size,
+                                               gzip_fallback=True)
+        else:
+            logger.info("brotli-asgi not installed: responses are compressed with gzip only")
+            self.compressed = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=GZIP_LEVEL)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (self.excluded and self.excluded.match(scope["path"])):
+            await self.app(scope, receive, send)
+            return
+        await self.compressed(scope, receive, send)
@@ -0,0 +1,135 @@
+"""Password and refresh-token store of the ``users`` collection.
+
+Passwords are kept as bcrypt hashes. A cost-12 check takes about 250 ms of
+CPU, so hashing and verification run in a bounded thread pool sized to the
+cores (bcrypt releases the GIL) instead of blocking the event loop during
+the morning logins.
+
+A refresh token is an opaque random string handed out at login; only its
+SHA-256 is stored. Exchanging it for a new access token needs no bcrypt
+check, and rotates it: the old token is consumed and a new one issued.
+"""
+import asyncio
+import hashlib
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+import bcrypt
+from pymongo.errors import DuplicateKeyError
+
+from auth_context import TokenVerifier
+
+BCRYPT_ROUNDS = 12
+REFRESH_TOKEN_DAYS = 14
+
+_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix="bcrypt")
+
+# Compared against when the user does not exist, so that a wrong username
+# costs as much as a wrong password; hashed at the first such login, not at import
+_dummy_hash: Optional[str] = None
+
+
+def _hash(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+def _check(password: str, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password.encode(), hashed)
+
+
+async def hash_password(password: str) -> str:
+    hashed = await asyncio.get_running_loop().run_in_executor(_pool, _hash, password)
+    return hashed.decode()
+
+
+async def check_password(password: str, hashed: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(_pool, _check, password, hashed.encode())
+
+
+async def seed_users(db, users: Dict[str, dict]) -> int:
+    """Create the users of ``users`` (plaintext seed) missing from ``users``."""
+    existing = {doc["username"] async for doc in db.users.find({}, {"_id": 0, "username": 1})}
+    missing = [username for username in users if username not in existing]
+    hashes = await asyncio.gather(*(hash_password(users[username]["password"]) for username in missing))
+    created = 0
+    for username, password_hash in zip(missing, hashes):
+        try:
+            await db.users.insert_one({
+                "username": username,
+                "password_hash": password_hash,
+                "ambulatori": users[username]["ambulatori"],
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            })
+            created += 1
+        except DuplicateKeyError:
+            pass  # seeded meanwhile by another worker
+    return created
+
+
+async def authenticate(db, username: str, password: str) -> Optional[dict]:
+    """The user if the password matches, else None."""
+    user = await db.users.find_one({"username": username}, {"_id": 0})
+    if user is None:
+        global _dummy_hash
+        if _dummy_hash is None:
+            _dummy_hash = await hash_password("-")
+        await check_password(password, _dummy_hash)
+        return None
+    if not await check_password(password, user["password_hash"]):
+        return None
+    return user
+
+
+async def set_password(db, verifier: TokenVerifier, username: str, password: str) -> bool:
+    password_hash = await hash_password(password)
+    result = await db.users.update_one({"username": username}, {"$set": {"password_hash": password_hash}})
+    if result.matched_count:
+        # Sessions opened with the old password end now, not at their next refresh
+        await verifier.revoke_user(db, username)
+        await revoke_refresh_tokens(db, username)
+    return bool(result.matched_count)
+
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def issue_refresh_token(db, username: str) -> str:
+    token = secrets.token_urlsafe(32)
+    now = datetime.now(timezone.utc)
+    await db.refresh_tokens.insert_one({
+        "_id": _digest(token),
+        "username": username,
+        "created_at": now.isoformat(),
+        # TTL index: a date, not an ISO string
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_DAYS),
+    })
+    return token
+
+
+async def rotate_refresh_token(db, token: str) -> Optional[Tuple[dict, str]]:
+    """Consume ``token``; returns the user and a new refresh token, or None."""
+    doc = await db.refresh_tokens.find_one_and_delete({"_id": _digest(token)})
+    if doc is None:
+        return None
+    expires_at = doc["expires_at"]
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    if expires_at <= datetime.now(timezone.utc):
+        # The TTL monitor runs about once a minute
+        return None
+    user = await db.users.find_one({"username": doc["username"]}, {"_id": 0, "password_hash": 0})
+    if user is None:
+        return None
+    return user, await issue_refresh_token(db, user["username"])
+
+
+async def revoke_refresh_token(db, token: str) -> None:
+    await db.refresh_tokens.delete_one({"_id": _digest(token)})
+
+
+async def revoke_refresh_tokens(db, username: str) -> None:
+    await db.refresh_tokens.delete_many({"username": username})
@@ -0,0 +1,165 @@
+"""Index set of the database and a startup check of the hot query plans.
+
+``INDEXES`` declares every index the server relies on; ``ensure_indexes``
+creates the missing ones at startup (``create_indexes`` is a no-op for
+indexes that already exist). ``HOT_QUERIES`` lists the query shapes of the
+busiest routes: ``verify_query_plans`` runs ``explain()`` on each one and
+reports those whose winning plan still scans the whole collection.
+"""
+import logging
+from typing import List
+
+from bson.regex import Regex
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+def _unique_id() -> IndexModel:
+    return IndexModel([("id", ASCENDING)], unique=True, name="id_unique")
+
+
+def _updated_at() -> IndexModel:
+    # Delta sync (sync.changes) pages through each collection by (updated_at, id)
+    return IndexModel([("ambulatorio", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)])
+
+
+INDEXES = {
+    "patients": [
+        _unique_id(),
+        IndexModel([("ambulatorio", ASCENDING), ("status", ASCENDING), ("cognome", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("ambulatorio", ASCENDING), ("cognome", ASCENDING), ("id", ASCENDING)]),
+        # Multikey index over the normalised name words (patient_search)
+        IndexModel([("ambulatorio", ASCENDING), ("search_keys", ASCENDING)]),
+        IndexModel([("ambulatorio", ASCENDING), ("codice_fiscale_norm", ASCENDING)]),
+        _updated_at(),
+    ],
+    "appointments": [
+        _unique_id(),
+        IndexModel([("ambulatorio", ASCENDING), ("data", ASCENDING), ("ora", ASCENDING), ("tipo", ASCENDING)]),
+        IndexModel([("ambulatorio", ASCENDING), ("data", ASCENDING), ("ora", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("patient_id", ASCENDING), ("ambulatorio", ASCENDING), ("data", ASCENDING)]),
+        _updated_at(),
+    ],
+    "schede_medicazione_med": [
+        _unique_id(),
+        IndexModel([("patient_id", ASCENDING), ("ambulatorio", ASCENDING), ("data_compilazione", DESCENDING)]),
+        _updated_at(),
+    ],
+    "schede_impianto_picc": [
+        _unique_id(),
+        IndexModel([("patient_id", ASCENDING), ("ambulatorio", ASCENDING), ("data_impianto", DESCENDING)]),
+        IndexModel([("ambulatorio", ASCENDING), ("data_impianto", ASCENDING)]),
+        _updated_at(),
+    ],
+    "schede_gestione_picc": [
+        _unique_id(),
+        IndexModel([("patient_id", ASCENDING), ("ambulatorio", ASCENDING), ("mese", DESCENDING)]),
+        _updated_at(),
+    ],
+    "photos": [
+        _unique_id(),
+        IndexModel([("patient_id", ASCENDING), ("ambulatorio", ASCENDING), ("data", DESCENDING)]),
+        _updated_at(),
+    ],
+    "stats_daily": [
+        IndexModel([("ambulatorio", ASCENDING), ("data", ASCENDING), ("tipo", ASCENDING)]),
+    ],
+    # _id is the slot key; this serves range reads over the agenda
+    "slots": [
+        IndexModel([("ambulatorio", ASCENDING), ("data", ASCENDING), ("tipo", ASCENDING)]),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    # _id is the SHA-256 of the token
+    "refresh_tokens": [
+        IndexModel([("username", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # Revoked access tokens and users (auth_context); _id is "<kind>:<value>"
+    "revocations": [
+        IndexModel([("revoked_at", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    # Deleted records for delta sync; expired by the TTL index
+    "tombstones": [
+        IndexModel([("ambulatorio", ASCENDING), ("collection", ASCENDING), ("deleted_at", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+# (collection, filter, sort) of the queries behind the busiest routes
+HOT_QUERIES = [
+    ("patients", {"id": "x"}, None),
+    ("patients", {"ambulatorio": "pta_centro", "status": "in_cura"}, [("cognome", ASCENDING), ("id", ASCENDING)]),
+    ("patients", {"ambulatorio": "pta_centro"}, [("cognome", ASCENDING), ("id", ASCENDING)]),
+    ("patients", {"ambulatorio": "pta_centro", "search_keys": Regex("^ros")}, None),
+    ("patients", {"ambulatorio": "pta_centro", "codice_fiscale_norm": "RSSMRA80A01H501U"}, None),
+    ("appointments", {"id": "x"}, None),
+    ("appointments", {"ambulatorio": "pta_centro", "data": "2026-01-01", "ora": "08:30", "tipo": "PICC"}, None),
+    ("appointments", {"ambulatorio": "pta_centro", "data": {"$gte": "2026-01-01", "$lte": "2026-01-31"}},
+     [("data", ASCENDING), ("ora", ASCENDING), ("id", ASCENDING)]),
+    ("schede_medicazione_med", {"id": "x"}, None),
+    ("schede_medicazione_med", {"patient_id": "x", "ambulatorio": "pta_centro"}, [("data_compilazione", DESCENDING)]),
+    ("schede_impianto_picc", {"id": "x"}, None),
+    ("schede_impianto_picc", {"patient_id": "x", "ambulatorio": "pta_centro"}, [("data_impianto", DESCENDING)]),
+    ("schede_impianto_picc", {"ambulatorio": "pta_centro", "data_impianto": {"$gte": "2026-01-01", "$lt": "2027-01-01"}}, None),
+    ("schede_gestione_picc", {"id": "x"}, None),
+    ("schede_gestione_picc", {"patient_id": "x", "ambulatorio": "pta_centro"}, [("mese", DESCENDING)]),
+    ("photos", {"id": "x"}, None),
+    ("photos", {"patient_id": "x", "ambulatorio": "pta_centro"}, [("data", DESCENDING)]),
+    ("stats_daily", {"ambulatorio": "pta_centro", "data": {"$gte": "2026-01-01", "$lt": "2027-01-01"}}, None),
+    ("slots", {"ambulatorio": "pta_centro", "data": {"$gte": "2026-01-01", "$lte": "2026-01-31"}}, None),
+    ("appointments", {"ambulatorio": {"$in": ["pta_centro"]}, "updated_at": {"$gte": "2026-01-01"}},
+     [("updated_at", ASCENDING), ("id", ASCENDING)]),
+    ("tombstones", {"ambulatorio": {"$in": ["pta_centro"]}, "collection": "appointments",
+                    "deleted_at": {"$gte": "2026-01-01"}}, [("deleted_at", ASCENDING), ("id", ASCENDING)]),
+]
+
+
+async def ensure_indexes(db) -> None:
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as exc:
+            # e.g. duplicate ids in old data prevent the unique index
+            logger.error("Cannot create indexes on %s: %s", collection, exc)
+
+
+def _stages(plan) -> List[str]:
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if "stage" in plan else []
+        for value in plan.values():
+            stages.extend(_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _stages(item)]
+    return []
+
+
+async def verify_query_plans(db, mode: str = "log") -> List[str]:
+    """Explain every query in ``HOT_QUERIES`` and report collection scans.
+
+    ``mode`` is ``off``, ``log`` (warn and carry on) or ``fail`` (refuse to
+    start). Returns the descriptions of the offending queries.
+    """
+    if mode == "off":
+        return []
+
+    collscans = []
+    for collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = _stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            collscans.append(f"{collection} {query} sort={sort}")
+
+    for description in collscans:
+        logger.warning("Query plan uses COLLSCAN: %s", description)
+    if collscans and mode == "fail":
+        raise RuntimeError(f"{len(collscans)} hot queries fall back to COLLSCAN")
+    return collscans
@@ -0,0 +1,198 @@
+"""Live agenda and patient changes for the tablets (Server-Sent Events).
+
+Every insert, update and delete of ``appointments`` and ``patients`` is
+published to the subscribers of its ambulatorio, so the open agenda applies
+the change instead of re-reading the whole day. With a replica set the
+changes come from a MongoDB change stream and every worker sees the writes
+of every other worker. A standalone server has no change streams: the write
+routes then publish their own changes in-process, which is enough for a
+single node.
+
+Deletes carry the record's ``id`` only when the change stream can give the
+document before the change (``changeStreamPreAndPostImages`` enabled on the
+collection); otherwise subscribers receive a ``resync`` event and reload.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import AsyncIterator, Callable, Dict, Iterable, Optional, Set
+
+import orjson
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Fields sent for each collection (None: the whole document)
+EVENT_FIELDS = {
+    "appointments": None,
+    "patients": ("id", "ambulatorio", "nome", "cognome", "tipo", "status", "discharge_reason"),
+}
+
+# Events a slow subscriber may fall behind by before it is told to resync
+QUEUE_SIZE = 100
+HEARTBEAT_SECONDS = 15
+RETRY_MS = 3000
+WATCH_RETRY_SECONDS = 5
+WATCH_RETRY_MAX_SECONDS = 300
+
+# "The $changeStream stage is only supported on replica sets"
+NO_REPLICA_SET = 40573
+# Unknown field / failed to parse: an option the server does not know
+UNKNOWN_OPTION = (40415, 9)
+
+RESYNC = {"collection": None, "op": "resync"}
+UNAUTHORIZED = b"event: unauthorized\ndata: {}\n\n"
+
+
+def _fields(collection: str, doc: dict) -> dict:
+    fields = EVENT_FIELDS[collection]
+    if fields is None:
+        return {k: v for k, v in doc.items() if k != "_id"}
+    return {k: doc.get(k) for k in fields}
+
+
+class EventBus:
+    """In-process fan-out of change events to per-ambulatorio subscribers."""
+
+    def __init__(self, queue_size: int = QUEUE_SIZE) -> None:
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        # True while a change stream feeds the bus
+        self.changestream = False
+
+    def subscribe(self, ambulatori: Iterable[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        for ambulatorio in ambulatori:
+            self.subscribers[ambulatorio].add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, ambulatori: Iterable[str]) -> None:
+        for ambulatorio in ambulatori:
+            self.subscribers[ambulatorio].discard(queue)
+
+    def publish(self, ambulatorio: Optional[str], event: dict) -> None:
+        """Send to the subscribers of ambulatorio (None: to every subscriber)."""
+        if ambulatorio is None:
+            queues = set().union(*self.subscribers.values())
+        else:
+            queues = self.subscribers.get(ambulatorio, ())
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too far behind: drop the backlog, the client reloads
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+
+    def publish_change(self, collection: str, op: str, doc: Optional[dict],
+                       before: Optional[dict] = None) -> None:
+        """Publish an insert, update or delete; ``before`` is the record before
+        an update, used to tell its old ambulatorio that it moved away."""
+        if op == "delete":
+            if doc is None:
+                self.publish(None, RESYNC)
+            else:
+                self.publish(doc["ambulatorio"], {"collection": collection, "op": "delete", "id": doc["id"]})
+            return
+        if before and before.get("ambulatorio") != doc.get("ambulatorio"):
+            self.publish(before["ambulatorio"], {"collection": collection, "op": "delete", "id": doc["id"]})
+        self.publish(doc["ambulatorio"], {
+            "collection": collection, "op": op, "id": doc["id"], "doc": _fields(collection, doc)
+        })
+
+    def notify(self, collection: str, op: str, doc: Optional[dict], before: Optional[dict] = None) -> None:
+        """Called by the write routes; a running change stream already sees the write."""
+        if not self.changestream:
+            self.publish_change(collection, op, doc, before)
+
+
+def _unsupported_pre_images(exc: OperationFailure) -> bool:
+    """MongoDB before 6.0 rejects the fullDocumentBeforeChange option."""
+    return exc.code in UNKNOWN_OPTION or "fullDocumentBeforeChange" in str(exc)
+
+
+async def watch(db, bus: EventBus) -> None:
+    """Feed the bus from a change stream until cancelled; returns at once on
+    a standalone server, leaving the routes to publish their own changes.
+
+    While the stream is down the routes publish in-process, and subscribers
+    are told to resync only when a running stream is lost; a stream that
+    keeps failing to open is retried with a growing delay."""
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": list(EVENT_FIELDS)},
+        "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+    }}]
+    options = {"full_document": "updateLookup", "full_document_before_change": "whenAvailable"}
+    resume_token = None
+    failures = 0
+    while True:
+        try:
+            async with db.watch(pipeline, resume_after=resume_token, **options) as stream:
+                bus.changestream = True
+                failures = 0
+                logger.info("Live events fed by the change stream")
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    collection = change["ns"]["coll"]
+                    op = {"insert": "insert", "delete": "delete"}.get(change["operationType"], "update")
+                    if op == "delete":
+                        bus.publish_change(collection, op, change.get("fullDocumentBeforeChange"))
+                    elif change.get("fullDocument"):
+                        # None when the record was deleted before the lookup
+                        bus.publish_change(collection, op, change["fullDocument"],
+                                           change.get("fullDocumentBeforeChange"))
+        except OperationFailure as exc:
+            streaming, bus.changestream = bus.changestream, False
+            if exc.code == NO_REPLICA_SET:
+                logger.info("No change streams (not a replica set): live events published in-process")
+                return
+            if "full_document_before_change" in options and _unsupported_pre_images(exc):
+                logger.info("Change stream pre-images not supported: deletes are sent as resync")
+                del options["full_document_before_change"]
+                continue
+            failures += 1
+            logger.warning("Change stream failed (%d), restarting: %s", failures, exc)
+            resume_token = None
+            if streaming:
+                # Changes made by other workers meanwhile are lost
+                bus.publish(None, RESYNC)
+        except PyMongoError as exc:
+            bus.changestream = False
+            failures += 1
+            logger.warning("Change stream interrupted (%d), resuming: %s", failures, exc)
+        await asyncio.sleep(min(WATCH_RETRY_SECONDS * 2 ** max(failures - 1, 0), WATCH_RETRY_MAX_SECONDS))
+
+
+def _format(event: dict) -> bytes:
+    name = "resync" if event["op"] == "resync" else event["collection"]
+    return b"event: " + name.encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
+
+
+async def stream(bus: EventBus, ambulatori: Iterable[str],
+                 authorized: Callable[[], bool] = lambda: True) -> AsyncIterator[bytes]:
+    """The text/event-stream body of one subscriber.
+
+    ``authorized`` is checked before every event and heartbeat: once the
+    token has expired or was revoked, an ``unauthorized`` event is sent and
+    the stream ends, so the client reconnects with a fresh token.
+    """
+    ambulatori = list(ambulatori)
+    queue = bus.subscribe(ambulatori)
+    try:
+        yield f"retry: {RETRY_MS}\n\n".encode()
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                event = None
+            if not authorized():
+                yield UNAUTHORIZED
+                return
+            if event is None:
+                # Keeps proxies from closing an idle connection
+                yield b": ping\n\n"
+                continue
+            yield _format(event)
+    finally:
+        bus.unsubscribe(queue, ambulatori)
@@ -0,0 +1,108 @@
+"""Maintenance commands for the Ambulatorio Infermieristico backend.
+
+Run from the backend directory, with the same environment as the server:
+
+    python manage.py migrate-photos
+"""
+import asyncio
+
+import typer
+
+from server import db, client, photo_store, token_verifier
+from photo_store import migrate_inline_photos
+from thumbnails import generate_missing_thumbnails
+import stats_rollup
+import slots
+import patient_search
+import sync
+import credentials
+
+cli = typer.Typer(help="Comandi di manutenzione del backend")
+
+
+@cli.callback()
+def main():
+    pass
+
+
+def run(coro):
+    try:
+        return asyncio.run(coro)
+    finally:
+        client.close()
+
+
+@cli.command("migrate-photos")
+def migrate_photos(
+    batch_size: int = typer.Option(100, help="Documenti letti per batch"),
+    limit: int = typer.Option(0, help="Numero massimo di foto da convertire (0 = tutte)"),
+):
+    """Move base64 photos from the `photos` documents into the blob store."""
+    migrated = run(migrate_inline_photos(db, photo_store, batch_size=batch_size, limit=limit or None))
+    typer.echo(f"Foto migrate: {migrated}")
+
+
+@cli.command("build-thumbnails")
+def build_thumbnails(
+    limit: int = typer.Option(0, help="Numero massimo di foto da elaborare (0 = tutte)"),
+):
+    """Render missing thumbnails, e.g. for photos converted by migrate-photos."""
+    generated = run(generate_missing_thumbnails(db, photo_store, limit=limit))
+    typer.echo(f"Anteprime generate: {generated}")
+
+
+@cli.command("rebuild-stats")
+def rebuild_stats():
+    """Regenerate the `stats_daily` rollups from the whole appointment history."""
+    documents = run(stats_rollup.rebuild(db))
+    typer.echo(f"Rollup giornalieri ricostruiti: {documents}")
+
+
+@cli.command("rebuild-slots")
+def rebuild_slots():
+    """Recount the `slots` capacity documents from the appointments (stop booking first)."""
+    documents = run(slots.rebuild(db))
+    typer.echo(f"Slot ricalcolati: {documents}")
+
+
+@cli.command("reindex-patients")
+def reindex_patients():
+    """Recompute the search fields of every patient (run once after upgrading)."""
+    updated = run(patient_search.reindex(db))
+    typer.echo(f"Pazienti reindicizzati: {updated}")
+
+
+@cli.command("backfill-updated-at")
+def backfill_updated_at():
+    """Give `updated_at` to records created before delta sync (also done at every server start)."""
+    counts = run(sync.backfill(db))
+    for collection, updated in counts.items():
+        typer.echo(f"{collection}: {updated}")
+
+
+@cli.command("set-password")
+def set_password(
+    username: str,
+    password: str = typer.Option(..., prompt=True, hide_input=True, confirmation_prompt=True),
+):
+    """Change a user's password (stored as a bcrypt hash); their sessions must log in again."""
+    if not run(credentials.set_password(db, token_verifier, username, password)):
+        typer.echo(f"Utente non trovato: {username}")
+        raise typer.Exit(code=1)
+    typer.echo(f"Password aggiornata: {username}")
+
+
+async def _revoke_sessions(username: str):
+    await token_verifier.revoke_user(db, username)
+    await credentials.revoke_refresh_tokens(db, username)
+
+
+@cli.command("revoke-sessions")
+def revoke_sessions(username: str):
+    """Log a user out of every device (e.g. a lost tablet); takes effect within seconds."""
+    run(_revoke_sessions(username))
+    typer.echo(f"Sessioni revocate: {username}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,141 @@
+"""Request and database instrumentation, exposed in Prometheus text format.
+
+``MetricsMiddleware`` records, per route template (``/api/patients/{patient_id}``,
+never the raw path) and ambulatorio, the latency and the size on the wire of
+every response, plus the requests in flight. ``CommandMetrics`` is a pymongo
+command listener recording the duration of every database command and the
+documents it returned, per collection. ``/api/metrics`` renders both.
+
+The ambulatorio label comes from the ``ambulatorio`` query parameter, which
+the list, calendar and statistics routes take; other requests get ``-``.
+"""
+import threading
+import time
+from typing import Dict, Tuple
+from urllib.parse import parse_qs
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, ProcessCollector, generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+REGISTRY = CollectorRegistry()
+ProcessCollector(registry=REGISTRY)
+
+AMBULATORI = frozenset(("pta_centro", "villa_ginestre"))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latenza delle richieste HTTP",
+    ["method", "route", "status", "ambulatorio"], registry=REGISTRY,
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RESPONSE_SIZE = Histogram(
+    "http_response_size_bytes", "Dimensione delle risposte HTTP (dopo la compressione)",
+    ["method", "route", "ambulatorio"], registry=REGISTRY,
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "Richieste HTTP in corso", ["method"], registry=REGISTRY)
+
+COMMAND_LATENCY = Histogram(
+    "mongodb_command_duration_seconds", "Durata dei comandi MongoDB",
+    ["collection", "command"], registry=REGISTRY,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+COMMAND_DOCUMENTS = Counter(
+    "mongodb_command_documents_returned", "Documenti restituiti dai comandi MongoDB",
+    ["collection", "command"], registry=REGISTRY,
+)
+COMMAND_FAILURES = Counter(
+    "mongodb_command_failures", "Comandi MongoDB falliti",
+    ["collection", "command"], registry=REGISTRY,
+)
+
+
+def render() -> Tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def _ambulatorio(scope: Scope) -> str:
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("ambulatorio")
+    return values[0] if values and values[0] in AMBULATORI else "-"
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        size = 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        IN_FLIGHT.labels(method).inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.labels(method).dec()
+            # The router stores the matched route in the scope; raw paths would
+            # make a series per record id
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            ambulatorio = _ambulatorio(scope)
+            REQUEST_LATENCY.labels(method, route, str(status), ambulatorio).observe(elapsed)
+            RESPONSE_SIZE.labels(method, route, ambulatorio).observe(size)
+
+
+def _returned(reply: dict) -> int:
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    if reply.get("value") is not None:  # findAndModify
+        return 1
+    return 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Pass to the client as ``event_listeners``; runs on the driver's threads."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple, str] = {}
+
+    @staticmethod
+    def _key(event) -> Tuple:
+        return (event.connection_id, event.request_id)
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        with self._lock:
+            self._pending[self._key(event)] = target if isinstance(target, str) else "-"
+
+    def _collection(self, event) -> str:
+        with self._lock:
+            return self._pending.pop(self._key(event), "-")
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        collection = self._collection(event)
+        COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        returned = _returned(event.reply)
+        if returned:
+            COMMAND_DOCUMENTS.labels(collection, event.command_name).inc(returned)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        collection = self._collection(event)
+        COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        COMMAND_FAILURES.labels(collection, event.command_name).inc()
@@ -0,0 +1,122 @@
+"""Indexed patient search.
+
+Every patient document carries ``search_keys``, the normalised words of nome
+and cognome (lowercase, accents stripped, "D'Angelo" -> "d", "angelo",
+"dangelo"), and ``codice_fiscale_norm``. A search term becomes an anchored
+prefix regex on ``search_keys``, which MongoDB answers with an index range
+scan on ``(ambulatorio, search_keys)`` instead of evaluating a free regex
+against every patient.
+"""
+import re
+import unicodedata
+from typing import List, Optional
+
+from bson.regex import Regex
+
+CODICE_FISCALE = re.compile(r"^[A-Z]{6}[0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$")
+WORD = re.compile(r"[a-z0-9]+")
+
+# Source fields of the search keys; an update touching one recomputes them
+SOURCE_FIELDS = ("nome", "cognome", "codice_fiscale")
+# Internal fields, never sent to clients
+INTERNAL_FIELDS = ("search_keys", "codice_fiscale_norm")
+
+# Matches read from the index and ranked; the best SEARCH_LIMIT are returned
+SEARCH_CANDIDATES = 500
+SEARCH_LIMIT = 50
+
+
+def normalise(text: Optional[str]) -> str:
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def words(text: Optional[str]) -> List[str]:
+    return WORD.findall(normalise(text))
+
+
+def keys_for(text: Optional[str]) -> List[str]:
+    parts = words(text)
+    # Multi-word names are also searchable typed without spaces/apostrophes
+    return parts + ["".join(parts)] if len(parts) > 1 else parts
+
+
+def search_fields(patient: dict) -> dict:
+    """The derived search fields for a patient document."""
+    codice_fiscale = re.sub(r"\s", "", patient.get("codice_fiscale") or "").upper()
+    return {
+        "search_keys": sorted(set(keys_for(patient.get("nome")) + keys_for(patient.get("cognome")))),
+        "codice_fiscale_norm": codice_fiscale or None,
+    }
+
+
+def search_updates(changes: dict) -> dict:
+    """The search fields that can be written together with ``changes``.
+
+    ``search_keys`` depends on both nome and cognome: when only one of them
+    changes, see ``needs_reindex``.
+    """
+    fields = search_fields(changes)
+    updates = {}
+    if "nome" in changes and "cognome" in changes:
+        updates["search_keys"] = fields["search_keys"]
+    if "codice_fiscale" in changes:
+        updates["codice_fiscale_norm"] = fields["codice_fiscale_norm"]
+    return updates
+
+
+def needs_reindex(changes: dict) -> bool:
+    return ("nome" in changes) != ("cognome" in changes)
+
+
+def build_query(search: str) -> Optional[dict]:
+    """Filter for ``search``, or None when it contains nothing searchable."""
+    terms = words(search)
+    clauses = []
+    if terms:
+        prefixes = [{"search_keys": Regex("^" + re.escape(term))} for term in terms]
+        clauses.append(prefixes[0] if len(prefixes) == 1 else {"$and": prefixes})
+    codice_fiscale = re.sub(r"\s", "", search).upper()
+    if CODICE_FISCALE.match(codice_fiscale):
+        clauses.append({"codice_fiscale_norm": codice_fiscale})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def rank(patients: List[dict], search: str) -> List[dict]:
+    """Best matches first: codice fiscale, then exact and prefix matches on
+    cognome before nome, then alphabetical."""
+    terms = words(search)
+    codice_fiscale = re.sub(r"\s", "", search).upper()
+
+    def score(patient: dict) -> tuple:
+        if patient.get("codice_fiscale") and patient["codice_fiscale"].upper() == codice_fiscale:
+            return (-1, "", "")
+        cognome, nome = keys_for(patient.get("cognome")), keys_for(patient.get("nome"))
+        total = 0
+        for term in terms:
+            if term not in cognome:
+                if any(k.startswith(term) for k in cognome):
+                    total += 1
+                else:
+                    total += 2 if term in nome else 3
+        return (total, normalise(patient.get("cognome")), normalise(patient.get("nome")))
+
+    return sorted(patients, key=score)
+
+
+async def reindex(db, batch_size: int = 500, query: Optional[dict] = None) -> int:
+    """Recompute the search fields of every patient (or of those matching ``query``)."""
+    updated = 0
+    projection = {"_id": 0, "id": 1, **{f: 1 for f in SOURCE_FIELDS}}
+    async for patient in db.patients.find(query or {}, projection).batch_size(batch_size):
+        await db.patients.update_one({"id": patient["id"]}, {"$set": search_fields(patient)})
+        updated += 1
+    return updated
+
+
+async def ensure_indexed(db) -> int:
+    """Index the patients saved before the search fields existed (first start
+    after the upgrade); without it they would not be found by name."""
+    return await reindex(db, query={"search_keys": {"$exists": False}})
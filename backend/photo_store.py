@@ -0,0 +1,166 @@
+"""Chunked binary storage for patient photos.
+
+The ``photos`` collection only keeps metadata and a ``blob_id``; the image
+bytes live in a :class:`BlobStore`. The default implementation is backed by
+GridFS so photos are split into fixed-size chunks and never have to be held
+in memory as a whole, neither on upload nor on download.
+"""
+import base64
+import hashlib
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+CHUNK_SIZE = 256 * 1024
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+@dataclass
+class StoredBlob:
+    blob_id: str
+    size: int
+    sha256: str
+    content_type: str
+
+
+@dataclass
+class BlobReader:
+    content_type: str
+    size: int
+    chunks: AsyncIterator[bytes]
+
+
+class BlobStore:
+    """Interface for photo binaries: write from a chunk stream, read as one."""
+
+    async def save(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> StoredBlob:
+        raise NotImplementedError
+
+    async def open(self, blob_id: str) -> BlobReader:
+        raise NotImplementedError
+
+    async def delete(self, blob_id: str) -> None:
+        raise NotImplementedError
+
+
+class GridFSBlobStore(BlobStore):
+    def __init__(self, db, bucket_name: str = "photo_blobs", chunk_size: int = CHUNK_SIZE):
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=chunk_size)
+
+    async def save(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> StoredBlob:
+        digest = hashlib.sha256()
+        size = 0
+        grid_in = self.bucket.open_upload_stream(filename, metadata={"content_type": content_type})
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                await grid_in.write(chunk)
+        except BaseException:
+            await grid_in.abort()
+            raise
+        await grid_in.close()
+        return StoredBlob(
+            blob_id=str(grid_in._id),
+            size=size,
+            sha256=digest.hexdigest(),
+            content_type=content_type,
+        )
+
+    async def open(self, blob_id: str) -> BlobReader:
+        try:
+            grid_out = await self.bucket.open_download_stream(ObjectId(blob_id))
+        except (NoFile, InvalidId):
+            raise BlobNotFound(blob_id)
+
+        async def iter_chunks():
+            while True:
+                chunk = await grid_out.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+
+        metadata = grid_out.metadata or {}
+        return BlobReader(
+            content_type=metadata.get("content_type", DEFAULT_CONTENT_TYPE),
+            size=grid_out.length,
+            chunks=iter_chunks(),
+        )
+
+    async def delete(self, blob_id: str) -> None:
+        try:
+            await self.bucket.delete(ObjectId(blob_id))
+        except (NoFile, InvalidId):
+            pass
+
+
+async def iter_upload(file, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Yield an ``UploadFile`` in chunks instead of reading it whole."""
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def iter_bytes(data: bytes, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def guess_content_type(data: bytes) -> str:
+    """Sniff the image format of legacy photos, which were stored without one."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    return "image/jpeg"
+
+
+async def migrate_inline_photos(db, store: BlobStore, batch_size: int = 100, limit: Optional[int] = None) -> int:
+    """Move base64 ``image_data`` of existing photos into ``store``.
+
+    Each document is converted on its own, so the command can be interrupted
+    and run again: photos that already have a ``blob_id`` are skipped.
+    """
+    query = {"image_data": {"$exists": True}, "blob_id": {"$exists": False}}
+    cursor = db.photos.find(query, {"_id": 0, "id": 1, "image_data": 1}).batch_size(batch_size)
+    migrated = 0
+    async for doc in cursor:
+        data = base64.b64decode(doc["image_data"])
+        content_type = guess_content_type(data)
+        stored = await store.save(iter_bytes(data), doc["id"], content_type)
+        result = await db.photos.update_one(
+            {"id": doc["id"], "blob_id": {"$exists": False}},
+            {
+                "$set": {
+                    "blob_id": stored.blob_id,
+                    "content_type": stored.content_type,
+                    "size": stored.size,
+                    "sha256": stored.sha256,
+                },
+                "$unset": {"image_data": ""},
+            },
+        )
+        if result.modified_count == 0:
+            # Converted concurrently by another run
+            await store.delete(stored.blob_id)
+            continue
+        migrated += 1
+        if limit and migrated >= limit:
+            break
+    return migrated
@@ -0,0 +1,125 @@
+"""Opt-in profiling of single requests.
+
+Only installed when ``PROFILING`` is enabled, so it costs nothing otherwise.
+A request carrying ``__profile=1`` in the query string (or an ``X-Profile: 1``
+header) from one of the allowed users is run under a profiler, and the
+profile is written to ``directory``; its name comes back in the
+``X-Profile-Id`` response header and the file can be downloaded from
+``/api/profiles/{name}``.
+
+With ``pyinstrument`` installed the profile is a sampling, async-aware trace
+of that request alone, including the time spent awaiting MongoDB, saved in
+speedscope format (``.speedscope.json``, open at https://www.speedscope.app).
+Without it ``cProfile`` is used: a ``.prof`` file (snakeviz, flameprof) that
+counts the CPU time of the event loop thread, including any request running
+concurrently, but not the time spent waiting.
+"""
+import asyncio
+import cProfile
+import logging
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, List, Optional
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # optional: cProfile only
+    Profiler = None
+
+PROFILE_HEADER = "X-Profile-Id"
+KEEP = 50
+NAME_PATTERN = re.compile(r"^[\w.-]+\.(speedscope\.json|prof)$")
+
+
+def requested(scope: Scope) -> bool:
+    if Headers(scope=scope).get("x-profile") == "1":
+        return True
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return query.get("__profile") == ["1"]
+
+
+def bearer_token(scope: Scope) -> Optional[str]:
+    scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" and token else None
+
+
+def profile_path(directory: Path, name: str) -> Optional[Path]:
+    """The stored profile called ``name``, or None (also for unsafe names)."""
+    if not NAME_PATTERN.match(name):
+        return None
+    path = directory / name
+    return path if path.is_file() else None
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, authorize: Callable[[str], bool], directory: Path, keep: int = KEEP) -> None:
+        """``authorize`` tells from a bearer token whether its user may profile."""
+        self.app = app
+        self.authorize = authorize
+        self.directory = Path(directory)
+        self.keep = keep
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if Profiler is None:
+            logger.info("pyinstrument not installed: requests are profiled with cProfile")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not requested(scope):
+            await self.app(scope, receive, send)
+            return
+        token = bearer_token(scope)
+        if token is None or not self.authorize(token):
+            await self.app(scope, receive, send)
+            return
+
+        path = re.sub(r"[^\w]+", "_", scope["path"]).strip("_")
+        suffix = "speedscope.json" if Profiler is not None else "prof"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}-{path}-{uuid.uuid4().hex[:8]}.{suffix}"
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = [*message["headers"], (PROFILE_HEADER.lower().encode(), name.encode())]
+            await send(message)
+
+        if Profiler is not None:
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.stop()
+                content = profiler.output(SpeedscopeRenderer())
+                await asyncio.to_thread(self._save, name, content.encode())
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                profiler.disable()
+                await asyncio.to_thread(self._dump, name, profiler)
+
+    def _save(self, name: str, content: bytes) -> None:
+        (self.directory / name).write_bytes(content)
+        self._prune()
+
+    def _dump(self, name: str, profiler: cProfile.Profile) -> None:
+        profiler.dump_stats(str(self.directory / name))
+        self._prune()
+
+    def _prune(self) -> None:
+        profiles: List[Path] = sorted(
+            (path for path in self.directory.iterdir() if NAME_PATTERN.match(path.name)),
+            key=lambda path: path.stat().st_mtime,
+        )
+        for path in profiles[:-self.keep]:
+            path.unlink(missing_ok=True)
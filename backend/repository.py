@@ -0,0 +1,73 @@
+"""Single round-trip mutations of ambulatorio-owned records.
+
+Every patient, appointment, scheda and photo belongs to one ambulatorio, and
+a user may only touch records of the ambulatori in their token. Instead of
+reading the record to check it, writing it and reading it back, the access
+check is part of the filter of a single ``find_one_and_update`` /
+``find_one_and_delete``. Only when nothing matched is a second, cheap lookup
+made to tell a missing record (404) from a forbidden one (403), or from a
+record that no longer matches the ``expected`` state (409) when the write
+is conditional (optimistic concurrency).
+"""
+from typing import Iterable, Optional
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+FORBIDDEN = "Non hai accesso a questo ambulatorio"
+
+
+def owned(record_id: str, ambulatori: Iterable[str]) -> dict:
+    return {"id": record_id, "ambulatorio": {"$in": list(ambulatori)}}
+
+
+async def raise_miss(collection, record_id: str, ambulatori: Iterable[str], not_found: str,
+                     conflict: Optional[str] = None):
+    """Raise the right error for a filter of ``owned`` that matched nothing."""
+    doc = await collection.find_one({"id": record_id}, {"_id": 0, "ambulatorio": 1})
+    if doc is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    if conflict and doc.get("ambulatorio") in ambulatori:
+        raise HTTPException(status_code=409, detail=conflict)
+    raise HTTPException(status_code=403, detail=FORBIDDEN)
+
+
+async def update_owned(collection, record_id: str, ambulatori: Iterable[str], update: dict,
+                       not_found: str, projection: Optional[dict] = None,
+                       return_document: bool = ReturnDocument.AFTER,
+                       expected: Optional[dict] = None, conflict: Optional[str] = None) -> dict:
+    """Apply ``update`` and return the record after it (or before it, with
+    ``return_document=ReturnDocument.BEFORE``).
+
+    With ``expected`` the update only applies while the record still matches
+    it; otherwise it fails with 409 and the ``conflict`` message.
+    """
+    query = owned(record_id, ambulatori)
+    if expected:
+        query["$and"] = [expected]
+    doc = await collection.find_one_and_update(
+        query, update,
+        projection=projection or {"_id": 0}, return_document=return_document
+    )
+    if doc is None:
+        await raise_miss(collection, record_id, ambulatori, not_found, conflict if expected else None)
+    return doc
+
+
+async def delete_owned(collection, record_id: str, ambulatori: Iterable[str], not_found: str,
+                       projection: Optional[dict] = None) -> dict:
+    """Delete the record and return it."""
+    doc = await collection.find_one_and_delete(
+        owned(record_id, ambulatori), projection=projection or {"_id": 0}
+    )
+    if doc is None:
+        await raise_miss(collection, record_id, ambulatori, not_found)
+    return doc
+
+
+async def find_owned(collection, record_id: str, ambulatori: Iterable[str], not_found: str,
+                     projection: Optional[dict] = None) -> dict:
+    doc = await collection.find_one(owned(record_id, ambulatori), projection or {"_id": 0})
+    if doc is None:
+        await raise_miss(collection, record_id, ambulatori, not_found)
+    return doc
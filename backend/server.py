@@ -1,8 +1,10 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request, BackgroundTasks, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse, FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import os
 import logging
 from pathlib import Path
@@ -11,31 +13,70 @@ from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone, date, timedelta
 import jwt
-import bcrypt
 from enum import Enum
 import base64
+import asyncio
+import time
+import re
+import hmac
+import tempfile
+
+from photo_store import GridFSBlobStore, BlobNotFound, iter_upload
+from thumbnails import THUMBNAIL_SIZES, THUMBNAIL_CONTENT_TYPE, generate_thumbnails
+import stats_rollup
+import stats_pipeline
+from db_indexes import ensure_indexes, verify_query_plans
+import slots
+import patient_search
+import timeline
+import events
+import sync
+import credentials
+from auth_context import Principal, TokenVerifier
+import metrics
+import profiling
+from compression import CompressionMiddleware
+from repository import owned, raise_miss, update_owned, delete_owned, find_owned
+from pagination import fetch_page, field_projection, ndjson_lines, NDJSON_MEDIA_TYPE, NEXT_CURSOR_HEADER
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[metrics.CommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
+# Photo binaries (GridFS, chunked)
+photo_store = GridFSBlobStore(db)
+
+# Live appointment and patient changes (/api/events)
+event_bus = events.EventBus()
+
 # JWT Settings
 JWT_SECRET = os.environ.get('JWT_SECRET', 'ambulatorio-infermieristico-secret-key-2024')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
 security = HTTPBearer()
+# EventSource cannot send headers: /api/events also takes the token as a query parameter
+optional_security = HTTPBearer(auto_error=False)
 
 # Create the main app
-app = FastAPI(title="Ambulatorio Infermieristico API")
+app = FastAPI(title="Ambulatorio Infermieristico API", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+def trusted(content, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    """Serialize documents straight to JSON, skipping response_model validation.
+
+    Only for data we wrote ourselves through the models and read back with an
+    explicit projection (no _id, no internal fields); response_model still
+    documents the shape in OpenAPI.
+    """
+    return ORJSONResponse(content, status_code=status_code, headers=headers)
+
 # ============== ENUMS ==============
 class PatientType(str, Enum):
     PICC = "PICC"
@@ -69,8 +110,12 @@ class UserResponse(BaseModel):
 class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    refresh_token: str
     user: UserResponse
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class PatientCreate(BaseModel):
     nome: str
     cognome: str
@@ -159,7 +204,23 @@ class Appointment(BaseModel):
     prestazioni: List[str]
     note: Optional[str] = None
     completed: bool = False
+    serie_id: Optional[str] = None  # set for appointments booked as a recurring series
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+
+SERIES_MAX_OCCURRENCES = 104
+
+class AppointmentSeriesCreate(BaseModel):
+    patient_id: str
+    ambulatorio: Ambulatorio
+    ora: str   # HH:MM
+    tipo: str  # PICC or MED
+    prestazioni: List[str]
+    note: Optional[str] = None
+    data_inizio: str  # YYYY-MM-DD, first occurrence
+    ogni_giorni: int = Field(7, ge=1, le=365)  # 7 = weekly
+    fino_al: Optional[str] = None  # YYYY-MM-DD, last possible occurrence
+    occorrenze: Optional[int] = Field(None, ge=1, le=SERIES_MAX_OCCURRENCES)
 
 # Scheda Medicazione MED
 class SchedaMedicazioneMEDCreate(BaseModel):
@@ -192,6 +253,7 @@ class SchedaMedicazioneMED(BaseModel):
     firma: Optional[str] = None
     foto_ids: List[str] = []
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Scheda Impianto PICC
 class SchedaImpiantoPICCCreate(BaseModel):
@@ -242,6 +304,7 @@ class SchedaImpiantoPICC(BaseModel):
     note: Optional[str] = None
     allegati: List[str] = []
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Scheda Gestione Mensile PICC
 class SchedaGestionePICCCreate(BaseModel):
@@ -259,9 +322,20 @@ class SchedaGestionePICC(BaseModel):
     mese: str
     giorni: Dict[str, Dict[str, Any]] = {}
     note: Optional[str] = None
+    version: int = 0  # incremented by every write, for optimistic concurrency
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
+class GiornoGestionePICCPatch(BaseModel):
+    version: int  # version of the scheda the client has seen
+    campi: Dict[str, Any]  # {lavaggio_mani: "X", ...}; null removes the field
+
+class GiornoGestionePICC(BaseModel):
+    id: str
+    giorno: str
+    valori: Dict[str, Any]
+    version: int
+
 # Photo
 class PhotoCreate(BaseModel):
     patient_id: str
@@ -278,8 +352,12 @@ class Photo(BaseModel):
     tipo: str
     descrizione: Optional[str] = None
     data: str
-    image_data: str  # Base64
+    blob_id: str  # Reference into photo_store
+    content_type: str = "image/jpeg"
+    size: int = 0
+    sha256: Optional[str] = None
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Document Templates
 class DocumentTemplate(BaseModel):
@@ -298,6 +376,7 @@ class StatisticsQuery(BaseModel):
     mese: Optional[int] = None
 
 # ============== USERS DATA ==============
+# Initial accounts, seeded into the users collection (bcrypt) at startup
 USERS = {
     "Domenico": {
         "password": "infermiere",
@@ -370,45 +449,118 @@ def get_holidays(year: int) -> List[str]:
         holidays.append(pasquetta.strftime("%Y-%m-%d"))
     return holidays
 
+def build_time_slots(start: str, end: str) -> List[str]:
+    """30-minute slot start times from start (included) to end (excluded)"""
+    times = []
+    current = datetime.strptime(start, "%H:%M")
+    end_time = datetime.strptime(end, "%H:%M")
+    while current < end_time:
+        times.append(current.strftime("%H:%M"))
+        current += timedelta(minutes=30)
+    return times
+
+# The slot grid and the holidays never change, so they are built once at import
+MORNING_SLOTS = build_time_slots("08:30", "13:00")
+AFTERNOON_SLOTS = build_time_slots("15:00", "17:00")
+TIME_SLOTS = MORNING_SLOTS + AFTERNOON_SLOTS
+AGENDA_YEARS = range(2026, 2031)
+HOLIDAYS = {year: frozenset(get_holidays(year)) for year in AGENDA_YEARS}
+
+def closed_reason(day: date) -> Optional[str]:
+    """Why the ambulatori are closed on day, or None if open"""
+    if day.weekday() >= 5:
+        return "weekend"
+    if day.year not in HOLIDAYS:
+        HOLIDAYS[day.year] = frozenset(get_holidays(day.year))
+    if day.isoformat() in HOLIDAYS[day.year]:
+        return "festivo"
+    return None
+
+def slot_tipi(ambulatorio: Ambulatorio, tipo: Optional[str]) -> List[str]:
+    """Agenda sections of an ambulatorio; Villa Ginestre only has PICC"""
+    if ambulatorio == Ambulatorio.VILLA_GINESTRE:
+        if tipo and tipo != "PICC":
+            raise HTTPException(status_code=400, detail="Villa delle Ginestre gestisce solo pazienti PICC")
+        return ["PICC"]
+    return [tipo] if tipo else ["PICC", "MED"]
+
+def parse_date(value: str, name: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data non valida per {name}: {value}")
+
 # ============== AUTH HELPERS ==============
 def create_token(username: str, ambulatori: List[str]) -> str:
     payload = {
         "sub": username,
         "ambulatori": ambulatori,
+        "jti": TokenVerifier.new_jti(),
+        # Fractional, so that a login right after a revocation of the user is not revoked too
+        "iat": time.time(),
         "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token scaduto")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Token non valido")
+def decode_token(token: str) -> dict:
+    return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+
+# Decoded tokens are cached until they expire; revocations are checked on every request
+token_verifier = TokenVerifier(decode_token, timedelta(hours=JWT_EXPIRATION_HOURS))
+
+# async, so that it runs on the event loop instead of a threadpool worker
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Principal:
+    return token_verifier.verify(credentials.credentials)
 
 # ============== AUTH ROUTES ==============
-@api_router.post("/auth/login", response_model=TokenResponse)
-async def login(data: UserLogin):
-    user = USERS.get(data.username)
-    if not user or user["password"] != data.password:
-        raise HTTPException(status_code=401, detail="Credenziali non valide")
-    
-    token = create_token(data.username, user["ambulatori"])
+def token_response(user: dict, refresh_token: str) -> TokenResponse:
     return TokenResponse(
-        access_token=token,
+        access_token=create_token(user["username"], user["ambulatori"]),
+        refresh_token=refresh_token,
         user=UserResponse(
-            id=data.username.lower().replace(".", "_"),
-            username=data.username,
+            id=user["username"].lower().replace(".", "_"),
+            username=user["username"],
             ambulatori=user["ambulatori"]
         )
     )
 
+@api_router.post("/auth/login", response_model=TokenResponse)
+async def login(data: UserLogin):
+    user = await credentials.authenticate(db, data.username, data.password)
+    if not user:
+        raise HTTPException(status_code=401, detail="Credenziali non valide")
+    return token_response(user, await credentials.issue_refresh_token(db, user["username"]))
+
+@api_router.post("/auth/refresh", response_model=TokenResponse)
+async def refresh_session(data: RefreshRequest):
+    """New access token (and refresh token) without the password"""
+    renewed = await credentials.rotate_refresh_token(db, data.refresh_token)
+    if not renewed:
+        raise HTTPException(status_code=401, detail="Sessione scaduta, effettua di nuovo il login")
+    user, refresh_token = renewed
+    return token_response(user, refresh_token)
+
+@api_router.post("/auth/logout")
+async def logout(data: RefreshRequest, bearer: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    await credentials.revoke_refresh_token(db, data.refresh_token)
+    if bearer:
+        try:
+            await token_verifier.revoke_token(db, token_verifier.verify(bearer.credentials))
+        except HTTPException:
+            pass  # already expired or revoked
+    return {"message": "Logout effettuato"}
+
+@api_router.post("/auth/logout-all")
+async def logout_everywhere(payload: Principal = Depends(verify_token)):
+    """End every session of the user, e.g. after losing a tablet"""
+    await token_verifier.revoke_user(db, payload.username)
+    await credentials.revoke_refresh_tokens(db, payload.username)
+    return {"message": "Tutte le sessioni sono state chiuse"}
+
 @api_router.get("/auth/me", response_model=UserResponse)
-async def get_current_user(payload: dict = Depends(verify_token)):
-    username = payload["sub"]
-    user = USERS.get(username)
+async def get_current_user(payload: Principal = Depends(verify_token)):
+    username = payload.username
+    user = await db.users.find_one({"username": username}, {"_id": 0, "ambulatori": 1})
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
     return UserResponse(
@@ -419,19 +571,48 @@ async def get_current_user(payload: dict = Depends(verify_token)):
 
 # ============== PATIENTS ROUTES ==============
 @api_router.post("/patients", response_model=Patient, status_code=201)
-async def create_patient(data: PatientCreate, payload: dict = Depends(verify_token)):
+async def create_patient(data: PatientCreate, payload: Principal = Depends(verify_token)):
     # Check ambulatorio access
-    if data.ambulatorio.value not in payload["ambulatori"]:
+    if data.ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     # Villa Ginestre only allows PICC
     if data.ambulatorio == Ambulatorio.VILLA_GINESTRE and data.tipo != PatientType.PICC:
         raise HTTPException(status_code=400, detail="Villa delle Ginestre gestisce solo pazienti PICC")
     
-    patient = Patient(**data.model_dump())
-    doc = patient.model_dump()
-    await db.patients.insert_one(doc)
-    return patient
+    patient = Patient(**data.model_dump()).model_dump()
+    await db.patients.insert_one({**patient, **patient_search.search_fields(patient)})
+    event_bus.notify("patients", "insert", patient)
+    return trusted(patient, status_code=201)
+
+# Keyset pagination orders; "id" makes every sort key unique
+PATIENTS_SORT = [("cognome", 1), ("id", 1)]
+APPOINTMENTS_SORT = [("data", 1), ("ora", 1), ("id", 1)]
+PAGE_LIMIT = 1000
+
+# Patient documents without the internal search fields
+PATIENT_PROJECTION = {"_id": 0, **{field: 0 for field in patient_search.INTERNAL_FIELDS}}
+
+def fields_projection(fields: Optional[str], model, always: List[str], default: Optional[dict] = None) -> dict:
+    """Projection for the fields= parameter of the list routes"""
+    try:
+        return field_projection(fields, model.model_fields, always, default or {"_id": 0})
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=f"Campi non validi: {exc}")
+
+async def paginated(collection, query: dict, projection: dict, sort: list,
+                    limit: int, cursor: Optional[str], format: Optional[str]):
+    """A page of results with X-Next-Cursor, or the whole result as NDJSON"""
+    if format == "ndjson":
+        return StreamingResponse(
+            ndjson_lines(collection.find(query, projection).sort(sort)),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+    try:
+        docs, next_cursor = await fetch_page(collection, query, projection, sort, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor non valido")
+    return trusted(docs, headers={NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None)
 
 @api_router.get("/patients", response_model=List[Patient])
 async def get_patients(
@@ -439,89 +620,174 @@ async def get_patients(
     status: Optional[PatientStatus] = None,
     tipo: Optional[PatientType] = None,
     search: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    fields: Optional[str] = None,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    format: Optional[str] = Query(None, pattern="^ndjson$"),
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    """Patients by cognome; follow X-Next-Cursor for the next page, or use format=ndjson to stream them all.
+    With search, the best matches by name prefix or codice fiscale (at most 50, no cursor).
+    fields=nome,cognome,... returns only those columns (plus id and the keys used for sorting)."""
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
+    # Search ranking also reads nome and codice fiscale
+    always = ["id", "cognome"] + (["nome", "codice_fiscale"] if search else [])
+    projection = fields_projection(fields, Patient, always, PATIENT_PROJECTION)
     query = {"ambulatorio": ambulatorio.value}
     if status:
         query["status"] = status.value
     if tipo:
         query["tipo"] = tipo.value
     if search:
-        query["$or"] = [
-            {"nome": {"$regex": search, "$options": "i"}},
-            {"cognome": {"$regex": search, "$options": "i"}}
-        ]
+        search_query = patient_search.build_query(search)
+        if search_query is None:
+            return []
+        query.update(search_query)
+        if format != "ndjson":
+            matches = await db.patients.find(query, projection).limit(
+                patient_search.SEARCH_CANDIDATES
+            ).to_list(patient_search.SEARCH_CANDIDATES)
+            return trusted(patient_search.rank(matches, search)[:min(limit, patient_search.SEARCH_LIMIT)])
     
-    patients = await db.patients.find(query, {"_id": 0}).sort("cognome", 1).to_list(1000)
-    return patients
+    return await paginated(db.patients, query, projection, PATIENTS_SORT, limit, cursor, format)
 
 @api_router.get("/patients/{patient_id}", response_model=Patient)
-async def get_patient(patient_id: str, payload: dict = Depends(verify_token)):
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+async def get_patient(patient_id: str, payload: Principal = Depends(verify_token)):
+    patient = await db.patients.find_one({"id": patient_id}, PATIENT_PROJECTION)
     if not patient:
         raise HTTPException(status_code=404, detail="Paziente non trovato")
-    if patient["ambulatorio"] not in payload["ambulatori"]:
+    if patient["ambulatorio"] not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    return patient
+    return trusted(patient)
 
 @api_router.put("/patients/{patient_id}", response_model=Patient)
-async def update_patient(patient_id: str, data: PatientUpdate, payload: dict = Depends(verify_token)):
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-    if not patient:
-        raise HTTPException(status_code=404, detail="Paziente non trovato")
-    if patient["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
+async def update_patient(patient_id: str, data: PatientUpdate, payload: Principal = Depends(verify_token)):
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update_data.update(patient_search.search_updates(update_data))
     
-    await db.patients.update_one({"id": patient_id}, {"$set": update_data})
-    updated = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-    return updated
+    updated = await update_owned(db.patients, patient_id, payload.ambulatori, {"$set": update_data},
+                                 "Paziente non trovato", projection=PATIENT_PROJECTION)
+    # Only one of nome/cognome changed: the search keys need the other one too
+    if patient_search.needs_reindex(update_data):
+        await db.patients.update_one({"id": patient_id}, {"$set": patient_search.search_fields(updated)})
+    event_bus.notify("patients", "update", updated)
+    return trusted(updated)
 
 @api_router.delete("/patients/{patient_id}")
-async def delete_patient(patient_id: str, payload: dict = Depends(verify_token)):
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-    if not patient:
-        raise HTTPException(status_code=404, detail="Paziente non trovato")
-    if patient["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.patients.delete_one({"id": patient_id})
+async def delete_patient(patient_id: str, payload: Principal = Depends(verify_token)):
+    patient = await delete_owned(db.patients, patient_id, payload.ambulatori, "Paziente non trovato",
+                                 projection={"_id": 0, "id": 1, "ambulatorio": 1})
+    await sync.record_deletion(db, "patients", patient)
+    event_bus.notify("patients", "delete", patient)
     return {"message": "Paziente eliminato"}
 
 # ============== APPOINTMENTS ROUTES ==============
 @api_router.post("/appointments", response_model=Appointment)
-async def create_appointment(data: AppointmentCreate, payload: dict = Depends(verify_token)):
-    if data.ambulatorio.value not in payload["ambulatori"]:
+async def create_appointment(data: AppointmentCreate, payload: Principal = Depends(verify_token)):
+    if data.ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Get patient info
-    patient = await db.patients.find_one({"id": data.patient_id}, {"_id": 0})
+    # Patient lookup and slot reservation (max 2 per type per slot) in parallel
+    slot = slots.slot_id(data.ambulatorio, data.data, data.ora, data.tipo)
+    patient, reserved = await asyncio.gather(
+        db.patients.find_one({"id": data.patient_id}, {"_id": 0, "nome": 1, "cognome": 1}),
+        slots.reserve(db, slot)
+    )
     if not patient:
+        if reserved:
+            await slots.release(db, slot)
         raise HTTPException(status_code=404, detail="Paziente non trovato")
-    
-    # Check slot availability (max 2 per type per slot)
-    existing = await db.appointments.count_documents({
-        "ambulatorio": data.ambulatorio.value,
-        "data": data.data,
-        "ora": data.ora,
-        "tipo": data.tipo
-    })
-    if existing >= 2:
+    if not reserved:
         raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
     
     appointment = Appointment(
         **data.model_dump(),
         patient_nome=patient["nome"],
         patient_cognome=patient["cognome"]
+    ).model_dump()
+    try:
+        await db.appointments.insert_one(dict(appointment))
+    except Exception:
+        await slots.release(db, slot)
+        raise
+    await stats_rollup.record_appointment(db, appointment)
+    event_bus.notify("appointments", "insert", appointment)
+    return trusted(appointment)
+
+def series_dates(start: date, every: int, until: Optional[date], count: Optional[int]) -> List[date]:
+    """Occurrences from start every N days, up to until and/or count occurrences"""
+    limit = min(count or SERIES_MAX_OCCURRENCES, SERIES_MAX_OCCURRENCES)
+    days = []
+    day = start
+    while len(days) < limit and (until is None or day <= until):
+        days.append(day)
+        day += timedelta(days=every)
+    return days
+
+@api_router.post("/appointments/series")
+async def create_appointment_series(data: AppointmentSeriesCreate, payload: Principal = Depends(verify_token)):
+    """Book a recurring series; returns the booked appointments and, per
+    occurrence that could not be booked, the reason (weekend, festivo, slot_pieno)"""
+    if data.ambulatorio.value not in payload.ambulatori:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    slot_tipi(data.ambulatorio, data.tipo)
+    if not data.fino_al and not data.occorrenze:
+        raise HTTPException(status_code=400, detail="Indica fino_al oppure occorrenze")
+    
+    start = parse_date(data.data_inizio, "data_inizio")
+    until = parse_date(data.fino_al, "fino_al") if data.fino_al else None
+    conflitti = []
+    open_days = []
+    for day in series_dates(start, data.ogni_giorni, until, data.occorrenze):
+        reason = closed_reason(day)
+        if reason:
+            conflitti.append({"data": day.isoformat(), "motivo": reason})
+        else:
+            open_days.append(day.isoformat())
+    
+    # Patient lookup and one bulk reservation of every occurrence, in parallel
+    keys = [slots.slot_id(data.ambulatorio, day, data.ora, data.tipo) for day in open_days]
+    patient, reserved = await asyncio.gather(
+        db.patients.find_one({"id": data.patient_id}, {"_id": 0, "nome": 1, "cognome": 1}),
+        slots.reserve_many(db, keys)
     )
-    doc = appointment.model_dump()
-    await db.appointments.insert_one(doc)
-    return appointment
+    taken = [key for key, ok in zip(keys, reserved) if ok]
+    if not patient:
+        await slots.release_many(db, taken)
+        raise HTTPException(status_code=404, detail="Paziente non trovato")
+    
+    serie_id = str(uuid.uuid4())
+    fields = data.model_dump(include={"patient_id", "ambulatorio", "ora", "tipo", "prestazioni", "note"})
+    appointments = []
+    for day, ok in zip(open_days, reserved):
+        if not ok:
+            conflitti.append({"data": day, "motivo": "slot_pieno"})
+            continue
+        appointments.append(Appointment(
+            **fields,
+            data=day,
+            serie_id=serie_id,
+            patient_nome=patient["nome"],
+            patient_cognome=patient["cognome"]
+        ).model_dump())
+    
+    if appointments:
+        try:
+            await db.appointments.insert_many([dict(appointment) for appointment in appointments])
+        except Exception:
+            await slots.release_many(db, taken)
+            raise
+        await stats_rollup.record_appointments(db, appointments)
+        for appointment in appointments:
+            event_bus.notify("appointments", "insert", appointment)
+    return trusted({
+        "serie_id": serie_id,
+        "appuntamenti": appointments,
+        "conflitti": sorted(conflitti, key=lambda c: c["data"])
+    })
 
 @api_router.get("/appointments", response_model=List[Appointment])
 async def get_appointments(
@@ -530,9 +796,15 @@ async def get_appointments(
     data_from: Optional[str] = None,
     data_to: Optional[str] = None,
     tipo: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    fields: Optional[str] = None,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    format: Optional[str] = Query(None, pattern="^ndjson$"),
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    """Appointments by data and ora; follow X-Next-Cursor for the next page, or use format=ndjson to stream them all.
+    fields=ora,patient_cognome,... returns only those columns (plus id, data and ora)."""
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     query = {"ambulatorio": ambulatorio.value}
@@ -543,121 +815,147 @@ async def get_appointments(
     if tipo:
         query["tipo"] = tipo
     
-    appointments = await db.appointments.find(query, {"_id": 0}).sort([("data", 1), ("ora", 1)]).to_list(1000)
-    return appointments
+    projection = fields_projection(fields, Appointment, ["id", "data", "ora"])
+    return await paginated(db.appointments, query, projection, APPOINTMENTS_SORT, limit, cursor, format)
 
 @api_router.put("/appointments/{appointment_id}", response_model=Appointment)
-async def update_appointment(appointment_id: str, data: dict, payload: dict = Depends(verify_token)):
-    appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    if not appointment:
-        raise HTTPException(status_code=404, detail="Appuntamento non trovato")
-    if appointment["ambulatorio"] not in payload["ambulatori"]:
+async def update_appointment(appointment_id: str, data: dict, payload: Principal = Depends(verify_token)):
+    if "ambulatorio" in data and data["ambulatorio"] not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    
+    if not slots.SLOT_FIELDS.intersection(data):
+        # Same slot: one round trip, the updated document is merged locally
+        appointment = await update_owned(db.appointments, appointment_id, payload.ambulatori, {"$set": data},
+                                         "Appuntamento non trovato", return_document=ReturnDocument.BEFORE)
+        updated = {**appointment, **data}
+        await stats_rollup.record_appointment_change(db, appointment, updated)
+        event_bus.notify("appointments", "update", updated)
+        return trusted(updated)
     
-    await db.appointments.update_one({"id": appointment_id}, {"$set": data})
-    updated = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    return updated
+    # Moving to another slot takes a place there before giving up the old one,
+    # so the current slot has to be read first
+    appointment = await find_owned(db.appointments, appointment_id, payload.ambulatori, "Appuntamento non trovato")
+    old_slot = slots.slot_id_for(appointment)
+    new_slot = slots.slot_id_for({**appointment, **data})
+    moved = new_slot != old_slot
+    if moved and not await slots.reserve(db, new_slot):
+        raise HTTPException(status_code=400, detail="Slot pieno (max 2 pazienti)")
+    
+    try:
+        # Matching the slot that was read guards against a concurrent move
+        updated = await update_owned(db.appointments, appointment_id, payload.ambulatori, {"$set": data},
+                                     "Appuntamento non trovato",
+                                     expected={field: appointment[field] for field in slots.SLOT_FIELDS},
+                                     conflict="Appuntamento modificato da un altro utente, riprova")
+    except Exception:
+        if moved:
+            await slots.release(db, new_slot)
+        raise
+    if moved:
+        await slots.release(db, old_slot)
+    await stats_rollup.record_appointment_change(db, appointment, updated)
+    event_bus.notify("appointments", "update", updated, before=appointment)
+    return trusted(updated)
 
 @api_router.delete("/appointments/{appointment_id}")
-async def delete_appointment(appointment_id: str, payload: dict = Depends(verify_token)):
-    appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
-    if not appointment:
-        raise HTTPException(status_code=404, detail="Appuntamento non trovato")
-    if appointment["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.appointments.delete_one({"id": appointment_id})
+async def delete_appointment(appointment_id: str, payload: Principal = Depends(verify_token)):
+    appointment = await delete_owned(db.appointments, appointment_id, payload.ambulatori,
+                                     "Appuntamento non trovato")
+    await slots.release(db, slots.slot_id_for(appointment))
+    await stats_rollup.record_appointment(db, appointment, sign=-1)
+    await sync.record_deletion(db, "appointments", appointment)
+    event_bus.notify("appointments", "delete", appointment)
     return {"message": "Appuntamento eliminato"}
 
 # ============== SCHEDE MEDICAZIONE MED ==============
+# Identity and counters of a scheda are not set by the client
+SCHEDA_READONLY_FIELDS = ("_id", "id", "patient_id", "version")
+
+def scheda_update(data: dict, payload: Principal) -> dict:
+    """The $set of a scheda PUT: no identity fields, ambulatorio only among the user's"""
+    if "ambulatorio" in data and data["ambulatorio"] not in payload.ambulatori:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    changes = {key: value for key, value in data.items() if key not in SCHEDA_READONLY_FIELDS}
+    changes["updated_at"] = datetime.now(timezone.utc).isoformat()
+    return changes
+
 @api_router.post("/schede-medicazione-med", response_model=SchedaMedicazioneMED)
-async def create_scheda_medicazione_med(data: SchedaMedicazioneMEDCreate, payload: dict = Depends(verify_token)):
-    if data.ambulatorio.value not in payload["ambulatori"]:
+async def create_scheda_medicazione_med(data: SchedaMedicazioneMEDCreate, payload: Principal = Depends(verify_token)):
+    if data.ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    scheda = SchedaMedicazioneMED(**data.model_dump())
-    doc = scheda.model_dump()
-    await db.schede_medicazione_med.insert_one(doc)
-    return scheda
+    scheda = SchedaMedicazioneMED(**data.model_dump()).model_dump()
+    await db.schede_medicazione_med.insert_one(dict(scheda))
+    return trusted(scheda)
 
 @api_router.get("/schede-medicazione-med", response_model=List[SchedaMedicazioneMED])
 async def get_schede_medicazione_med(
     patient_id: str,
     ambulatorio: Ambulatorio,
-    payload: dict = Depends(verify_token)
+    fields: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     schede = await db.schede_medicazione_med.find(
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
+        fields_projection(fields, SchedaMedicazioneMED, ["id", "data_compilazione"])
     ).sort("data_compilazione", -1).to_list(1000)
-    return schede
+    return trusted(schede)
 
 @api_router.get("/schede-medicazione-med/{scheda_id}", response_model=SchedaMedicazioneMED)
-async def get_scheda_medicazione_med(scheda_id: str, payload: dict = Depends(verify_token)):
+async def get_scheda_medicazione_med(scheda_id: str, payload: Principal = Depends(verify_token)):
     scheda = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
     if not scheda:
         raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
+    if scheda["ambulatorio"] not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    return scheda
+    return trusted(scheda)
 
 @api_router.put("/schede-medicazione-med/{scheda_id}", response_model=SchedaMedicazioneMED)
-async def update_scheda_medicazione_med(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_medicazione_med.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+async def update_scheda_medicazione_med(scheda_id: str, data: dict, payload: Principal = Depends(verify_token)):
+    updated = await update_owned(db.schede_medicazione_med, scheda_id, payload.ambulatori,
+                                 {"$set": scheda_update(data, payload)}, "Scheda non trovata")
+    return trusted(updated)
 
 # ============== SCHEDE IMPIANTO PICC ==============
 @api_router.post("/schede-impianto-picc", response_model=SchedaImpiantoPICC)
-async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: dict = Depends(verify_token)):
-    if data.ambulatorio.value not in payload["ambulatori"]:
+async def create_scheda_impianto_picc(data: SchedaImpiantoPICCCreate, payload: Principal = Depends(verify_token)):
+    if data.ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    scheda = SchedaImpiantoPICC(**data.model_dump())
-    doc = scheda.model_dump()
-    await db.schede_impianto_picc.insert_one(doc)
-    return scheda
+    scheda = SchedaImpiantoPICC(**data.model_dump()).model_dump()
+    await db.schede_impianto_picc.insert_one(dict(scheda))
+    return trusted(scheda)
 
 @api_router.get("/schede-impianto-picc", response_model=List[SchedaImpiantoPICC])
 async def get_schede_impianto_picc(
     patient_id: str,
     ambulatorio: Ambulatorio,
-    payload: dict = Depends(verify_token)
+    fields: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     schede = await db.schede_impianto_picc.find(
         {"patient_id": patient_id, "ambulatorio": ambulatorio.value},
-        {"_id": 0}
+        fields_projection(fields, SchedaImpiantoPICC, ["id", "data_impianto"])
     ).sort("data_impianto", -1).to_list(1000)
-    return schede
+    return trusted(schede)
 
 @api_router.put("/schede-impianto-picc/{scheda_id}", response_model=SchedaImpiantoPICC)
-async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+async def update_scheda_impianto_picc(scheda_id: str, data: dict, payload: Principal = Depends(verify_token)):
+    updated = await update_owned(db.schede_impianto_picc, scheda_id, payload.ambulatori,
+                                 {"$set": scheda_update(data, payload)}, "Scheda non trovata")
+    return trusted(updated)
 
 # ============== SCHEDE GESTIONE PICC (MENSILE) ==============
 @api_router.post("/schede-gestione-picc", response_model=SchedaGestionePICC)
-async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: dict = Depends(verify_token)):
-    if data.ambulatorio.value not in payload["ambulatori"]:
+async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: Principal = Depends(verify_token)):
+    if data.ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     # Check if already exists for this month
@@ -669,69 +967,162 @@ async def create_scheda_gestione_picc(data: SchedaGestionePICCCreate, payload: d
     if existing:
         raise HTTPException(status_code=400, detail="Esiste già una scheda per questo mese")
     
-    scheda = SchedaGestionePICC(**data.model_dump())
-    doc = scheda.model_dump()
-    await db.schede_gestione_picc.insert_one(doc)
-    return scheda
+    scheda = SchedaGestionePICC(**data.model_dump()).model_dump()
+    await db.schede_gestione_picc.insert_one(dict(scheda))
+    return trusted(scheda)
 
 @api_router.get("/schede-gestione-picc", response_model=List[SchedaGestionePICC])
 async def get_schede_gestione_picc(
     patient_id: str,
     ambulatorio: Ambulatorio,
     mese: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    fields: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     query = {"patient_id": patient_id, "ambulatorio": ambulatorio.value}
     if mese:
         query["mese"] = mese
     
-    schede = await db.schede_gestione_picc.find(query, {"_id": 0}).sort("mese", -1).to_list(100)
-    return schede
+    projection = fields_projection(fields, SchedaGestionePICC, ["id", "mese", "version"])
+    schede = await db.schede_gestione_picc.find(query, projection).sort("mese", -1).to_list(100)
+    return trusted(schede)
 
 @api_router.put("/schede-gestione-picc/{scheda_id}", response_model=SchedaGestionePICC)
-async def update_scheda_gestione_picc(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+async def update_scheda_gestione_picc(scheda_id: str, data: dict, payload: Principal = Depends(verify_token)):
+    updated = await update_owned(db.schede_gestione_picc, scheda_id, payload.ambulatori,
+                                 {"$set": scheda_update(data, payload), "$inc": {"version": 1}},
+                                 "Scheda non trovata")
+    return trusted(updated)
+
+# Day keys are dates (YYYY-MM-DD) or, in older schede, day numbers
+GIORNO_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2}|\d{1,2})$")
+SCHEDA_CONFLICT = "Scheda modificata da un altro utente, ricarica e riprova"
+
+def version_filter(version: int) -> dict:
+    # Schede created before versioning have no counter: they count as version 0
+    return {"version": {"$in": [0, None]}} if version == 0 else {"version": version}
+
+async def write_giorno(scheda_id: str, giorno: str, version: int, update: dict, payload: Principal) -> dict:
+    """Apply a dotted update to one day, returning only that day"""
+    if not GIORNO_PATTERN.match(giorno):
+        raise HTTPException(status_code=400, detail="Giorno non valido")
+    update.setdefault("$set", {})["updated_at"] = datetime.now(timezone.utc).isoformat()
+    update["$inc"] = {"version": 1}
+    scheda = await update_owned(
+        db.schede_gestione_picc, scheda_id, payload.ambulatori, update, "Scheda non trovata",
+        projection={"_id": 0, f"giorni.{giorno}": 1, "version": 1},
+        expected=version_filter(version), conflict=SCHEDA_CONFLICT
+    )
+    return {
+        "id": scheda_id,
+        "giorno": giorno,
+        "valori": scheda.get("giorni", {}).get(giorno, {}),
+        "version": scheda["version"]
+    }
+
+@api_router.patch("/schede-gestione-picc/{scheda_id}/giorni/{giorno}", response_model=GiornoGestionePICC)
+async def patch_giorno_gestione_picc(
+    scheda_id: str,
+    giorno: str,
+    data: GiornoGestionePICCPatch,
+    payload: Principal = Depends(verify_token)
+):
+    """Set or remove single fields of one day of the monthly sheet"""
+    if not data.campi:
+        raise HTTPException(status_code=400, detail="Nessun campo da aggiornare")
+    if any("." in campo or campo.startswith("$") for campo in data.campi):
+        raise HTTPException(status_code=400, detail="Nome campo non valido")
     
-    data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.schede_gestione_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
+    update = {}
+    for campo, valore in data.campi.items():
+        if valore is None:
+            update.setdefault("$unset", {})[f"giorni.{giorno}.{campo}"] = ""
+        else:
+            update.setdefault("$set", {})[f"giorni.{giorno}.{campo}"] = valore
+    return trusted(await write_giorno(scheda_id, giorno, data.version, update, payload))
+
+@api_router.delete("/schede-gestione-picc/{scheda_id}/giorni/{giorno}", response_model=GiornoGestionePICC)
+async def delete_giorno_gestione_picc(
+    scheda_id: str,
+    giorno: str,
+    version: int,
+    payload: Principal = Depends(verify_token)
+):
+    """Remove a whole day from the monthly sheet"""
+    return trusted(await write_giorno(scheda_id, giorno, version, {"$unset": {f"giorni.{giorno}": ""}}, payload))
 
 # ============== PHOTOS ==============
+PHOTO_METADATA_PROJECTION = {"_id": 0, "image_data": 0, "blob_id": 0, "thumbnails": 0}
+
+# Photo binaries never change once stored, so clients may keep them forever
+PHOTO_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def photo_with_urls(photo: dict) -> dict:
+    photo["url"] = f"/api/photos/{photo['id']}"
+    photo["thumbnail_url"] = f"/api/photos/{photo['id']}/thumbnail/grid"
+    photo["preview_url"] = f"/api/photos/{photo['id']}/thumbnail/preview"
+    return photo
+
+async def stream_blob(request: Request, blob_id: str, sha256: Optional[str], content_type: Optional[str]) -> Response:
+    etag = f'"{sha256}"' if sha256 else None
+    if etag and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": PHOTO_CACHE_CONTROL})
+    
+    try:
+        blob = await photo_store.open(blob_id)
+    except BlobNotFound:
+        raise HTTPException(status_code=404, detail="Foto non trovata")
+    
+    headers = {"Content-Length": str(blob.size)}
+    if etag:
+        headers["ETag"] = etag
+        headers["Cache-Control"] = PHOTO_CACHE_CONTROL
+    return StreamingResponse(blob.chunks, media_type=content_type or blob.content_type, headers=headers)
+
 @api_router.post("/photos")
 async def upload_photo(
+    background_tasks: BackgroundTasks,
     patient_id: str = Form(...),
     ambulatorio: str = Form(...),
     tipo: str = Form(...),
     data: str = Form(...),
     descrizione: Optional[str] = Form(None),
     file: UploadFile = File(...),
-    payload: dict = Depends(verify_token)
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio not in payload["ambulatori"]:
+    if ambulatorio not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    contents = await file.read()
-    image_data = base64.b64encode(contents).decode('utf-8')
+    content_type = file.content_type or ""
+    if not content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Formato file non supportato")
+    
+    photo_id = str(uuid.uuid4())
+    stored = await photo_store.save(iter_upload(file), photo_id, content_type)
     
     photo = Photo(
+        id=photo_id,
         patient_id=patient_id,
         ambulatorio=Ambulatorio(ambulatorio),
         tipo=tipo,
         descrizione=descrizione,
         data=data,
-        image_data=image_data
+        blob_id=stored.blob_id,
+        content_type=stored.content_type,
+        size=stored.size,
+        sha256=stored.sha256
     )
     doc = photo.model_dump()
-    await db.photos.insert_one(doc)
+    try:
+        await db.photos.insert_one(doc)
+    except Exception:
+        await photo_store.delete(stored.blob_id)
+        raise
     
+    background_tasks.add_task(generate_thumbnails, db, photo_store, photo.id)
     return {"id": photo.id, "message": "Foto caricata"}
 
 @api_router.get("/photos")
@@ -739,46 +1130,161 @@ async def get_photos(
     patient_id: str,
     ambulatorio: Ambulatorio,
     tipo: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     query = {"patient_id": patient_id, "ambulatorio": ambulatorio.value}
     if tipo:
         query["tipo"] = tipo
     
-    photos = await db.photos.find(query, {"_id": 0}).sort("data", -1).to_list(100)
-    return photos
+    photos = await db.photos.find(query, PHOTO_METADATA_PROJECTION).sort("data", -1).to_list(100)
+    return trusted([photo_with_urls(photo) for photo in photos])
 
 @api_router.get("/photos/{photo_id}")
-async def get_photo(photo_id: str, payload: dict = Depends(verify_token)):
-    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0})
+async def get_photo(photo_id: str, request: Request, payload: Principal = Depends(verify_token)):
+    """Streams the full-size photo with its original Content-Type"""
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0, "thumbnails": 0})
     if not photo:
         raise HTTPException(status_code=404, detail="Foto non trovata")
-    if photo["ambulatorio"] not in payload["ambulatori"]:
+    if photo["ambulatorio"] not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    return photo
+    
+    # Photos not yet moved out of the document by `manage.py migrate-photos`
+    if "blob_id" not in photo:
+        return Response(content=base64.b64decode(photo["image_data"]), media_type="image/jpeg")
+    
+    return await stream_blob(request, photo["blob_id"], photo.get("sha256"), photo.get("content_type"))
 
-@api_router.delete("/photos/{photo_id}")
-async def delete_photo(photo_id: str, payload: dict = Depends(verify_token)):
-    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0})
+@api_router.get("/photos/{photo_id}/thumbnail/{size}")
+async def get_photo_thumbnail(photo_id: str, size: str, request: Request, payload: Principal = Depends(verify_token)):
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=404, detail="Formato anteprima non valido")
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0, "image_data": 0})
     if not photo:
         raise HTTPException(status_code=404, detail="Foto non trovata")
-    if photo["ambulatorio"] not in payload["ambulatori"]:
+    if photo["ambulatorio"] not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    await db.photos.delete_one({"id": photo_id})
+    thumb = photo.get("thumbnails", {}).get(size)
+    if not thumb:
+        # Still rendering, or a legacy photo: fall back to the original, uncached
+        if "blob_id" not in photo:
+            return await get_photo(photo_id, request, payload)
+        response = await stream_blob(request, photo["blob_id"], None, photo.get("content_type"))
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    
+    return await stream_blob(request, thumb["blob_id"], thumb["sha256"], THUMBNAIL_CONTENT_TYPE)
+
+@api_router.delete("/photos/{photo_id}")
+async def delete_photo(photo_id: str, payload: Principal = Depends(verify_token)):
+    photo = await delete_owned(db.photos, photo_id, payload.ambulatori, "Foto non trovata",
+                               projection={"_id": 0, "id": 1, "ambulatorio": 1, "blob_id": 1, "thumbnails": 1})
+    await sync.record_deletion(db, "photos", photo)
+    if photo.get("blob_id"):
+        await photo_store.delete(photo["blob_id"])
+    for thumb in photo.get("thumbnails", {}).values():
+        await photo_store.delete(thumb["blob_id"])
     return {"message": "Foto eliminata"}
 
+# ============== PATIENT CHART ==============
+# Section -> (collection, projection, sort, max documents), as the single-section routes return them
+CHART_SECTIONS = {
+    "schede_medicazione_med": ("schede_medicazione_med", {"_id": 0}, [("data_compilazione", -1)], 1000),
+    "schede_impianto_picc": ("schede_impianto_picc", {"_id": 0}, [("data_impianto", -1)], 1000),
+    "schede_gestione_picc": ("schede_gestione_picc", {"_id": 0}, [("mese", -1)], 100),
+    "photos": ("photos", PHOTO_METADATA_PROJECTION, [("data", -1)], 100),
+    "appointments": ("appointments", {"_id": 0}, [("data", 1), ("ora", 1)], 1000),
+}
+
+@api_router.get("/patients/{patient_id}/chart")
+async def get_patient_chart(
+    patient_id: str,
+    include: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
+):
+    """The patient and all their records in one response.
+
+    include: comma-separated sections (default all of CHART_SECTIONS). Every
+    query is restricted to the user's ambulatori, so they all run at once
+    instead of waiting for the patient lookup.
+    """
+    sections = [section.strip() for section in include.split(",")] if include else list(CHART_SECTIONS)
+    unknown = [section for section in sections if section not in CHART_SECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Sezioni non valide: {', '.join(unknown)}")
+    
+    owned_by_patient = {"patient_id": patient_id, "ambulatorio": {"$in": list(payload.ambulatori)}}
+    queries = [
+        db[collection].find(owned_by_patient, projection).sort(sort).to_list(max_docs)
+        for collection, projection, sort, max_docs in (CHART_SECTIONS[section] for section in sections)
+    ]
+    patient, *results = await asyncio.gather(
+        db.patients.find_one(owned(patient_id, payload.ambulatori), PATIENT_PROJECTION),
+        *queries
+    )
+    if patient is None:
+        await raise_miss(db.patients, patient_id, payload.ambulatori, "Paziente non trovato")
+    
+    chart = {"patient": patient, **dict(zip(sections, results))}
+    if "photos" in chart:
+        chart["photos"] = [photo_with_urls(photo) for photo in chart["photos"]]
+    return trusted(chart)
+
+TIMELINE_SOURCES = {
+    "appuntamento": timeline.Source("appuntamento", "appointments", "data", "ora"),
+    "scheda_med": timeline.Source("scheda_med", "schede_medicazione_med", "data_compilazione"),
+    "impianto_picc": timeline.Source("impianto_picc", "schede_impianto_picc", "data_impianto"),
+    "gestione_picc": timeline.Source("gestione_picc", "schede_gestione_picc", "mese"),
+    "foto": timeline.Source("foto", "photos", "data", projection=PHOTO_METADATA_PROJECTION),
+}
+TIMELINE_LIMIT = 50
+
+@api_router.get("/patients/{patient_id}/timeline")
+async def get_patient_timeline(
+    patient_id: str,
+    tipi: Optional[str] = None,
+    limit: int = Query(TIMELINE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
+):
+    """Everything that happened to the patient, newest first: [{tipo, data, ora, id, record}].
+
+    tipi: comma-separated event types (default all of TIMELINE_SOURCES).
+    Follow X-Next-Cursor to scroll further back.
+    """
+    names = [name.strip() for name in tipi.split(",")] if tipi else list(TIMELINE_SOURCES)
+    unknown = [name for name in names if name not in TIMELINE_SOURCES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Tipi non validi: {', '.join(unknown)}")
+    
+    sources = [TIMELINE_SOURCES[name] for name in dict.fromkeys(names)]
+    owned_by_patient = {"patient_id": patient_id, "ambulatorio": {"$in": list(payload.ambulatori)}}
+    try:
+        patient, (events, next_cursor) = await asyncio.gather(
+            db.patients.find_one(owned(patient_id, payload.ambulatori), {"_id": 1}),
+            timeline.fetch_page(db, sources, owned_by_patient, limit, cursor)
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor non valido")
+    if patient is None:
+        await raise_miss(db.patients, patient_id, payload.ambulatori, "Paziente non trovato")
+    
+    for event in events:
+        if event["tipo"] == "foto":
+            photo_with_urls(event["record"])
+    return trusted(events, headers={NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None)
+
 # ============== DOCUMENTS ==============
 @api_router.get("/documents")
 async def get_documents(
     ambulatorio: Ambulatorio,
     categoria: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     docs = DOCUMENT_TEMPLATES.copy()
@@ -793,115 +1299,201 @@ async def get_documents(
     return docs
 
 # ============== STATISTICS ==============
+def period_bounds(anno: int, mese: Optional[int] = None) -> tuple:
+    """Half-open [start, end) date range for a year or a single month"""
+    if mese:
+        start_date = f"{anno}-{mese:02d}-01"
+        if mese == 12:
+            end_date = f"{anno + 1}-01-01"
+        else:
+            end_date = f"{anno}-{mese + 1:02d}-01"
+    else:
+        start_date = f"{anno}-01-01"
+        end_date = f"{anno + 1}-01-01"
+    return start_date, end_date
+
+async def compute_statistics(ambulatorio: Ambulatorio, tipo: Optional[str], start_date: str, end_date: str) -> dict:
+    """Statistics for appointments with start_date <= data < end_date"""
+    if not tipo and ambulatorio == Ambulatorio.VILLA_GINESTRE:
+        tipo = "PICC"
+    
+    # Whole days are served from the rollups once they have been built
+    if await stats_rollup.is_built(db):
+        days = await stats_rollup.load_days(db, ambulatorio.value, start_date, end_date, tipo)
+        return stats_rollup.summarise(days)
+    
+    match = {"ambulatorio": ambulatorio.value, "data": {"$gte": start_date, "$lt": end_date}}
+    if tipo:
+        match["tipo"] = tipo
+    return await stats_pipeline.appointment_statistics(db, match)
+
 @api_router.get("/statistics")
 async def get_statistics(
     ambulatorio: Ambulatorio,
-    anno: int,
+    anno: Optional[int] = None,
     mese: Optional[int] = None,
     tipo: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    data_from: Optional[str] = None,
+    data_to: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    """Statistics for a year/month, or for an ad-hoc data_from..data_to range (inclusive)"""
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
     # Villa Ginestre only shows PICC stats
     if ambulatorio == Ambulatorio.VILLA_GINESTRE and tipo == "MED":
         raise HTTPException(status_code=400, detail="Villa delle Ginestre non ha statistiche MED")
     
-    # Build date range
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
+    if data_from or data_to:
+        if not (data_from and data_to):
+            raise HTTPException(status_code=400, detail="Specificare sia data_from che data_to")
+        match = {"ambulatorio": ambulatorio.value, "data": {"$gte": data_from, "$lte": data_to}}
+        if tipo:
+            match["tipo"] = tipo
+        elif ambulatorio == Ambulatorio.VILLA_GINESTRE:
+            match["tipo"] = "PICC"
+        stats = await stats_pipeline.appointment_statistics(db, match)
+    elif anno:
+        start_date, end_date = period_bounds(anno, mese)
+        stats = await compute_statistics(ambulatorio, tipo, start_date, end_date)
     else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
-    
-    query = {
-        "ambulatorio": ambulatorio.value,
-        "data": {"$gte": start_date, "$lt": end_date}
-    }
-    if tipo:
-        query["tipo"] = tipo
-    elif ambulatorio == Ambulatorio.VILLA_GINESTRE:
-        query["tipo"] = "PICC"
-    
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(10000)
-    
-    # Calculate statistics
-    total_accessi = len(appointments)
-    unique_patients = len(set(a["patient_id"] for a in appointments))
-    
-    # Prestazioni count
-    prestazioni_count = {}
-    for app in appointments:
-        for prest in app.get("prestazioni", []):
-            prestazioni_count[prest] = prestazioni_count.get(prest, 0) + 1
-    
-    # Monthly breakdown
-    monthly_stats = {}
-    for app in appointments:
-        month = app["data"][:7]  # YYYY-MM
-        if month not in monthly_stats:
-            monthly_stats[month] = {"accessi": 0, "pazienti": set(), "prestazioni": {}}
-        monthly_stats[month]["accessi"] += 1
-        monthly_stats[month]["pazienti"].add(app["patient_id"])
-        for prest in app.get("prestazioni", []):
-            monthly_stats[month]["prestazioni"][prest] = monthly_stats[month]["prestazioni"].get(prest, 0) + 1
-    
-    # Convert sets to counts
-    for month in monthly_stats:
-        monthly_stats[month]["pazienti_unici"] = len(monthly_stats[month]["pazienti"])
-        del monthly_stats[month]["pazienti"]
+        raise HTTPException(status_code=400, detail="Specificare anno oppure data_from e data_to")
     
     return {
         "anno": anno,
         "mese": mese,
+        "data_from": data_from,
+        "data_to": data_to,
         "ambulatorio": ambulatorio.value,
         "tipo": tipo,
-        "totale_accessi": total_accessi,
-        "pazienti_unici": unique_patients,
-        "prestazioni": prestazioni_count,
-        "dettaglio_mensile": monthly_stats
+        **stats
+    }
+
+def parse_periodo(value: str) -> tuple:
+    """'2026', '2026-03' or a month range '2025-03..2026-02' -> (label, start, end)"""
+    def year_month(text: str) -> tuple:
+        anno, mese = int(text[:4]), int(text[5:7])
+        if len(text) != 7 or text[4] != "-" or not 1 <= mese <= 12:
+            raise ValueError(text)
+        return anno, mese
+    
+    try:
+        if ".." in value:
+            first, last = value.split("..", 1)
+            start_date, _ = period_bounds(*year_month(first))
+            _, end_date = period_bounds(*year_month(last))
+        elif "-" in value:
+            start_date, end_date = period_bounds(*year_month(value))
+        else:
+            start_date, end_date = period_bounds(int(value))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Periodo non valido: {value}")
+    if start_date >= end_date:
+        raise HTTPException(status_code=400, detail=f"Periodo non valido: {value}")
+    return value, start_date, end_date
+
+async def evaluate_periods(ambulatorio: Ambulatorio, tipo: Optional[str], periodi: List[tuple]) -> List[dict]:
+    """Statistics for several periods at once, concurrently.
+    
+    Overlapping periods are merged into one range that is read once, from
+    the rollups or with one aggregation, and summarised per period.
+    """
+    started = time.perf_counter()
+    if not tipo and ambulatorio == Ambulatorio.VILLA_GINESTRE:
+        tipo = "PICC"
+    rollups = await stats_rollup.is_built(db)
+    
+    # Group overlapping periods so each group is loaded with one query
+    groups = []
+    for index in sorted(range(len(periodi)), key=lambda i: periodi[i][1]):
+        _, start, end = periodi[index]
+        if groups and start < groups[-1]["end"]:
+            groups[-1]["end"] = max(groups[-1]["end"], end)
+            groups[-1]["periodi"].append(index)
+        else:
+            groups.append({"start": start, "end": end, "periodi": [index]})
+    
+    async def evaluate_group(group: dict) -> List[tuple]:
+        bounds = [periodi[index][1:] for index in group["periodi"]]
+        if rollups:
+            days = await stats_rollup.load_days(db, ambulatorio.value, group["start"], group["end"], tipo)
+            summaries = [stats_rollup.summarise(d for d in days if start <= d["data"] < end) for start, end in bounds]
+        else:
+            match = {"ambulatorio": ambulatorio.value}
+            if tipo:
+                match["tipo"] = tipo
+            summaries = await stats_pipeline.appointment_statistics_by_period(db, match, bounds)
+        elapsed = round((time.perf_counter() - started) * 1000, 2)
+        return [(index, {**stats, "tempo_ms": elapsed}) for index, stats in zip(group["periodi"], summaries)]
+    
+    results = [None] * len(periodi)
+    for group_results in await asyncio.gather(*(evaluate_group(g) for g in groups)):
+        for index, stats in group_results:
+            results[index] = stats
+    return results
+
+def statistics_diff(base: dict, other: dict) -> dict:
+    diff = {
+        "accessi": other["totale_accessi"] - base["totale_accessi"],
+        "pazienti_unici": other["pazienti_unici"] - base["pazienti_unici"],
+        "prestazioni": {}
     }
+    
+    all_prestazioni = set(base["prestazioni"].keys()) | set(other["prestazioni"].keys())
+    for prest in all_prestazioni:
+        diff["prestazioni"][prest] = other["prestazioni"].get(prest, 0) - base["prestazioni"].get(prest, 0)
+    return diff
 
 @api_router.get("/statistics/compare")
 async def compare_statistics(
     ambulatorio: Ambulatorio,
-    periodo1_anno: int,
+    periodo1_anno: Optional[int] = None,
     periodo1_mese: Optional[int] = None,
     periodo2_anno: int = None,
     periodo2_mese: Optional[int] = None,
+    periodi: Optional[str] = None,
     tipo: Optional[str] = None,
-    payload: dict = Depends(verify_token)
+    payload: Principal = Depends(verify_token)
 ):
-    if ambulatorio.value not in payload["ambulatori"]:
+    """Compare periodo1 with periodo2, or N periods given as
+    periodi=2025,2026-01,2025-03..2026-02 (differences are against the first)"""
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Get stats for both periods
-    stats1 = await get_statistics(ambulatorio, periodo1_anno, periodo1_mese, tipo, payload)
-    stats2 = await get_statistics(ambulatorio, periodo2_anno or periodo1_anno, periodo2_mese, tipo, payload)
+    if ambulatorio == Ambulatorio.VILLA_GINESTRE and tipo == "MED":
+        raise HTTPException(status_code=400, detail="Villa delle Ginestre non ha statistiche MED")
     
-    # Calculate differences
-    diff = {
-        "accessi": stats2["totale_accessi"] - stats1["totale_accessi"],
-        "pazienti_unici": stats2["pazienti_unici"] - stats1["pazienti_unici"],
-        "prestazioni": {}
-    }
+    if periodi:
+        requested = [parse_periodo(p.strip()) for p in periodi.split(",") if p.strip()]
+    elif periodo1_anno:
+        requested = []
+        for anno, mese in ((periodo1_anno, periodo1_mese), (periodo2_anno or periodo1_anno, periodo2_mese)):
+            label = f"{anno}-{mese:02d}" if mese else str(anno)
+            requested.append((label, *period_bounds(anno, mese)))
+    else:
+        raise HTTPException(status_code=400, detail="Specificare periodo1_anno oppure periodi")
+    if len(requested) < 2:
+        raise HTTPException(status_code=400, detail="Servono almeno due periodi da confrontare")
     
-    all_prestazioni = set(stats1["prestazioni"].keys()) | set(stats2["prestazioni"].keys())
-    for prest in all_prestazioni:
-        val1 = stats1["prestazioni"].get(prest, 0)
-        val2 = stats2["prestazioni"].get(prest, 0)
-        diff["prestazioni"][prest] = val2 - val1
+    started = time.perf_counter()
+    results = await evaluate_periods(ambulatorio, tipo, requested)
+    for (label, start_date, end_date), stats in zip(requested, results):
+        last_day = (date.fromisoformat(end_date) - timedelta(days=1)).isoformat()
+        stats.update({"periodo": label, "data_from": start_date, "data_to": last_day,
+                      "ambulatorio": ambulatorio.value, "tipo": tipo})
     
-    return {
-        "periodo1": stats1,
-        "periodo2": stats2,
-        "differenze": diff
+    response = {
+        "periodi": results,
+        "differenze": [statistics_diff(results[0], other) for other in results[1:]],
+        "tempo_totale_ms": round((time.perf_counter() - started) * 1000, 2)
     }
+    if not periodi:
+        # Two-period shape used by the dashboard
+        response["periodo1"] = {"anno": periodo1_anno, "mese": periodo1_mese, **results[0]}
+        response["periodo2"] = {"anno": periodo2_anno or periodo1_anno, "mese": periodo2_mese, **results[1]}
+        response["differenze"] = response["differenze"][0]
+    return response
 
 # ============== CALENDAR HELPERS ==============
 @api_router.get("/calendar/holidays")
@@ -911,123 +1503,182 @@ async def get_calendar_holidays(anno: int):
 @api_router.get("/calendar/slots")
 async def get_time_slots():
     """Returns available time slots"""
-    morning_slots = []
-    afternoon_slots = []
-    
-    # Morning: 08:30 - 13:00
-    current = datetime.strptime("08:30", "%H:%M")
-    end_morning = datetime.strptime("13:00", "%H:%M")
-    while current < end_morning:
-        morning_slots.append(current.strftime("%H:%M"))
-        current += timedelta(minutes=30)
+    return {
+        "mattina": MORNING_SLOTS,
+        "pomeriggio": AFTERNOON_SLOTS,
+        "tutti": TIME_SLOTS
+    }
+
+# Longest range served by /calendar/availability
+AVAILABILITY_MAX_DAYS = 92
+
+@api_router.get("/calendar/availability")
+async def get_availability(
+    ambulatorio: Ambulatorio,
+    data_from: str,
+    data_to: str,
+    tipo: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
+):
+    """Remaining capacity of every slot between data_from and data_to (inclusive)"""
+    if ambulatorio.value not in payload.ambulatori:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Afternoon: 15:00 - 17:00
-    current = datetime.strptime("15:00", "%H:%M")
-    end_afternoon = datetime.strptime("17:00", "%H:%M")
-    while current < end_afternoon:
-        afternoon_slots.append(current.strftime("%H:%M"))
-        current += timedelta(minutes=30)
+    start, end = parse_date(data_from, "data_from"), parse_date(data_to, "data_to")
+    if end < start or (end - start).days >= AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Intervallo non valido (max {AVAILABILITY_MAX_DAYS} giorni)")
+    tipi = slot_tipi(ambulatorio, tipo)
+    
+    # Only slots with at least one booking have a document
+    occupied = {}
+    async for slot in db.slots.find(
+        {"ambulatorio": ambulatorio.value, "data": {"$gte": data_from, "$lte": data_to},
+         "tipo": {"$in": tipi}, "count": {"$gt": 0}},
+        {"_id": 0, "data": 1, "ora": 1, "tipo": 1, "count": 1}
+    ):
+        occupied[(slot["data"], slot["ora"], slot["tipo"])] = slot["count"]
+    
+    giorni = []
+    day = start
+    while day <= end:
+        data = day.isoformat()
+        motivo = closed_reason(day)
+        giorni.append({
+            "data": data,
+            "chiuso": motivo is not None,
+            "motivo": motivo,
+            "slots": [] if motivo else [
+                {
+                    "ora": ora,
+                    "disponibili": {
+                        t: max(slots.SLOT_CAPACITY - occupied.get((data, ora, t), 0), 0) for t in tipi
+                    }
+                }
+                for ora in TIME_SLOTS
+            ]
+        })
+        day += timedelta(days=1)
     
     return {
-        "mattina": morning_slots,
-        "pomeriggio": afternoon_slots,
-        "tutti": morning_slots + afternoon_slots
+        "ambulatorio": ambulatorio.value,
+        "data_from": data_from,
+        "data_to": data_to,
+        "capacita": slots.SLOT_CAPACITY,
+        "giorni": giorni
+    }
+
+# How far ahead /calendar/next-available looks for free slots
+NEXT_AVAILABLE_MAX_DAYS = 92
+NEXT_AVAILABLE_MAX_COUNT = 50
+
+@api_router.get("/calendar/next-available")
+async def get_next_available(
+    ambulatorio: Optional[Ambulatorio] = None,
+    tipo: Optional[str] = None,
+    after: Optional[str] = None,
+    count: int = Query(5, ge=1, le=NEXT_AVAILABLE_MAX_COUNT),
+    payload: Principal = Depends(verify_token)
+):
+    """First count slots with a free place after the given day (YYYY-MM-DD) or
+    time (YYYY-MM-DDTHH:MM), in one ambulatorio or in all those of the user"""
+    if ambulatorio:
+        if ambulatorio.value not in payload.ambulatori:
+            raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+        targets = {ambulatorio.value: slot_tipi(ambulatorio, tipo)}
+    else:
+        # Villa Ginestre only has PICC: skipped when looking for another tipo
+        targets = {
+            amb.value: slot_tipi(amb, tipo) for amb in Ambulatorio
+            if amb.value in payload.ambulatori and not (amb == Ambulatorio.VILLA_GINESTRE and tipo and tipo != "PICC")
+        }
+    
+    start_date, _, after_ora = (after or date.today().isoformat()).partition("T")
+    start = parse_date(start_date, "after")
+    if after_ora and not re.fullmatch(r"\d{2}:\d{2}", after_ora):
+        raise HTTPException(status_code=400, detail=f"Orario non valido per after: {after_ora}")
+    end = start + timedelta(days=NEXT_AVAILABLE_MAX_DAYS - 1)
+    
+    # Occupancy of the whole horizon in one range read; only booked slots have a document
+    occupied = {}
+    if targets:
+        async for slot in db.slots.find(
+            {"$or": [{"ambulatorio": amb, "tipo": {"$in": tipi}} for amb, tipi in targets.items()],
+             "data": {"$gte": start.isoformat(), "$lte": end.isoformat()},
+             "count": {"$gt": 0}},
+            {"count": 1}
+        ):
+            occupied[slot["_id"]] = slot["count"]
+    
+    # Today's slots that have already started are not bookable any more
+    now = datetime.now()
+    today, now_ora = now.date().isoformat(), now.strftime("%H:%M")
+    
+    liberi = []
+    day = start
+    while targets and day <= end and len(liberi) < count:
+        if not closed_reason(day):
+            data = day.isoformat()
+            for ora in TIME_SLOTS:
+                if data == start_date and ora <= after_ora:
+                    continue
+                if data == today and ora <= now_ora:
+                    continue
+                for amb, tipi in targets.items():
+                    for t in tipi:
+                        disponibili = slots.SLOT_CAPACITY - occupied.get(slots.slot_id(amb, data, ora, t), 0)
+                        if disponibili > 0:
+                            liberi.append({"ambulatorio": amb, "data": data, "ora": ora, "tipo": t,
+                                           "disponibili": disponibili})
+        day += timedelta(days=1)
+    
+    return {
+        "after": after or start_date,
+        "capacita": slots.SLOT_CAPACITY,
+        "slots": liberi[:count]
     }
 
 # ============== DELETE ENDPOINTS ==============
 
 @api_router.delete("/schede-impianto-picc/{scheda_id}")
-async def delete_scheda_impianto(scheda_id: str, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_impianto_picc.delete_one({"id": scheda_id})
+async def delete_scheda_impianto(scheda_id: str, payload: Principal = Depends(verify_token)):
+    scheda = await delete_owned(db.schede_impianto_picc, scheda_id, payload.ambulatori, "Scheda non trovata",
+                                projection={"_id": 0, "id": 1, "ambulatorio": 1})
+    await sync.record_deletion(db, "schede_impianto_picc", scheda)
     return {"message": "Scheda impianto eliminata"}
 
 @api_router.delete("/schede-gestione-picc/{scheda_id}")
-async def delete_scheda_gestione(scheda_id: str, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_gestione_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_gestione_picc.delete_one({"id": scheda_id})
+async def delete_scheda_gestione(scheda_id: str, payload: Principal = Depends(verify_token)):
+    scheda = await delete_owned(db.schede_gestione_picc, scheda_id, payload.ambulatori, "Scheda non trovata",
+                                projection={"_id": 0, "id": 1, "ambulatorio": 1})
+    await sync.record_deletion(db, "schede_gestione_picc", scheda)
     return {"message": "Scheda gestione eliminata"}
 
 @api_router.delete("/schede-medicazione-med/{scheda_id}")
-async def delete_scheda_medicazione(scheda_id: str, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_medicazione_med.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    await db.schede_medicazione_med.delete_one({"id": scheda_id})
+async def delete_scheda_medicazione(scheda_id: str, payload: Principal = Depends(verify_token)):
+    scheda = await delete_owned(db.schede_medicazione_med, scheda_id, payload.ambulatori, "Scheda non trovata",
+                                projection={"_id": 0, "id": 1, "ambulatorio": 1})
+    await sync.record_deletion(db, "schede_medicazione_med", scheda)
     return {"message": "Scheda medicazione eliminata"}
 
-@api_router.put("/schede-impianto-picc/{scheda_id}")
-async def update_scheda_impianto(scheda_id: str, data: dict, payload: dict = Depends(verify_token)):
-    scheda = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    if not scheda:
-        raise HTTPException(status_code=404, detail="Scheda non trovata")
-    if scheda["ambulatorio"] not in payload["ambulatori"]:
-        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
-    
-    data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    await db.schede_impianto_picc.update_one({"id": scheda_id}, {"$set": data})
-    updated = await db.schede_impianto_picc.find_one({"id": scheda_id}, {"_id": 0})
-    return updated
-
 # ============== IMPLANT STATISTICS ==============
 @api_router.get("/statistics/implants")
 async def get_implant_statistics(
     ambulatorio: Ambulatorio,
     anno: int,
     mese: Optional[int] = None,
-    payload: dict = Depends(verify_token)
+    payload: Principal = Depends(verify_token)
 ):
     """Get statistics for implants (PICC, Port, Midline, etc.)"""
-    if ambulatorio.value not in payload["ambulatori"]:
+    if ambulatorio.value not in payload.ambulatori:
         raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
     
-    # Build date range query
-    if mese:
-        start_date = f"{anno}-{mese:02d}-01"
-        if mese == 12:
-            end_date = f"{anno + 1}-01-01"
-        else:
-            end_date = f"{anno}-{mese + 1:02d}-01"
-    else:
-        start_date = f"{anno}-01-01"
-        end_date = f"{anno + 1}-01-01"
+    start_date, end_date = period_bounds(anno, mese)
     
-    # Query implants
-    query = {
+    match = {
         "ambulatorio": ambulatorio.value,
         "data_impianto": {"$gte": start_date, "$lt": end_date}
     }
-    
-    schede = await db.schede_impianto_picc.find(query, {"_id": 0}).to_list(1000)
-    
-    # Count by type
-    tipo_counts = {}
-    monthly_breakdown = {}
-    
-    for scheda in schede:
-        tipo = scheda.get("tipo_catetere", "altro")
-        tipo_counts[tipo] = tipo_counts.get(tipo, 0) + 1
-        
-        # Monthly breakdown
-        data_impianto = scheda.get("data_impianto", "")
-        if data_impianto:
-            month_key = data_impianto[:7]  # "YYYY-MM"
-            if month_key not in monthly_breakdown:
-                monthly_breakdown[month_key] = {}
-            monthly_breakdown[month_key][tipo] = monthly_breakdown[month_key].get(tipo, 0) + 1
+    stats = await stats_pipeline.implant_statistics(db, match)
     
     # Labels for types
     tipo_labels = {
@@ -1040,12 +1691,109 @@ async def get_implant_statistics(
     }
     
     return {
-        "totale_impianti": len(schede),
-        "per_tipo": tipo_counts,
+        "totale_impianti": stats["totale_impianti"],
+        "per_tipo": stats["per_tipo"],
         "tipo_labels": tipo_labels,
-        "dettaglio_mensile": monthly_breakdown
+        "dettaglio_mensile": stats["dettaglio_mensile"]
     }
 
+# ============== DELTA SYNC ==============
+# Collection -> projection of the documents sent by /sync
+SYNC_PROJECTIONS = {
+    "patients": PATIENT_PROJECTION,
+    "appointments": {"_id": 0},
+    "schede_medicazione_med": {"_id": 0},
+    "schede_impianto_picc": {"_id": 0},
+    "schede_gestione_picc": {"_id": 0},
+    "photos": PHOTO_METADATA_PROJECTION,
+}
+
+@api_router.get("/sync")
+async def sync_changes(
+    since: Optional[str] = None,
+    ambulatorio: Optional[Ambulatorio] = None,
+    collections: Optional[str] = None,
+    payload: Principal = Depends(verify_token)
+):
+    """Records created, updated or deleted since the token of the previous
+    sync (everything without one); pass back the returned token next time"""
+    if ambulatorio and ambulatorio.value not in payload.ambulatori:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    names = [name.strip() for name in collections.split(",") if name.strip()] if collections else list(SYNC_PROJECTIONS)
+    unknown = sorted(set(names) - set(SYNC_PROJECTIONS))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Collection non valide: {', '.join(unknown)}")
+    try:
+        position = sync.parse_token(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Token di sincronizzazione non valido")
+    
+    ambulatori = [ambulatorio.value] if ambulatorio else payload.ambulatori
+    result = await sync.changes(db, {name: SYNC_PROJECTIONS[name] for name in names}, ambulatori, position)
+    return trusted(result)
+
+# ============== LIVE EVENTS ==============
+@api_router.get("/events")
+async def stream_events(
+    ambulatorio: Optional[Ambulatorio] = None,
+    token: Optional[str] = None,
+    bearer: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    """Server-Sent Events with the appointment and patient changes of one
+    ambulatorio (or of all those of the user)"""
+    if bearer:
+        token = bearer.credentials
+    if not token:
+        raise HTTPException(status_code=401, detail="Token mancante")
+    payload = token_verifier.verify(token)
+    if ambulatorio and ambulatorio.value not in payload.ambulatori:
+        raise HTTPException(status_code=403, detail="Non hai accesso a questo ambulatorio")
+    
+    ambulatori = [ambulatorio.value] if ambulatorio else payload.ambulatori
+    return StreamingResponse(
+        # Logout-all, revocation and expiry also end a stream already open
+        events.stream(event_bus, ambulatori, lambda: token_verifier.is_valid(payload)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ============== METRICS ==============
+# The scraper sends METRICS_TOKEN as a bearer token; without it the endpoint is off
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics(bearer: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
+    """Request and database metrics in Prometheus text format"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metriche non abilitate")
+    if bearer is None or not hmac.compare_digest(bearer.credentials, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Token non valido")
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+# ============== PROFILING ==============
+# PROFILING=1 lets the users in PROFILING_USERS (comma separated) add ?__profile=1 to any request
+PROFILING = os.environ.get('PROFILING', '').lower() in ("1", "true", "yes")
+PROFILING_USERS = frozenset(u.strip() for u in os.environ.get('PROFILING_USERS', '').split(',') if u.strip())
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', Path(tempfile.gettempdir()) / "ambulatorio-profiles"))
+
+def profiling_allowed(token: str) -> bool:
+    try:
+        return token_verifier.verify(token).username in PROFILING_USERS
+    except HTTPException:
+        return False
+
+@api_router.get("/profiles/{name}", include_in_schema=False)
+async def download_profile(name: str, payload: Principal = Depends(verify_token)):
+    """A profile captured with ?__profile=1 (name from the X-Profile-Id header)"""
+    if not PROFILING or payload.username not in PROFILING_USERS:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    path = profiling.profile_path(PROFILE_DIR, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    return FileResponse(path, filename=name)
+
 # ============== ROOT ==============
 @api_router.get("/")
 async def root():
@@ -1054,14 +1802,25 @@ async def root():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Not installed at all unless enabled
+if PROFILING:
+    app.add_middleware(profiling.ProfilingMiddleware, authorize=profiling_allowed, directory=PROFILE_DIR)
+
+# Photo binaries are already compressed; the event stream must not be buffered
+app.add_middleware(CompressionMiddleware, excluded=[r"/api/photos/[^/]+(/thumbnail/[^/]+)?$", r"/api/events$"])
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, profiling.PROFILE_HEADER],
 )
 
+# Outermost, so that latency and response size include CORS and compression
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -1069,6 +1828,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def init_database():
+    await ensure_indexes(db)
+    await credentials.seed_users(db, USERS)
+    if await slots.ensure_seeded(db):
+        logger.info("Slot occupancy counted from the existing appointments")
+    # Records saved before delta sync: without updated_at no sync would send them
+    backfilled = sum((await sync.backfill(db)).values())
+    if backfilled:
+        logger.info("updated_at assigned to %d records", backfilled)
+    indexed = await patient_search.ensure_indexed(db)
+    if indexed:
+        logger.info("Search fields computed for %d patients", indexed)
+    # INDEX_PLAN_CHECK: off, log (default) or fail
+    await verify_query_plans(db, os.environ.get('INDEX_PLAN_CHECK', 'log'))
+
+@app.on_event("startup")
+async def start_event_feed():
+    app.state.event_feed = asyncio.create_task(events.watch(db, event_bus))
+
+@app.on_event("startup")
+async def start_revocation_poll():
+    await token_verifier.load_revocations(db)
+    app.state.revocation_poll = asyncio.create_task(token_verifier.poll_revocations(db))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.event_feed.cancel()
+    app.state.revocation_poll.cancel()
     client.close()
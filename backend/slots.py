@@ -0,0 +1,149 @@
+"""Atomic capacity reservation for agenda slots.
+
+Each (ambulatorio, data, ora, tipo) slot has a document in ``slots`` whose
+``_id`` is the slot key and whose ``count`` is the number of booked
+appointments. A booking reserves a place with a single conditional
+``find_one_and_update``; when the slot is already full the filter does not
+match, the upsert collides with the existing ``_id`` and the reservation is
+refused. Two tablets booking the same slot at the same time can therefore
+never push it past ``SLOT_CAPACITY``.
+"""
+from typing import List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+SLOT_CAPACITY = 2
+
+# Appointment fields that make up the slot key
+SLOT_FIELDS = frozenset(("ambulatorio", "data", "ora", "tipo"))
+
+# Concurrent first bookings of an empty slot race on the upsert; the loser
+# retries and then finds the document the winner created.
+RESERVE_ATTEMPTS = 3
+
+
+def slot_id(ambulatorio, data: str, ora: str, tipo: str) -> str:
+    ambulatorio = getattr(ambulatorio, "value", ambulatorio)
+    return f"{ambulatorio}|{data}|{ora}|{tipo}"
+
+
+def slot_id_for(appointment: dict) -> str:
+    return slot_id(appointment["ambulatorio"], appointment["data"], appointment["ora"], appointment["tipo"])
+
+
+async def reserve(db, key: str) -> Optional[int]:
+    """Take one place in the slot; returns the new count, or None if full."""
+    ambulatorio, data, ora, tipo = key.split("|", 3)
+    for _ in range(RESERVE_ATTEMPTS):
+        try:
+            doc = await db.slots.find_one_and_update(
+                {"_id": key, "count": {"$lt": SLOT_CAPACITY}},
+                {
+                    "$inc": {"count": 1},
+                    "$setOnInsert": {"ambulatorio": ambulatorio, "data": data, "ora": ora, "tipo": tipo},
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            return doc["count"]
+        except DuplicateKeyError:
+            existing = await db.slots.find_one({"_id": key}, {"count": 1})
+            if existing and existing["count"] >= SLOT_CAPACITY:
+                return None
+    return None
+
+
+def _reserve_op(key: str) -> UpdateOne:
+    ambulatorio, data, ora, tipo = key.split("|", 3)
+    return UpdateOne(
+        {"_id": key, "count": {"$lt": SLOT_CAPACITY}},
+        {
+            "$inc": {"count": 1},
+            "$setOnInsert": {"ambulatorio": ambulatorio, "data": data, "ora": ora, "tipo": tipo},
+        },
+        upsert=True,
+    )
+
+
+async def reserve_many(db, keys: List[str]) -> List[bool]:
+    """Take one place in each slot with a single unordered bulk write.
+
+    Returns, per key, whether the place was taken. Like ``reserve``, a full
+    slot makes its upsert collide; collisions on slots that turn out not to
+    be full were lost creation races and are retried one by one.
+    """
+    if not keys:
+        return []
+    reserved = [True] * len(keys)
+    try:
+        await db.slots.bulk_write([_reserve_op(key) for key in keys], ordered=False)
+    except BulkWriteError as exc:
+        for error in exc.details.get("writeErrors", []):
+            if error.get("code") != 11000:
+                raise
+            reserved[error["index"]] = False
+    failed = [i for i, ok in enumerate(reserved) if not ok]
+    if failed:
+        counts = {
+            doc["_id"]: doc["count"]
+            async for doc in db.slots.find({"_id": {"$in": [keys[i] for i in failed]}}, {"count": 1})
+        }
+        for i in failed:
+            if counts.get(keys[i], 0) < SLOT_CAPACITY:
+                reserved[i] = await reserve(db, keys[i]) is not None
+    return reserved
+
+
+async def release(db, key: str) -> None:
+    await db.slots.update_one({"_id": key, "count": {"$gt": 0}}, {"$inc": {"count": -1}})
+
+
+async def release_many(db, keys: List[str]) -> None:
+    if keys:
+        await db.slots.bulk_write(
+            [UpdateOne({"_id": key, "count": {"$gt": 0}}, {"$inc": {"count": -1}}) for key in keys],
+            ordered=False,
+        )
+
+
+async def rebuild(db, keep_higher: bool = False) -> int:
+    """Recount the slots from the appointments, merging into ``slots``.
+
+    Run it while booking is stopped: a reservation made during the
+    aggregation is overwritten by the recount. With ``keep_higher`` a slot
+    keeps its current count when that is higher, which is safe while
+    bookings run but cannot correct a count that is too high.
+    """
+    when_matched = "replace"
+    if keep_higher:
+        when_matched = [{"$set": {"count": {"$max": ["$count", "$$new.count"]}}}]
+    pipeline = [
+        {"$group": {
+            "_id": {"ambulatorio": "$ambulatorio", "data": "$data", "ora": "$ora", "tipo": "$tipo"},
+            "count": {"$sum": 1},
+        }},
+        {"$project": {
+            "_id": {"$concat": ["$_id.ambulatorio", "|", "$_id.data", "|", "$_id.ora", "|", "$_id.tipo"]},
+            "ambulatorio": "$_id.ambulatorio",
+            "data": "$_id.data",
+            "ora": "$_id.ora",
+            "tipo": "$_id.tipo",
+            "count": 1,
+        }},
+        {"$merge": {"into": "slots", "on": "_id", "whenMatched": when_matched, "whenNotMatched": "insert"}},
+    ]
+    await db.appointments.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    return await db.slots.count_documents({})
+
+
+async def ensure_seeded(db) -> bool:
+    """Count the existing bookings into an empty ``slots`` (first start after
+    the upgrade); without it every slot would start from zero."""
+    if await db.slots.find_one({}, {"_id": 1}) is not None:
+        return False
+    if await db.appointments.find_one({}, {"_id": 1}) is None:
+        return False
+    # Other workers may already take bookings: never lower a count
+    await rebuild(db, keep_higher=True)
+    return True
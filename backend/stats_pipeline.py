@@ -0,0 +1,101 @@
+"""Statistics computed inside MongoDB with a single aggregation.
+
+Used for ranges the daily rollups in ``stats_rollup`` don't answer (ad-hoc
+date ranges, rollups not built yet) and for implant statistics. Each call is
+one ``$match`` followed by a ``$facet`` whose branches group on the server,
+so only the grouped counts travel back, whatever the size of the history.
+"""
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+MONTH = {"$substrBytes": ["$data", 0, 7]}
+IMPLANT_MONTH = {"$substrBytes": ["$data_impianto", 0, 7]}
+IMPLANT_TIPO = {"$ifNull": ["$tipo_catetere", "altro"]}
+
+
+async def _facet(collection, match: dict, facets: dict) -> dict:
+    pipeline = [{"$match": match}, {"$facet": facets}]
+    result = await collection.aggregate(pipeline, allowDiskUse=True).to_list(1)
+    return result[0] if result else {name: [] for name in facets}
+
+
+def _count(rows: list) -> int:
+    return rows[0]["n"] if rows else 0
+
+
+APPOINTMENT_FACETS = {
+    "totale": [{"$count": "n"}],
+    "pazienti": [{"$group": {"_id": "$patient_id"}}, {"$count": "n"}],
+    "prestazioni": [
+        {"$unwind": "$prestazioni"},
+        {"$group": {"_id": "$prestazioni", "n": {"$sum": 1}}},
+    ],
+    "mesi": [{"$group": {"_id": MONTH, "n": {"$sum": 1}}}],
+    "mesi_pazienti": [
+        {"$group": {"_id": {"mese": MONTH, "paziente": "$patient_id"}}},
+        {"$group": {"_id": "$_id.mese", "n": {"$sum": 1}}},
+    ],
+    "mesi_prestazioni": [
+        {"$unwind": "$prestazioni"},
+        {"$group": {"_id": {"mese": MONTH, "prestazione": "$prestazioni"}, "n": {"$sum": 1}}},
+    ],
+}
+
+
+def _appointment_summary(result: dict) -> dict:
+    monthly: Dict[str, dict] = {}
+    for row in result["mesi"]:
+        monthly[row["_id"]] = {"accessi": row["n"], "prestazioni": {}, "pazienti_unici": 0}
+    for row in result["mesi_pazienti"]:
+        monthly[row["_id"]]["pazienti_unici"] = row["n"]
+    for row in result["mesi_prestazioni"]:
+        monthly[row["_id"]["mese"]]["prestazioni"][row["_id"]["prestazione"]] = row["n"]
+
+    return {
+        "totale_accessi": _count(result["totale"]),
+        "pazienti_unici": _count(result["pazienti"]),
+        "prestazioni": {row["_id"]: row["n"] for row in result["prestazioni"]},
+        "dettaglio_mensile": dict(sorted(monthly.items())),
+    }
+
+
+async def appointment_statistics(db, match: dict) -> dict:
+    """Same shape as ``stats_rollup.summarise`` for the appointments in ``match``."""
+    return _appointment_summary(await _facet(db.appointments, match, APPOINTMENT_FACETS))
+
+
+async def appointment_statistics_by_period(db, match: dict, periods: List[Tuple[str, str]]) -> List[dict]:
+    """``appointment_statistics`` of every [start, end) date range in
+    ``periods``, reading the appointments of their union once: each period
+    is a set of ``$facet`` branches over the same ``$match``."""
+    match = {**match, "data": {"$gte": min(start for start, _ in periods),
+                               "$lt": max(end for _, end in periods)}}
+    facets = {}
+    for index, (start, end) in enumerate(periods):
+        in_period = {"$match": {"data": {"$gte": start, "$lt": end}}}
+        for name, stages in APPOINTMENT_FACETS.items():
+            facets[f"{index}_{name}"] = [in_period, *stages]
+    result = await _facet(db.appointments, match, facets)
+    return [
+        _appointment_summary({name: result[f"{index}_{name}"] for name in APPOINTMENT_FACETS})
+        for index in range(len(periods))
+    ]
+
+
+async def implant_statistics(db, match: dict) -> dict:
+    facets = {
+        "totale": [{"$count": "n"}],
+        "per_tipo": [{"$group": {"_id": IMPLANT_TIPO, "n": {"$sum": 1}}}],
+        "mesi": [{"$group": {"_id": {"mese": IMPLANT_MONTH, "tipo": IMPLANT_TIPO}, "n": {"$sum": 1}}}],
+    }
+    result = await _facet(db.schede_impianto_picc, match, facets)
+
+    monthly = defaultdict(dict)
+    for row in result["mesi"]:
+        monthly[row["_id"]["mese"]][row["_id"]["tipo"]] = row["n"]
+
+    return {
+        "totale_impianti": _count(result["totale"]),
+        "per_tipo": {row["_id"]: row["n"] for row in result["per_tipo"]},
+        "dettaglio_mensile": dict(sorted(monthly.items())),
+    }
@@ -0,0 +1,238 @@
+"""Daily statistics rollups for the agenda.
+
+``stats_daily`` holds one document per (ambulatorio, day, tipo) with the
+number of accessi, a counter per prestazione and a counter per patient:
+
+    {
+        "_id": "pta_centro|2026-03-02|MED",
+        "ambulatorio": "pta_centro", "data": "2026-03-02", "tipo": "MED",
+        "accessi": 7,
+        "prestazioni": {"medicazione_semplice": 5, "iniezione_terapeutica": 2},
+        "pazienti": {"<patient_id>": 1, ...}
+    }
+
+Documents are kept up to date with ``$inc`` whenever an appointment is
+created, changed or deleted, so ``/statistics`` reads at most one document
+per day and tipo instead of every appointment. Counters that drop to zero
+are left in place and ignored on read.
+"""
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set
+from urllib.parse import unquote
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = ("ambulatorio", "data", "tipo", "patient_id", "prestazioni")
+META_ID = "stats_daily"
+# Appointments are stamped before they are written: the history read by
+# rebuild ends this long before it starts, the rest is replayed
+REBUILD_SKEW = timedelta(seconds=5)
+
+
+def rollup_key(ambulatorio: str, data: str, tipo: str) -> str:
+    # Freshly dumped models still carry Enum members rather than plain strings
+    ambulatorio = getattr(ambulatorio, "value", ambulatorio)
+    return f"{ambulatorio}|{data}|{tipo}"
+
+
+def _field(name: str) -> str:
+    """Map keys become dotted paths in $inc: escape "." and a leading "$"
+    (and "%", the escape character) so that ``_name`` gives the key back."""
+    if not name:
+        return "%"
+    name = name.replace("%", "%25").replace(".", "%2E")
+    return "%24" + name[1:] if name.startswith("$") else name
+
+
+def _name(field: str) -> str:
+    return "" if field == "%" else unquote(field)
+
+
+def _inc_for(appointments: Iterable[dict], sign: int) -> Dict[str, Dict[str, int]]:
+    """Combine the $inc of several appointments, grouped by rollup document."""
+    incs: Dict[str, Counter] = {}
+    for app in appointments:
+        key = rollup_key(app["ambulatorio"], app["data"], app["tipo"])
+        inc = incs.setdefault(key, Counter())
+        inc["accessi"] += sign
+        inc[f"pazienti.{_field(app['patient_id'])}"] += sign
+        for prest in app.get("prestazioni", []):
+            inc[f"prestazioni.{_field(prest)}"] += sign
+    return {key: dict(inc) for key, inc in incs.items()}
+
+
+def _update_ops(appointments: Iterable[dict], sign: int) -> List[UpdateOne]:
+    ops = []
+    for key, inc in _inc_for(appointments, sign).items():
+        ambulatorio, data, tipo = key.split("|", 2)
+        ops.append(UpdateOne(
+            {"_id": key},
+            {"$inc": inc, "$setOnInsert": {"ambulatorio": ambulatorio, "data": data, "tipo": tipo}},
+            upsert=True,
+        ))
+    return ops
+
+
+async def record_appointments(db, appointments: List[dict], sign: int = 1) -> None:
+    """Add (``sign=1``) or remove (``sign=-1``) appointments from the rollups.
+
+    A failure here must not fail the booking itself; the rollups can always
+    be regenerated with ``manage.py rebuild-stats``.
+    """
+    ops = _update_ops(appointments, sign)
+    if not ops:
+        return
+    try:
+        await db.stats_daily.bulk_write(ops, ordered=False)
+    except PyMongoError:
+        logger.exception("stats_daily update failed, run `manage.py rebuild-stats`")
+
+
+async def record_appointment(db, appointment: dict, sign: int = 1) -> None:
+    await record_appointments(db, [appointment], sign)
+
+
+async def record_appointment_change(db, before: dict, after: dict) -> None:
+    if all(before.get(f) == after.get(f) for f in ROLLUP_FIELDS):
+        return
+    ops = _update_ops([before], -1) + _update_ops([after], 1)
+    try:
+        await db.stats_daily.bulk_write(ops, ordered=True)
+    except PyMongoError:
+        logger.exception("stats_daily update failed, run `manage.py rebuild-stats`")
+
+
+_built = False
+
+
+async def is_built(db) -> bool:
+    """Whether ``rebuild`` has run at least once; cached once it has."""
+    global _built
+    if not _built:
+        _built = await db.stats_meta.find_one({"_id": META_ID}, {"_id": 1}) is not None
+    return _built
+
+
+async def load_days(db, ambulatorio: str, start: str, end: str, tipo: Optional[str] = None) -> List[dict]:
+    """Rollup documents for ``start <= data < end``."""
+    query = {"ambulatorio": ambulatorio, "data": {"$gte": start, "$lt": end}}
+    if tipo:
+        query["tipo"] = tipo
+    return await db.stats_daily.find(query, {"_id": 0}).to_list(None)
+
+
+def summarise(days: Iterable[dict]) -> dict:
+    """Fold daily rollups into the ``/statistics`` totals and monthly detail."""
+    accessi = 0
+    pazienti = set()
+    prestazioni: Counter = Counter()
+    monthly: Dict[str, dict] = {}
+
+    for day in days:
+        if day.get("accessi", 0) <= 0:
+            continue
+        day_pazienti = [pid for pid, n in day.get("pazienti", {}).items() if n > 0]
+        # Same keys as the appointments, as in the stats_pipeline results
+        day_prestazioni = {_name(p): n for p, n in day.get("prestazioni", {}).items() if n > 0}
+
+        accessi += day["accessi"]
+        pazienti.update(day_pazienti)
+        prestazioni.update(day_prestazioni)
+
+        month = monthly.setdefault(day["data"][:7], {"accessi": 0, "pazienti": set(), "prestazioni": Counter()})
+        month["accessi"] += day["accessi"]
+        month["pazienti"].update(day_pazienti)
+        month["prestazioni"].update(day_prestazioni)
+
+    return {
+        "totale_accessi": accessi,
+        "pazienti_unici": len(pazienti),
+        "prestazioni": dict(prestazioni),
+        "dettaglio_mensile": {
+            key: {
+                "accessi": month["accessi"],
+                "prestazioni": dict(month["prestazioni"]),
+                "pazienti_unici": len(month["pazienti"]),
+            }
+            for key, month in sorted(monthly.items())
+        },
+    }
+
+
+async def _replay(db, scratch, since: str, replayed: Set[str]) -> int:
+    """Add to ``scratch`` the appointments created from ``since`` on that are
+    not in ``replayed`` yet; returns how many were added."""
+    projection = {"_id": 0, "id": 1, **{f: 1 for f in ROLLUP_FIELDS}}
+    appointments = [
+        app async for app in db.appointments.find({"created_at": {"$gte": since}}, projection)
+        if app.get("id") not in replayed
+    ]
+    ops = _update_ops(appointments, 1)
+    if ops:
+        await scratch.bulk_write(ops, ordered=False)
+    replayed.update(app.get("id") for app in appointments)
+    return len(appointments)
+
+
+async def rebuild(db, batch_size: int = 1000) -> int:
+    """Regenerate ``stats_daily`` from the whole appointment history.
+
+    The rollups are built in a scratch collection and swapped in with a
+    rename, so ``/statistics`` never sees a half-built state. The rename
+    drops the updates made to ``stats_daily`` meanwhile, so the history is
+    read up to a high-water mark on ``created_at`` and the bookings created
+    after it are replayed into the scratch collection right before the
+    rename. Changes to and deletions of older appointments made while the
+    rebuild runs are still lost: run it with the agenda idle.
+    """
+    high_water = (datetime.now(timezone.utc) - REBUILD_SKEW).isoformat()
+    days: Dict[str, Counter] = {}
+    projection = {"_id": 0, **{f: 1 for f in ROLLUP_FIELDS}}
+    # Also matches legacy appointments without created_at
+    history = {"created_at": {"$not": {"$gte": high_water}}}
+    async for app in db.appointments.find(history, projection).batch_size(batch_size):
+        for key, inc in _inc_for([app], 1).items():
+            days.setdefault(key, Counter()).update(inc)
+
+    scratch = db["stats_daily_rebuild"]
+    await scratch.drop()
+    docs = []
+    for key, counters in days.items():
+        ambulatorio, data, tipo = key.split("|", 2)
+        doc = {"_id": key, "ambulatorio": ambulatorio, "data": data, "tipo": tipo,
+               "accessi": 0, "prestazioni": {}, "pazienti": {}}
+        for path, value in counters.items():
+            if "." in path:
+                group, name = path.split(".", 1)
+                doc[group][name] = value
+            else:
+                doc[path] = value
+        docs.append(doc)
+        if len(docs) >= batch_size:
+            await scratch.insert_many(docs)
+            docs = []
+    if docs:
+        await scratch.insert_many(docs)
+
+    # Until a pass finds no new booking, so the window before the rename is short
+    replayed: Set[str] = set()
+    while await _replay(db, scratch, high_water, replayed):
+        pass
+
+    documents = await scratch.count_documents({})
+    if documents:
+        await scratch.rename("stats_daily", dropTarget=True)
+    else:
+        await db.stats_daily.delete_many({})
+    await db.stats_daily.create_index([("ambulatorio", 1), ("data", 1), ("tipo", 1)])
+    await db.stats_meta.update_one(
+        {"_id": META_ID},
+        {"$set": {"rebuilt_at": datetime.now(timezone.utc).isoformat(), "documents": documents}},
+        upsert=True,
+    )
+    return documents
@@ -0,0 +1,166 @@
+"""Delta sync for tablets that go offline.
+
+Every synced collection keeps ``updated_at`` (ISO string, set on insert and
+on every update) and every delete leaves a tombstone in ``tombstones``. A
+client sends back the ``since`` token of its previous sync and receives, per
+collection, only the documents updated and the ids deleted after it.
+
+``updated_at`` is stamped by the API process before the write reaches the
+database, so a write stamped just before a sync may only become visible
+after it. The next token therefore starts ``OVERLAP`` before the moment the
+sync began: a few documents are sent twice, none is missed, and applying a
+document by ``id`` is idempotent on the client.
+
+A response holds at most ``SYNC_LIMIT`` documents and deletions per
+collection; when one is truncated ``more`` is set and its token resumes
+each collection after the last ``(updated_at, id)`` sent.
+
+Tombstones expire after ``TOMBSTONE_DAYS``; a token issued longer ago than
+that gets a full download with ``reset`` set, as does a first sync without a
+token. Documents written before ``updated_at`` existed are given one by
+``manage.py backfill-updated-at``.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from pagination import SortSpec, add_filter, cursor_values, decode_cursor, encode_cursor, keyset_filter
+
+SYNC_COLLECTIONS = (
+    "patients",
+    "appointments",
+    "schede_medicazione_med",
+    "schede_impianto_picc",
+    "schede_gestione_picc",
+    "photos",
+)
+
+OVERLAP = timedelta(seconds=30)
+TOMBSTONE_DAYS = 30
+# Documents per collection in one response; the client asks again while "more" is set
+SYNC_LIMIT = 2000
+
+# Page order of the documents and of the tombstones of a collection
+DOC_ORDER = (("updated_at", 1), ("id", 1))
+DELETION_ORDER = (("deleted_at", 1), ("id", 1))
+
+# Shape of the sync token, for decode_cursor: see SyncPosition
+TOKEN_SPEC = (("since", 1), ("started_at", 1), ("pending", 1))
+
+
+async def backfill(db) -> Dict[str, int]:
+    """Give ``updated_at`` (their ``created_at``) to documents written without it."""
+    counts = {}
+    for collection in SYNC_COLLECTIONS:
+        result = await db[collection].update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": {"$ifNull": ["$created_at", "1970-01-01T00:00:00+00:00"]}}}]
+        )
+        counts[collection] = result.modified_count
+    return counts
+
+
+async def record_deletion(db, collection: str, doc: dict) -> None:
+    """Leave the tombstone of a deleted record (needs its id and ambulatorio)."""
+    deleted = datetime.now(timezone.utc)
+    await db.tombstones.insert_one({
+        "collection": collection,
+        "id": doc["id"],
+        "ambulatorio": getattr(doc["ambulatorio"], "value", doc["ambulatorio"]),
+        "deleted_at": deleted.isoformat(),
+        # TTL index: a date, not the ISO string
+        "expires_at": deleted + timedelta(days=TOMBSTONE_DAYS),
+    })
+
+
+class SyncPosition(NamedTuple):
+    """Where a sync resumes, decoded from its token.
+
+    ``since`` is the ``updated_at`` the round of syncs started from (None:
+    full download) and ``started_at`` the moment that round began. While a
+    round is truncated, ``pending`` maps each unfinished collection to the
+    ``(updated_at, id)`` of the last document sent and the ``(deleted_at,
+    id)`` of the last tombstone sent (None once that part is complete).
+    """
+    since: Optional[str] = None
+    started_at: Optional[str] = None
+    pending: Optional[Dict[str, list]] = None
+
+
+def parse_token(token: Optional[str]) -> SyncPosition:
+    """The position a sync resumes from; a full download without a token.
+
+    Raises ValueError for an invalid token.
+    """
+    if not token:
+        return SyncPosition()
+    since, started_at, pending = decode_cursor(token, TOKEN_SPEC)
+    if not isinstance(since, (str, type(None))) or not isinstance(started_at, str) \
+            or not isinstance(pending, (dict, type(None))):
+        raise ValueError("token non valido")
+    for parts in (pending or {}).values():
+        if not (isinstance(parts, list) and len(parts) == 2
+                and all(last is None or (isinstance(last, list) and len(last) == 2) for last in parts)):
+            raise ValueError("token non valido")
+    # The deletes since then may already have expired
+    oldest = (datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_DAYS)).isoformat()
+    if since is not None and started_at <= oldest:
+        return SyncPosition()
+    return SyncPosition(since, started_at, pending)
+
+
+def _after(query: dict, sort: SortSpec, last: Optional[list]) -> dict:
+    return add_filter(query, keyset_filter(sort, last)) if last else query
+
+
+async def changes(db, projections: Dict[str, dict], ambulatori: Iterable[str],
+                  position: SyncPosition, limit: int = SYNC_LIMIT) -> dict:
+    """Documents updated and ids deleted at or after ``position.since`` in
+    every collection of ``projections``, and the token of the next sync.
+
+    At most ``limit`` documents and ``limit`` deletions per collection are
+    returned; the next page resumes after the last ``(updated_at, id)`` sent,
+    so documents sharing one ``updated_at`` cannot stall the sync.
+    """
+    since, started_at, pending = position
+    if pending is None:
+        # A new round: its changes are those from since up to now
+        started_at = datetime.now(timezone.utc).isoformat()
+    scope = {"ambulatorio": {"$in": list(ambulatori)}}
+    result = {"reset": since is None and pending is None, "more": False, "collections": {}}
+    next_pending = {}
+    for collection, projection in projections.items():
+        if pending is not None and collection not in pending:
+            # Completed earlier in this round
+            result["collections"][collection] = {"updated": [], "deleted": []}
+            continue
+        last_doc, last_deletion = pending[collection] if pending is not None else (None, None)
+        if pending is not None and last_doc is None:
+            docs = []
+        else:
+            query = dict(scope)
+            if since:
+                query["updated_at"] = {"$gte": since}
+            query = _after(query, DOC_ORDER, last_doc)
+            docs = await db[collection].find(query, projection).sort(list(DOC_ORDER)).limit(limit).to_list(limit)
+        deletions = []
+        if since and (pending is None or last_deletion is not None):
+            query = _after({**scope, "collection": collection, "deleted_at": {"$gte": since}},
+                           DELETION_ORDER, last_deletion)
+            deletions = await db.tombstones.find(query, {"_id": 0, "id": 1, "deleted_at": 1}) \
+                .sort(list(DELETION_ORDER)).limit(limit).to_list(limit)
+        if len(docs) == limit or len(deletions) == limit:
+            # Truncated: the next page resumes after the last record sent
+            next_pending[collection] = [
+                cursor_values(docs[-1], DOC_ORDER) if len(docs) == limit else None,
+                cursor_values(deletions[-1], DELETION_ORDER) if len(deletions) == limit else None,
+            ]
+        result["collections"][collection] = {"updated": docs, "deleted": [doc["id"] for doc in deletions]}
+
+    if next_pending:
+        result["more"] = True
+        result["token"] = encode_cursor([since, started_at, next_pending])
+    else:
+        # The next round starts from when this one began
+        next_since = (datetime.fromisoformat(started_at) - OVERLAP).isoformat()
+        result["token"] = encode_cursor([next_since, started_at, None])
+    return result
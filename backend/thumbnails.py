@@ -0,0 +1,99 @@
+"""Derived thumbnails for patient photos.
+
+Thumbnails are rendered once, right after upload, on a worker pool so the
+decoding and resizing of multi-megabyte phone photos never runs on the event
+loop. The results are stored in the same blob store as the originals and
+referenced from ``photo["thumbnails"][size]``.
+"""
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from photo_store import BlobStore, BlobNotFound, iter_bytes
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels
+THUMBNAIL_SIZES = {
+    "grid": 320,
+    "preview": 1280,
+}
+THUMBNAIL_CONTENT_TYPE = "image/jpeg"
+THUMBNAIL_QUALITY = 80
+
+# Pillow releases the GIL while decoding and resampling, so threads scale
+thumbnail_executor = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1),
+    thread_name_prefix="thumbnails",
+)
+
+
+def render_thumbnails(data: bytes) -> Dict[str, bytes]:
+    with Image.open(io.BytesIO(data)) as image:
+        # Phone cameras store rotation in EXIF instead of rotating the pixels
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        rendered = {}
+        for name, side in THUMBNAIL_SIZES.items():
+            thumb = image.copy()
+            thumb.thumbnail((side, side), Image.LANCZOS)
+            out = io.BytesIO()
+            thumb.save(out, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            rendered[name] = out.getvalue()
+        return rendered
+
+
+async def generate_thumbnails(db, store: BlobStore, photo_id: str) -> bool:
+    """Render and store every size in ``THUMBNAIL_SIZES`` for one photo."""
+    photo = await db.photos.find_one({"id": photo_id}, {"_id": 0, "id": 1, "blob_id": 1})
+    if not photo or "blob_id" not in photo:
+        return False
+
+    try:
+        blob = await store.open(photo["blob_id"])
+    except BlobNotFound:
+        logger.warning("Photo %s: original blob missing, no thumbnails", photo_id)
+        return False
+    data = b"".join([chunk async for chunk in blob.chunks])
+
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(thumbnail_executor, render_thumbnails, data)
+    except (UnidentifiedImageError, OSError) as exc:
+        logger.warning("Photo %s: cannot render thumbnails (%s)", photo_id, exc)
+        return False
+    del data
+
+    thumbnails = {}
+    for name, content in rendered.items():
+        stored = await store.save(iter_bytes(content), f"{photo_id}-{name}", THUMBNAIL_CONTENT_TYPE)
+        thumbnails[name] = {
+            "blob_id": stored.blob_id,
+            "size": stored.size,
+            "sha256": stored.sha256,
+        }
+
+    result = await db.photos.update_one({"id": photo_id}, {"$set": {"thumbnails": thumbnails}})
+    if result.matched_count == 0:
+        # Photo deleted while we were rendering
+        for thumb in thumbnails.values():
+            await store.delete(thumb["blob_id"])
+        return False
+    return True
+
+
+async def generate_missing_thumbnails(db, store: BlobStore, limit: int = 0) -> int:
+    query = {"blob_id": {"$exists": True}, "thumbnails": {"$exists": False}}
+    cursor = db.photos.find(query, {"_id": 0, "id": 1})
+    generated = 0
+    async for doc in cursor:
+        if await generate_thumbnails(db, store, doc["id"]):
+            generated += 1
+        if limit and generated >= limit:
+            break
+    return generated
@@ -0,0 +1,123 @@
+"""Chronological patient timeline merged from several collections.
+
+Every source (appointments, schede, photos) is read through its own cursor,
+sorted newest first on ``(date, time, id)`` by the existing per-patient
+indexes. The cursors are merged lazily with a heap, so a page of ``limit``
+events reads at most ``limit + 1`` documents from each source. The position
+in the timeline is the key ``[date, time, tipo, id]`` of the last event
+sent; the next page resumes every source strictly after that key.
+"""
+import asyncio
+import heapq
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from pagination import encode_cursor, decode_cursor
+
+# Shape of the timeline key, for decode_cursor
+KEY_SPEC = (("data", -1), ("ora", -1), ("tipo", -1), ("id", -1))
+
+
+class Source(NamedTuple):
+    tipo: str
+    collection: str
+    date_field: str
+    time_field: Optional[str] = None
+    projection: Optional[dict] = None
+
+
+def event_key(source: Source, doc: dict) -> Tuple[str, str, str, str]:
+    time = (doc.get(source.time_field) or "") if source.time_field else ""
+    return (doc.get(source.date_field) or "", time, source.tipo, doc["id"])
+
+
+def before_filter(source: Source, key: Sequence[str]) -> dict:
+    """Documents of ``source`` whose key sorts strictly before ``key``.
+
+    The keyset condition over ``(date, time, tipo, id)``, where time and tipo
+    are constants for sources without a time field and for the source itself.
+    """
+    fields = [
+        (source.date_field, None),
+        (source.time_field, None) if source.time_field else (None, ""),
+        (None, source.tipo),
+        ("id", None),
+    ]
+    branches, prefix = [], {}
+    for (field, constant), value in zip(fields, key):
+        if field is None:
+            if constant < value:
+                branches.append(dict(prefix))
+            if constant != value:
+                break
+            continue
+        branches.append({**prefix, field: {"$lt": value}})
+        prefix[field] = value
+    return {"$or": branches} if branches else {"_id": {"$exists": False}}
+
+
+def sort_spec(source: Source) -> List[Tuple[str, int]]:
+    fields = [source.date_field] + ([source.time_field] if source.time_field else []) + ["id"]
+    return [(field, -1) for field in fields]
+
+
+class _Newest:
+    """Heap entry: heapq pops the smallest, the timeline wants the newest."""
+    __slots__ = ("key", "doc", "source", "cursor")
+
+    def __init__(self, key, doc, source, cursor):
+        self.key, self.doc, self.source, self.cursor = key, doc, source, cursor
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+async def _next(cursor) -> Optional[dict]:
+    try:
+        return await cursor.next()
+    except StopAsyncIteration:
+        return None
+
+
+async def fetch_page(db, sources: Sequence[Source], query: dict, limit: int,
+                     cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of events, newest first, and the cursor of the next page.
+
+    Raises ValueError for an invalid cursor.
+    """
+    key = decode_cursor(cursor, KEY_SPEC) if cursor else None
+    cursors = []
+    for source in sources:
+        source_query = dict(query)
+        if key:
+            source_query["$and"] = [before_filter(source, key)]
+        docs = db[source.collection].find(source_query, source.projection or {"_id": 0})
+        cursors.append(docs.sort(sort_spec(source)).limit(limit + 1).batch_size(limit + 1))
+    # The first batch of every source is fetched concurrently
+    firsts = await asyncio.gather(*(_next(docs) for docs in cursors))
+    heap = [
+        _Newest(event_key(source, doc), doc, source, docs)
+        for source, docs, doc in zip(sources, cursors, firsts) if doc is not None
+    ]
+    heapq.heapify(heap)
+
+    events = []
+    while heap:
+        entry = heapq.heappop(heap)
+        events.append((entry.key, entry.source, entry.doc))
+        if len(events) > limit:
+            await entry.cursor.close()
+            break
+        doc = await _next(entry.cursor)
+        if doc is not None:
+            heapq.heappush(heap, _Newest(event_key(entry.source, doc), doc, entry.source, entry.cursor))
+    for entry in heap:
+        await entry.cursor.close()
+
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(list(events[-1][0]))
+    return [
+        {"tipo": source.tipo, "data": key[0], "ora": key[1] or None, "id": key[3], "record": doc}
+        for key, source, doc in events
+    ], next_cursor
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Response path benchmark for Ambulatorio Infermieristico
+Measures the CPU spent per request to turn 1,000 stored documents into a
+response: the old path (response_model validation + JSONResponse) against the
+trusted orjson path used by the list routes. No database is needed: the
+handlers return prebuilt documents shaped like those in MongoDB.
+
+Usage: python benchmarks/response_path.py [rows] [requests]
+"""
+
+import os
+import sys
+import time
+import uuid
+import asyncio
+from pathlib import Path
+from typing import List
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+# The server module needs these to import; the benchmark never connects
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from server import Patient, Appointment, trusted  # noqa: E402
+
+
+def patient_docs(rows: int) -> List[dict]:
+    return [
+        Patient(nome=f"Nome{i}", cognome=f"Cognome{i:05d}", tipo="MED", ambulatorio="pta_centro",
+                codice_fiscale="RSSMRA80A01H501U", telefono="3331234567",
+                anamnesi="Anamnesi " * 20, lesion_markers=[{"x": 10, "y": 20, "note": "gamba dx"}]).model_dump(mode="json")
+        for i in range(rows)
+    ]
+
+
+def appointment_docs(rows: int) -> List[dict]:
+    return [
+        Appointment(patient_id=str(uuid.uuid4()), patient_nome=f"Nome{i}", patient_cognome=f"Cognome{i}",
+                    ambulatorio="pta_centro", data="2026-03-02", ora="09:00", tipo="MED",
+                    prestazioni=["medicazione_semplice", "fasciatura_semplice"]).model_dump(mode="json")
+        for i in range(rows)
+    ]
+
+
+def build_app(patients: List[dict], appointments: List[dict]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/before/patients", response_model=List[Patient], response_class=JSONResponse)
+    async def patients_before():
+        return patients
+
+    @app.get("/after/patients", response_model=List[Patient])
+    async def patients_after():
+        return trusted(patients)
+
+    @app.get("/before/appointments", response_model=List[Appointment], response_class=JSONResponse)
+    async def appointments_before():
+        return appointments
+
+    @app.get("/after/appointments", response_model=List[Appointment])
+    async def appointments_after():
+        return trusted(appointments)
+
+    return app
+
+
+async def cpu_per_request(client: httpx.AsyncClient, path: str, requests: int) -> float:
+    await client.get(path)  # warm up
+    start = time.process_time()
+    for _ in range(requests):
+        response = await client.get(path)
+        response.raise_for_status()
+    return (time.process_time() - start) / requests * 1000
+
+
+async def run(rows: int, requests: int):
+    app = build_app(patient_docs(rows), appointment_docs(rows))
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        print(f"{rows} rows per response, {requests} requests, CPU ms per request")
+        print(f"{'endpoint':<16}{'before':>10}{'after':>10}{'speedup':>10}")
+        for endpoint in ("patients", "appointments"):
+            before = await cpu_per_request(client, f"/before/{endpoint}", requests)
+            after = await cpu_per_request(client, f"/after/{endpoint}", requests)
+            print(f"{endpoint:<16}{before:>10.2f}{after:>10.2f}{before / after:>9.1f}x")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(run(rows, requests))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
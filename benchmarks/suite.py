@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+Load benchmark suite for Ambulatorio Infermieristico
+Seeds a synthetic clinic (patients, years of appointments, schede and photos
+at real sizes) and drives the ASGI app in-process with concurrent clients
+over the hot paths: login, agenda day, patient search, chart open, booking
+burst, statistics year, photo upload and photo download. Reports p50/p95/p99
+latency and throughput per scenario, and saves or compares JSON baselines so
+regressions show up.
+
+The database is a local MongoDB (MONGO_URL, database DB_NAME, default
+ambulatorio_benchmark, dropped and reseeded) or, with --memory, the
+in-memory mongomock-motor stand-in. The stand-in has no indexes and lacks
+some operators: use it to try the suite, not to compare numbers.
+
+Usage:
+  python benchmarks/suite.py                          # seed + run, print the table
+  python benchmarks/suite.py --save-baseline main     # ... and store benchmarks/baselines/main.json
+  python benchmarks/suite.py --compare main           # ... and fail on regressions against it
+  python benchmarks/suite.py --scenarios agenda_day,chart_open --requests 500 --concurrency 50
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ambulatorio_benchmark")
+
+import server  # noqa: E402
+import credentials  # noqa: E402
+from patient_search import search_fields  # noqa: E402
+import slots  # noqa: E402
+import stats_rollup  # noqa: E402
+from db_indexes import ensure_indexes  # noqa: E402
+from photo_store import BlobStore, BlobNotFound, BlobReader, StoredBlob, iter_bytes  # noqa: E402
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+
+COGNOMI = ["Rossi", "Russo", "Ferrari", "Esposito", "Bianchi", "Romano", "Colombo", "Ricci", "Marino",
+           "Greco", "Bruno", "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo",
+           "Lombardi", "Moretti", "Barbieri", "Fontana", "Santoro", "Mariani", "Rinaldi", "Caruso"]
+NOMI = ["Giuseppe", "Maria", "Giovanni", "Anna", "Antonino", "Rosa", "Salvatore", "Francesca",
+        "Francesco", "Giuseppa", "Vincenzo", "Angela", "Domenico", "Rosalia", "Pietro", "Carmela"]
+PRESTAZIONI_MED = ["medicazione_semplice", "medicazione_complessa", "fasciatura_semplice", "bendaggio_elastocompressivo"]
+PRESTAZIONI_PICC = ["medicazione_picc", "lavaggio_picc", "sostituzione_sutureless"]
+
+
+class MemoryBlobStore(BlobStore):
+    """Photo binaries in a dict, for --memory runs (the stand-in has no GridFS)."""
+
+    def __init__(self):
+        self.blobs: Dict[str, tuple] = {}
+
+    async def save(self, chunks, filename: str, content_type: str) -> StoredBlob:
+        data = b"".join([chunk async for chunk in chunks])
+        blob_id = f"{len(self.blobs)}-{filename}"
+        self.blobs[blob_id] = (data, content_type)
+        return StoredBlob(blob_id, len(data), hashlib.sha256(data).hexdigest(), content_type)
+
+    async def open(self, blob_id: str) -> BlobReader:
+        if blob_id not in self.blobs:
+            raise BlobNotFound(blob_id)
+        data, content_type = self.blobs[blob_id]
+        return BlobReader(content_type, len(data), iter_bytes(data))
+
+    async def delete(self, blob_id: str) -> None:
+        self.blobs.pop(blob_id, None)
+
+
+def photo_bytes(rng: random.Random, width: int = 1600, height: int = 1200) -> bytes:
+    """A JPEG of a phone photo's size: smooth gradient plus noise, ~0.3-0.6 MB."""
+    from PIL import Image
+    noise = Image.frombytes("L", (width, height), rng.randbytes(width * height))
+    base = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (base, Image.blend(base, noise, 0.3), noise.point(lambda v: v // 2)))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+
+def workdays(start: date, end: date) -> List[date]:
+    days = []
+    day = start
+    while day <= end:
+        if server.closed_reason(day) is None:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+async def seed(db, args, rng: random.Random) -> dict:
+    """Drop and regenerate the dataset; returns what the scenarios need."""
+    for name in await db.list_collection_names():
+        await db.drop_collection(name)
+    await ensure_indexes(db)
+    await credentials.seed_users(db, server.USERS)
+
+    patients = []
+    for i in range(args.patients):
+        ambulatorio = "villa_ginestre" if i % 4 == 0 else "pta_centro"
+        tipo = "PICC" if ambulatorio == "villa_ginestre" else rng.choice(["PICC", "MED", "MED", "PICC_MED"])
+        patient = server.Patient(
+            nome=rng.choice(NOMI), cognome=f"{rng.choice(COGNOMI)}{'' if i < len(COGNOMI) else i}",
+            tipo=tipo, ambulatorio=ambulatorio, codice_fiscale=f"RSSMRA80A01H{i:04d}U"[:16],
+            telefono=f"333{rng.randrange(10**7):07d}", anamnesi="Anamnesi remota e prossima. " * rng.randint(2, 20),
+            terapia_in_atto="Terapia domiciliare. " * rng.randint(1, 10),
+        ).model_dump(mode="json")
+        patients.append({**patient, **search_fields(patient)})
+    await db.patients.insert_many([dict(p) for p in patients])
+
+    # Appointments: every workday of the last `years` years, a share of the slots booked
+    today = date.today()
+    days = workdays(today - timedelta(days=365 * args.years), today + timedelta(days=30))
+    by_ambulatorio = {amb: [p for p in patients if p["ambulatorio"] == amb] for amb in ("pta_centro", "villa_ginestre")}
+    batch = []
+    appointments = 0
+    occupancy = Counter()
+    for day in days:
+        for ambulatorio, candidates in by_ambulatorio.items():
+            tipi = ["PICC"] if ambulatorio == "villa_ginestre" else ["PICC", "MED"]
+            for ora in server.TIME_SLOTS:
+                for tipo in tipi:
+                    for _ in range(slots.SLOT_CAPACITY):
+                        if rng.random() > args.occupancy:
+                            continue
+                        patient = rng.choice(candidates)
+                        occupancy[slots.slot_id(ambulatorio, day.isoformat(), ora, tipo)] += 1
+                        batch.append(server.Appointment(
+                            patient_id=patient["id"], patient_nome=patient["nome"], patient_cognome=patient["cognome"],
+                            ambulatorio=ambulatorio, data=day.isoformat(), ora=ora, tipo=tipo,
+                            prestazioni=rng.sample(PRESTAZIONI_PICC if tipo == "PICC" else PRESTAZIONI_MED, 2),
+                            completed=day < today,
+                        ).model_dump(mode="json"))
+        if len(batch) >= 5000:
+            await db.appointments.insert_many(batch)
+            appointments += len(batch)
+            batch = []
+    if batch:
+        await db.appointments.insert_many(batch)
+        appointments += len(batch)
+    # The counts are known here; slots.rebuild ($merge) is not available in mongomock
+    await db.slots.insert_many([
+        dict(zip(("ambulatorio", "data", "ora", "tipo"), key.split("|")), _id=key, count=count)
+        for key, count in occupancy.items()
+    ])
+    await stats_rollup.rebuild(db)
+
+    # Schede: a few medications per MED patient, an implant and monthly sheets per PICC patient
+    schede = {"schede_medicazione_med": [], "schede_impianto_picc": [], "schede_gestione_picc": []}
+    for patient in patients:
+        common = {"patient_id": patient["id"], "ambulatorio": patient["ambulatorio"]}
+        if patient["tipo"] in ("MED", "PICC_MED"):
+            for _ in range(rng.randint(1, 8)):
+                schede["schede_medicazione_med"].append(server.SchedaMedicazioneMED(
+                    **common, data_compilazione=rng.choice(days).isoformat(),
+                    fondo=["granuleggiante"], margini=["regolari"], medicazione="Medicazione avanzata " * 5,
+                ).model_dump(mode="json"))
+        if patient["tipo"] in ("PICC", "PICC_MED"):
+            implant = rng.choice(days)
+            schede["schede_impianto_picc"].append(server.SchedaImpiantoPICC(
+                **common, data_impianto=implant.isoformat(), tipo_catetere="picc", sede="braccio_dx",
+            ).model_dump(mode="json"))
+            for month in range(rng.randint(1, 6)):
+                mese = (implant + timedelta(days=31 * month)).strftime("%Y-%m")
+                giorni = {f"{mese}-{d:02d}": {"medicazione": "si", "lavaggio": "si"} for d in range(1, 29, 7)}
+                schede["schede_gestione_picc"].append(server.SchedaGestionePICC(
+                    **common, mese=mese, giorni=giorni,
+                ).model_dump(mode="json"))
+    for collection, docs in schede.items():
+        if docs:
+            await db[collection].insert_many(docs)
+
+    # Photos at real sizes; a handful of distinct images reused for every record
+    images = [photo_bytes(rng) for _ in range(3)]
+    photo_ids = []
+    for i in range(args.photos):
+        patient = rng.choice(patients)
+        image = images[i % len(images)]
+        photo_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        stored = await server.photo_store.save(iter_bytes(image), photo_id, "image/jpeg")
+        await db.photos.insert_one(server.Photo(
+            id=photo_id, patient_id=patient["id"], ambulatorio=patient["ambulatorio"], tipo=patient["tipo"][:4],
+            data=rng.choice(days).isoformat(), blob_id=stored.blob_id, content_type="image/jpeg",
+            size=stored.size, sha256=stored.sha256,
+        ).model_dump(mode="json"))
+        photo_ids.append(photo_id)
+
+    return {
+        "patients": patients,
+        "days": [d.isoformat() for d in days if d <= today],
+        "future_days": [d.isoformat() for d in days if d > today],
+        "photo_ids": photo_ids,
+        "image": images[0],
+        "counts": {"patients": len(patients), "appointments": appointments, "photos": len(photo_ids),
+                   **{name: len(docs) for name, docs in schede.items()}},
+    }
+
+
+# ============== SCENARIOS ==============
+# name -> (request, statuses that count as success)
+Scenario = Callable[[httpx.AsyncClient, dict, random.Random], Awaitable[httpx.Response]]
+
+
+async def login(client, ctx, rng):
+    username = rng.choice(list(server.USERS))
+    return await client.post("/api/auth/login", json={"username": username, "password": server.USERS[username]["password"]})
+
+
+async def agenda_day(client, ctx, rng):
+    return await client.get("/api/appointments", headers=ctx["headers"],
+                            params={"ambulatorio": "pta_centro", "data": rng.choice(ctx["days"])})
+
+
+async def patient_search(client, ctx, rng):
+    return await client.get("/api/patients", headers=ctx["headers"],
+                            params={"ambulatorio": "pta_centro", "search": rng.choice(COGNOMI)[:3].lower()})
+
+
+async def chart_open(client, ctx, rng):
+    patient = rng.choice(ctx["patients"])
+    return await client.get(f"/api/patients/{patient['id']}/chart", headers=ctx["headers"])
+
+
+async def booking_burst(client, ctx, rng):
+    patient = rng.choice([p for p in ctx["patients"][:200] if p["ambulatorio"] == "pta_centro"])
+    # Few slots, many tablets: most requests contend for the same places
+    return await client.post("/api/appointments", headers=ctx["headers"], json={
+        "patient_id": patient["id"], "ambulatorio": "pta_centro", "data": rng.choice(ctx["future_days"][:3]),
+        "ora": rng.choice(server.TIME_SLOTS[:4]), "tipo": "MED", "prestazioni": ["medicazione_semplice"],
+    })
+
+
+async def statistics_year(client, ctx, rng):
+    return await client.get("/api/statistics", headers=ctx["headers"],
+                            params={"ambulatorio": "pta_centro", "anno": int(rng.choice(ctx["days"])[:4])})
+
+
+async def photo_upload(client, ctx, rng):
+    patient = rng.choice(ctx["patients"])
+    return await client.post("/api/photos", headers=ctx["headers"], data={
+        "patient_id": patient["id"], "ambulatorio": patient["ambulatorio"], "tipo": "MED",
+        "data": rng.choice(ctx["days"]),
+    }, files={"file": ("foto.jpg", ctx["image"], "image/jpeg")})
+
+
+async def photo_download(client, ctx, rng):
+    return await client.get(f"/api/photos/{rng.choice(ctx['photo_ids'])}", headers=ctx["headers"])
+
+
+SCENARIOS: Dict[str, tuple] = {
+    "login": (login, {200}),
+    "agenda_day": (agenda_day, {200}),
+    "patient_search": (patient_search, {200}),
+    "chart_open": (chart_open, {200}),
+    # A full slot is a correct answer
+    "booking_burst": (booking_burst, {200, 400}),
+    "statistics_year": (statistics_year, {200}),
+    "photo_upload": (photo_upload, {200}),
+    "photo_download": (photo_download, {200}),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+async def run_scenario(client, ctx, name: str, requests: int, concurrency: int, seed_value: int) -> dict:
+    request, ok_statuses = SCENARIOS[name]
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker(worker_id: int):
+        nonlocal errors
+        rng = random.Random(f"{seed_value}-{name}-{worker_id}")
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await request(client, ctx, rng)
+                failed = response.status_code not in ok_statuses
+            except Exception:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of p95 latency or throughput beyond ``tolerance``."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline["scenarios"].get(name)
+        if not before:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['rps']} -> {result['rps']} req/s")
+    return regressions
+
+
+def print_table(results: dict, baseline: dict = None):
+    print(f"{'scenario':<18}{'req':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}"
+          + (f"{'p95 vs base':>13}" if baseline else ""))
+    for name, r in results.items():
+        line = (f"{name:<18}{r['requests']:>6}{r['errors']:>5}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+                f"{r['p99_ms']:>10.2f}{r['rps']:>9.1f}")
+        before = (baseline or {}).get("scenarios", {}).get(name)
+        if before:
+            line += f"{(r['p95_ms'] / before['p95_ms'] - 1) * 100:>+12.1f}%"
+        print(line)
+
+
+async def run(args) -> int:
+    if args.memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            print("--memory richiede mongomock-motor (pip install mongomock-motor)")
+            return 2
+        server.db = AsyncMongoMockClient()[os.environ["DB_NAME"]]
+        server.photo_store = MemoryBlobStore()
+    elif "benchmark" not in os.environ["DB_NAME"]:
+        # The suite drops the whole database
+        print(f"DB_NAME deve contenere 'benchmark' (ora: {os.environ['DB_NAME']})")
+        return 2
+    db = server.db
+
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"Scenari sconosciuti: {', '.join(unknown)} (disponibili: {', '.join(SCENARIOS)})")
+        return 2
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    ctx = await seed(db, args, rng)
+    print(f"Dataset ({time.perf_counter() - started:.1f}s): "
+          + ", ".join(f"{k} {v}" for k, v in ctx["counts"].items()))
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        response = await client.post("/api/auth/login", json={"username": "Domenico", "password": server.USERS["Domenico"]["password"]})
+        response.raise_for_status()
+        ctx["headers"] = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        print(f"{args.requests} requests per scenario, {args.concurrency} concurrent clients, "
+              f"{'mongomock (in-memory)' if args.memory else os.environ['MONGO_URL']}")
+        results = {}
+        for name in names:
+            requests = min(args.requests, args.login_requests) if name == "login" else args.requests
+            results[name] = await run_scenario(client, ctx, name, requests, args.concurrency, args.seed)
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads((BASELINE_DIR / f"{args.compare}.json").read_text())
+    print_table(results, baseline)
+
+    if args.save_baseline:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / f"{args.save_baseline}.json"
+        path.write_text(json.dumps({
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "settings": {k: getattr(args, k) for k in ("patients", "years", "occupancy", "photos", "requests",
+                                                       "concurrency", "seed", "memory")},
+            "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                            "cpus": os.cpu_count()},
+            "dataset": ctx["counts"],
+            "scenarios": results,
+        }, indent=2) + "\n")
+        print(f"Baseline salvata: {path}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSIONE {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di carico dell'API")
+    parser.add_argument("--memory", action="store_true", help="usa mongomock-motor invece di MongoDB")
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--years", type=int, default=2, help="anni di storico appuntamenti")
+    parser.add_argument("--occupancy", type=float, default=0.6, help="quota dei posti prenotati")
+    parser.add_argument("--photos", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=300, help="richieste per scenario")
+    parser.add_argument("--login-requests", type=int, default=50, help="richieste per lo scenario login (bcrypt)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", help="elenco separato da virgole (default: tutti)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="NOME")
+    parser.add_argument("--compare", metavar="NOME", help="confronta con benchmarks/baselines/NOME.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento tollerato (0.2 = 20%%)")
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Booking load test for Ambulatorio Infermieristico
+Fires hundreds of parallel bookings at the same agenda slot and checks that
+the slot never ends up with more than 2 patients.
+
+Usage: python booking_load_test.py [base_url] [requests]
+"""
+
+import sys
+import random
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+
+SLOT_CAPACITY = 2
+
+
+class BookingLoadTester:
+    def __init__(self, base_url="http://localhost:8001", parallel_requests=300):
+        self.api_url = f"{base_url}/api"
+        self.parallel_requests = parallel_requests
+        self.headers = {}
+
+    def log(self, message: str):
+        print(f"[booking] {message}")
+
+    def login(self):
+        response = requests.post(f"{self.api_url}/auth/login",
+                                 json={"username": "Domenico", "password": "infermiere"})
+        response.raise_for_status()
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    def create_patient(self) -> str:
+        response = requests.post(f"{self.api_url}/patients", headers=self.headers, json={
+            "nome": "Carico", "cognome": "Test", "tipo": "MED", "ambulatorio": "pta_centro"
+        })
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def book(self, payload: dict) -> int:
+        # One session per call: each request is its own connection, like a separate tablet
+        with requests.Session() as session:
+            response = session.post(f"{self.api_url}/appointments", headers=self.headers, json=payload)
+            return response.status_code
+
+    def run(self) -> bool:
+        self.login()
+        patient_id = self.create_patient()
+        # A random far-future slot so repeated runs don't collide
+        slot = {
+            "ambulatorio": "pta_centro",
+            "data": f"2030-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+            "ora": random.choice(["08:30", "09:00", "09:30", "10:00", "15:00", "16:00"]),
+            "tipo": "MED",
+        }
+        payload = {**slot, "patient_id": patient_id, "prestazioni": ["medicazione_semplice"]}
+
+        self.log(f"{self.parallel_requests} parallel bookings on {slot}")
+        with ThreadPoolExecutor(max_workers=min(self.parallel_requests, 200)) as pool:
+            statuses = Counter(pool.map(lambda _: self.book(payload), range(self.parallel_requests)))
+        self.log(f"Status codes: {dict(statuses)}")
+
+        response = requests.get(f"{self.api_url}/appointments", headers=self.headers,
+                                params={"ambulatorio": slot["ambulatorio"], "data": slot["data"], "tipo": slot["tipo"]})
+        booked = [a for a in response.json() if a["ora"] == slot["ora"]]
+        self.log(f"Appointments in slot: {len(booked)} (capacity {SLOT_CAPACITY})")
+
+        # Cleanup
+        for appointment in booked:
+            requests.delete(f"{self.api_url}/appointments/{appointment['id']}", headers=self.headers)
+        requests.delete(f"{self.api_url}/patients/{patient_id}", headers=self.headers)
+
+        ok = statuses[200] == len(booked) <= SLOT_CAPACITY
+        self.log("✅ No overbooking" if ok else "❌ Slot overbooked")
+        return ok
+
+
+def main():
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8001"
+    parallel_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    return 0 if BookingLoadTester(base_url, parallel_requests).run() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -54,13 +54,41 @@ apiClient.interceptors.request.use((config) => {
   return config;
 });
 
+// One refresh at a time, shared by the requests that got a 401 together
+let refreshing = null;
+export const refreshSession = () => {
+  if (!refreshing) {
+    const refreshToken = localStorage.getItem("refresh_token");
+    refreshing = (refreshToken
+      ? axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken }).then((response) => {
+          localStorage.setItem("token", response.data.access_token);
+          localStorage.setItem("refresh_token", response.data.refresh_token);
+          return response.data.access_token;
+        })
+      : Promise.reject(new Error("no refresh token"))
+    ).finally(() => {
+      refreshing = null;
+    });
+  }
+  return refreshing;
+};
+
 apiClient.interceptors.response.use(
   (response) => response,
-  (error) => {
-    if (error.response?.status === 401) {
-      localStorage.removeItem("token");
-      localStorage.removeItem("user");
-      window.location.href = "/login";
+  async (error) => {
+    const request = error.config;
+    if (error.response?.status === 401 && request && !request._retried) {
+      request._retried = true;
+      try {
+        const token = await refreshSession();
+        request.headers.Authorization = `Bearer ${token}`;
+        return apiClient(request);
+      } catch (refreshError) {
+        localStorage.removeItem("token");
+        localStorage.removeItem("refresh_token");
+        localStorage.removeItem("user");
+        window.location.href = "/login";
+      }
     }
     return Promise.reject(error);
   }
@@ -129,9 +157,10 @@ function AppContent() {
   const login = async (username, password) => {
     try {
       const response = await axios.post(`${API}/auth/login`, { username, password });
-      const { access_token, user: userData } = response.data;
+      const { access_token, refresh_token, user: userData } = response.data;
       
       localStorage.setItem("token", access_token);
+      localStorage.setItem("refresh_token", refresh_token);
       localStorage.setItem("user", JSON.stringify(userData));
       setUser(userData);
 
@@ -152,7 +181,12 @@ function AppContent() {
   };
 
   const logout = () => {
+    const refreshToken = localStorage.getItem("refresh_token");
+    if (refreshToken) {
+      axios.post(`${API}/auth/logout`, { refresh_token: refreshToken }).catch(() => {});
+    }
     localStorage.removeItem("token");
+    localStorage.removeItem("refresh_token");
     localStorage.removeItem("user");
     localStorage.removeItem("ambulatorio");
     setUser(null);
@@ -179,6 +179,8 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
   // State for dynamic columns (dates)
   const [columns, setColumns] = useState([]);
   const [columnData, setColumnData] = useState({});
+  const [savedData, setSavedData] = useState({}); // days as stored, to send only what changed
+  const [dayKeys, setDayKeys] = useState({}); // date -> key in scheda.giorni (older schede use day numbers)
   const [editNote, setEditNote] = useState("");
   const [saving, setSaving] = useState(false);
   const [insertPosition, setInsertPosition] = useState(null); // { index, side: 'left' | 'right' }
@@ -241,6 +243,7 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
     const existingData = scheda.giorni || {};
     const dates = [];
     const data = {};
+    const keysByDate = {};
     
     const keys = Object.keys(existingData);
     if (keys.length > 0) {
@@ -249,6 +252,7 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
         keys.forEach(dateStr => {
           dates.push(dateStr);
           data[dateStr] = existingData[dateStr];
+          keysByDate[dateStr] = dateStr;
         });
       } else {
         const [year, month] = scheda.mese.split("-").map(Number);
@@ -256,6 +260,7 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
           const dateStr = `${year}-${month.toString().padStart(2, "0")}-${dayNum.toString().padStart(2, "0")}`;
           dates.push(dateStr);
           data[dateStr] = existingData[dayNum];
+          keysByDate[dateStr] = dayNum;
         });
       }
     }
@@ -264,6 +269,8 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
     
     setColumns(dates);
     setColumnData(data);
+    setSavedData(data);
+    setDayKeys(keysByDate);
     setEditNote(scheda.note || "");
     setEditDialogOpen(true);
   };
@@ -336,25 +343,54 @@ export const SchedaGestionePICC = ({ patientId, ambulatorio, schede, onRefresh,
     toast.success("Dati copiati dalla colonna precedente");
   };
 
+  // Only the changed cells are sent, one day at a time; the version makes a
+  // concurrent edit of the same scheda fail with 409 instead of being overwritten
   const handleSaveEdit = async () => {
     setSaving(true);
+    const url = `/schede-gestione-picc/${selectedScheda.id}`;
+    let version = selectedScheda.version || 0;
     try {
-      const giorni = {};
-      columns.forEach(dateStr => {
-        if (columnData[dateStr] && Object.keys(columnData[dateStr]).length > 0) {
-          giorni[dateStr] = columnData[dateStr];
+      const dates = new Set([...Object.keys(savedData), ...columns]);
+      for (const dateStr of dates) {
+        const key = dayKeys[dateStr] || dateStr;
+        const before = savedData[dateStr] || {};
+        const after = (columns.includes(dateStr) && columnData[dateStr]) || {};
+
+        if (Object.keys(after).length === 0) {
+          if (Object.keys(before).length > 0) {
+            const response = await apiClient.delete(`${url}/giorni/${key}`, { params: { version } });
+            version = response.data.version;
+          }
+          continue;
         }
-      });
 
-      await apiClient.put(`/schede-gestione-picc/${selectedScheda.id}`, {
-        giorni,
-        note: editNote,
-      });
+        const campi = {};
+        Object.keys(after).forEach(field => {
+          if (after[field] !== before[field]) campi[field] = after[field];
+        });
+        Object.keys(before).forEach(field => {
+          if (!(field in after)) campi[field] = null;
+        });
+        if (Object.keys(campi).length > 0) {
+          const response = await apiClient.patch(`${url}/giorni/${key}`, { version, campi });
+          version = response.data.version;
+        }
+      }
+
+      if (editNote !== (selectedScheda.note || "")) {
+        await apiClient.put(url, { note: editNote });
+      }
       toast.success("Scheda salvata");
       setEditDialogOpen(false);
       onRefresh();
     } catch (error) {
-      toast.error("Errore nel salvataggio");
+      if (error.response?.status === 409) {
+        toast.error(error.response.data.detail);
+        setEditDialogOpen(false);
+        onRefresh();
+      } else {
+        toast.error("Errore nel salvataggio");
+      }
     } finally {
       setSaving(false);
     }
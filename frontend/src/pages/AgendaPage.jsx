@@ -1,5 +1,5 @@
 import { useState, useEffect, useCallback } from "react";
-import { useAmbulatorio, apiClient } from "@/App";
+import { useAmbulatorio, apiClient, API, refreshSession } from "@/App";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
@@ -98,7 +98,7 @@ export default function AgendaPage() {
           params: { ambulatorio, data: dateStr },
         }),
         apiClient.get("/patients", {
-          params: { ambulatorio, status: "in_cura" },
+          params: { ambulatorio, status: "in_cura", fields: "nome,cognome,tipo" },
         }),
         apiClient.get("/calendar/holidays", {
           params: { anno: currentDate.getFullYear() },
@@ -128,6 +128,80 @@ export default function AgendaPage() {
     fetchData();
   }, [fetchData]);
 
+  // Live updates: apply the changes pushed by the server instead of reloading
+  useEffect(() => {
+    const dateStr = format(currentDate, "yyyy-MM-dd");
+    let source = null;
+    let retryTimer = null;
+    let retryDelay = 1000;
+    let stopped = false;
+
+    const tokenExpiring = (token) => {
+      try {
+        const { exp } = JSON.parse(atob(token.split(".")[1].replace(/-/g, "+").replace(/_/g, "/")));
+        return exp * 1000 < Date.now() + 30000;
+      } catch (error) {
+        return true;
+      }
+    };
+
+    // The server ends the stream when the token expires or is revoked: open
+    // it again with the current token and reload what was missed meanwhile
+    const reconnect = () => {
+      if (source) source.close();
+      source = null;
+      if (stopped || retryTimer) return;
+      retryTimer = setTimeout(async () => {
+        retryTimer = null;
+        const token = localStorage.getItem("token");
+        if (token && tokenExpiring(token)) {
+          await refreshSession().catch(() => {});
+        }
+        // Goes through apiClient: a revoked session ends on the login page
+        await fetchData();
+        connect();
+      }, retryDelay);
+      retryDelay = Math.min(retryDelay * 2, 30000);
+    };
+
+    const connect = () => {
+      const token = localStorage.getItem("token");
+      if (stopped || !token) return;
+      source = new EventSource(
+        `${API}/events?ambulatorio=${ambulatorio}&token=${encodeURIComponent(token)}`
+      );
+      source.onopen = () => {
+        retryDelay = 1000;
+      };
+      source.onerror = reconnect;
+      source.addEventListener("unauthorized", reconnect);
+      source.addEventListener("appointments", (event) => {
+        const change = JSON.parse(event.data);
+        setAppointments((prev) => {
+          const others = prev.filter((a) => a.id !== change.id);
+          if (change.op === "delete" || change.doc.data !== dateStr) return others;
+          return [...others, change.doc];
+        });
+      });
+      source.addEventListener("patients", (event) => {
+        const change = JSON.parse(event.data);
+        setPatients((prev) => {
+          const others = prev.filter((p) => p.id !== change.id);
+          if (change.op === "delete" || change.doc.status !== "in_cura") return others;
+          return [...others, change.doc];
+        });
+      });
+      source.addEventListener("resync", () => fetchData());
+    };
+
+    connect();
+    return () => {
+      stopped = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, [ambulatorio, currentDate, fetchData]);
+
   useEffect(() => {
     if (searchQuery.length >= 1 && selectedSlot) {
       const tipo = selectedSlot.tipo;
@@ -65,9 +65,9 @@ export default function DashboardPage() {
       try {
         // Fetch patients to calculate stats
         const [inCuraRes, dimessiRes, sospesiRes] = await Promise.all([
-          apiClient.get("/patients", { params: { ambulatorio, status: "in_cura" } }),
-          apiClient.get("/patients", { params: { ambulatorio, status: "dimesso" } }),
-          apiClient.get("/patients", { params: { ambulatorio, status: "sospeso" } }),
+          apiClient.get("/patients", { params: { ambulatorio, status: "in_cura", fields: "tipo" } }),
+          apiClient.get("/patients", { params: { ambulatorio, status: "dimesso", fields: "tipo" } }),
+          apiClient.get("/patients", { params: { ambulatorio, status: "sospeso", fields: "tipo" } }),
         ]);
 
         const inCura = inCuraRes.data;
@@ -45,6 +45,8 @@ import SchedaMedicazioneMED from "@/components/SchedaMedicazioneMED";
 import SchedaImpiantoPICC from "@/components/SchedaImpiantoPICC";
 import SchedaGestionePICC from "@/components/SchedaGestionePICC";
 
+const CHART_SECTIONS = "schede_medicazione_med,schede_impianto_picc,schede_gestione_picc,photos";
+
 export default function PatientDetailPage() {
   const { patientId } = useParams();
   const navigate = useNavigate();
@@ -64,10 +66,21 @@ export default function PatientDetailPage() {
   const [schedeGestionePICC, setSchedeGestionePICC] = useState([]);
   const [photos, setPhotos] = useState([]);
 
+  const setMedicalRecords = (chart) => {
+    setSchedeMED(chart.schede_medicazione_med);
+    setSchedeImpiantoPICC(chart.schede_impianto_picc);
+    setSchedeGestionePICC(chart.schede_gestione_picc);
+    setPhotos(chart.photos);
+  };
+
+  // Patient and records in one request
   const fetchPatient = useCallback(async () => {
     try {
-      const response = await apiClient.get(`/patients/${patientId}`);
-      setPatient(response.data);
+      const response = await apiClient.get(`/patients/${patientId}/chart`, {
+        params: { include: CHART_SECTIONS },
+      });
+      setPatient(response.data.patient);
+      setMedicalRecords(response.data);
     } catch (error) {
       toast.error("Errore nel caricamento del paziente");
       navigate("/pazienti");
@@ -76,65 +89,22 @@ export default function PatientDetailPage() {
     }
   }, [patientId, navigate]);
 
+  // Records only, after a scheda or photo changed: the patient form keeps its edits
   const fetchMedicalRecords = useCallback(async () => {
-    if (!patient) return;
-
     try {
-      const requests = [];
-
-      // MED records
-      if (patient.tipo === "MED" || patient.tipo === "PICC_MED") {
-        requests.push(
-          apiClient.get("/schede-medicazione-med", {
-            params: { patient_id: patientId, ambulatorio },
-          })
-        );
-      } else {
-        requests.push(Promise.resolve({ data: [] }));
-      }
-
-      // PICC records
-      if (patient.tipo === "PICC" || patient.tipo === "PICC_MED") {
-        requests.push(
-          apiClient.get("/schede-impianto-picc", {
-            params: { patient_id: patientId, ambulatorio },
-          }),
-          apiClient.get("/schede-gestione-picc", {
-            params: { patient_id: patientId, ambulatorio },
-          })
-        );
-      } else {
-        requests.push(Promise.resolve({ data: [] }), Promise.resolve({ data: [] }));
-      }
-
-      // Photos
-      requests.push(
-        apiClient.get("/photos", {
-          params: { patient_id: patientId, ambulatorio },
-        })
-      );
-
-      const [medRes, impiantoRes, gestioneRes, photosRes] = await Promise.all(requests);
-
-      setSchedeMED(medRes.data);
-      setSchedeImpiantoPICC(impiantoRes.data);
-      setSchedeGestionePICC(gestioneRes.data);
-      setPhotos(photosRes.data);
+      const response = await apiClient.get(`/patients/${patientId}/chart`, {
+        params: { include: CHART_SECTIONS },
+      });
+      setMedicalRecords(response.data);
     } catch (error) {
       console.error("Error fetching medical records:", error);
     }
-  }, [patient, patientId, ambulatorio]);
+  }, [patientId]);
 
   useEffect(() => {
     fetchPatient();
   }, [fetchPatient]);
 
-  useEffect(() => {
-    if (patient) {
-      fetchMedicalRecords();
-    }
-  }, [patient, fetchMedicalRecords]);
-
   const handleSavePatient = async () => {
     setSaving(true);
     try {
@@ -647,6 +617,33 @@ export default function PatientDetailPage() {
   );
 }
 
+// Photos are served as binaries behind auth, so <img> can't load them directly
+function PhotoImage({ path, alt, className }) {
+  const [src, setSrc] = useState(null);
+
+  useEffect(() => {
+    let objectUrl = null;
+    let cancelled = false;
+    apiClient
+      .get(path, { responseType: "blob" })
+      .then((response) => {
+        if (cancelled) return;
+        objectUrl = URL.createObjectURL(response.data);
+        setSrc(objectUrl);
+      })
+      .catch((error) => console.error("Error loading photo:", error));
+    return () => {
+      cancelled = true;
+      if (objectUrl) URL.revokeObjectURL(objectUrl);
+    };
+  }, [path]);
+
+  if (!src) {
+    return <div className={`${className} bg-muted animate-pulse`} />;
+  }
+  return <img src={src} alt={alt} className={className} />;
+}
+
 // Photo Gallery Component
 function PhotoGallery({ patientId, ambulatorio, patientTipo, photos, onRefresh }) {
   const [uploading, setUploading] = useState(false);
@@ -724,8 +721,8 @@ function PhotoGallery({ patientId, ambulatorio, patientTipo, photos, onRefresh }
               onClick={() => setSelectedPhoto(photo)}
             >
               <div className="aspect-square relative">
-                <img
-                  src={`data:image/jpeg;base64,${photo.image_data}`}
+                <PhotoImage
+                  path={`/photos/${photo.id}/thumbnail/grid`}
                   alt={photo.descrizione || "Foto paziente"}
                   className="w-full h-full object-cover"
                 />
@@ -761,8 +758,8 @@ function PhotoGallery({ patientId, ambulatorio, patientTipo, photos, onRefresh }
             </DialogTitle>
           </DialogHeader>
           {selectedPhoto && (
-            <img
-              src={`data:image/jpeg;base64,${selectedPhoto.image_data}`}
+            <PhotoImage
+              path={`/photos/${selectedPhoto.id}`}
               alt="Foto ingrandita"
               className="w-full rounded-lg"
             />
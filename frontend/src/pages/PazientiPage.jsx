@@ -60,6 +60,9 @@ const PATIENT_TYPES = [
   { value: "PICC_MED", label: "PICC + MED", color: "bg-purple-100 text-purple-700" },
 ];
 
+// Only the columns the list shows; the full record is loaded by the detail page
+const LIST_FIELDS = "nome,cognome,tipo,status,discharge_reason";
+
 export default function PazientiPage() {
   const { ambulatorio } = useAmbulatorio();
   const navigate = useNavigate();
@@ -92,9 +95,9 @@ export default function PazientiPage() {
     setLoading(true);
     try {
       const [inCuraRes, dimessiRes, sospesiRes] = await Promise.all([
-        apiClient.get("/patients", { params: { ambulatorio, status: "in_cura" } }),
-        apiClient.get("/patients", { params: { ambulatorio, status: "dimesso" } }),
-        apiClient.get("/patients", { params: { ambulatorio, status: "sospeso" } }),
+        apiClient.get("/patients", { params: { ambulatorio, status: "in_cura", fields: LIST_FIELDS } }),
+        apiClient.get("/patients", { params: { ambulatorio, status: "dimesso", fields: LIST_FIELDS } }),
+        apiClient.get("/patients", { params: { ambulatorio, status: "sospeso", fields: LIST_FIELDS } }),
       ]);
       
       setAllPatients({
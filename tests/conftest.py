@@ -0,0 +1,23 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The backend modules are imported as top-level modules, as server.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+# server.py reads these at import; tests never reach the database through it
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "ambulatorio_test")
+
+
+@pytest.fixture
+def server():
+    # Motor binds the GridFS bucket created at import to the current event loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    import server
+    yield server
+    asyncio.set_event_loop(None)
+    loop.close()
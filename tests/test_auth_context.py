@@ -0,0 +1,111 @@
+import time
+from datetime import timedelta
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+from auth_context import TokenVerifier
+
+SECRET = "test-secret-of-at-least-thirty-two-bytes"
+
+
+def make_token(username="Oriana", ambulatori=("pta_centro",), jti="jti-1", iat=None, exp=None):
+    now = time.time()
+    payload = {
+        "sub": username,
+        "ambulatori": list(ambulatori),
+        "jti": jti,
+        "iat": now if iat is None else iat,
+        "exp": now + 3600 if exp is None else exp,
+    }
+    return jwt.encode(payload, SECRET, algorithm="HS256")
+
+
+@pytest.fixture
+def decodes():
+    return []
+
+
+@pytest.fixture
+def verifier(decodes):
+    def decode(token):
+        decodes.append(token)
+        return jwt.decode(token, SECRET, algorithms=["HS256"])
+    return TokenVerifier(decode, timedelta(hours=24), cache_size=2)
+
+
+def test_cache_hit_decodes_once(verifier, decodes):
+    token = make_token()
+    first = verifier.verify(token)
+    second = verifier.verify(token)
+    assert first == second
+    assert first.ambulatori == frozenset({"pta_centro"})
+    assert len(decodes) == 1
+
+
+def test_cache_evicts_least_recently_used(verifier, decodes):
+    a, b, c = make_token(jti="a"), make_token(jti="b"), make_token(jti="c")
+    verifier.verify(a)
+    verifier.verify(b)
+    verifier.verify(a)
+    verifier.verify(c)  # evicts b
+    assert len(verifier.cache) == 2
+    verifier.verify(a)
+    assert len(decodes) == 3
+    verifier.verify(b)
+    assert len(decodes) == 4
+
+
+def test_expired_token_is_rejected(verifier):
+    with pytest.raises(HTTPException) as exc:
+        verifier.verify(make_token(exp=time.time() - 10))
+    assert exc.value.status_code == 401
+
+
+def test_cached_token_expiring_is_dropped(verifier, monkeypatch):
+    token = make_token(exp=time.time() + 60)
+    verifier.verify(token)
+    monkeypatch.setattr(time, "time", lambda real=time.time: real() + 120)
+    with pytest.raises(HTTPException) as exc:
+        verifier.verify(token)
+    assert exc.value.detail == "Token scaduto"
+    assert not verifier.cache
+
+
+def test_invalid_token_is_rejected(verifier):
+    with pytest.raises(HTTPException) as exc:
+        verifier.verify("not-a-token")
+    assert exc.value.detail == "Token non valido"
+
+
+def test_revoked_jti_is_rejected_even_if_cached(verifier):
+    token = make_token(jti="revoked")
+    principal = verifier.verify(token)
+    verifier._apply({"kind": "token", "value": "revoked", "until": principal.expires_at})
+    with pytest.raises(HTTPException) as exc:
+        verifier.verify(token)
+    assert exc.value.status_code == 401
+    verifier.verify(make_token(jti="other"))
+
+
+def test_user_revocation_covers_tokens_issued_before(verifier):
+    before = make_token(jti="old", iat=1000.0)
+    after = make_token(jti="new", iat=3000.0)
+    verifier._apply({"kind": "user", "value": "Oriana", "before": 2000.0})
+    with pytest.raises(HTTPException):
+        verifier.verify(before)
+    assert verifier.verify(after).jti == "new"
+    # Other users are unaffected
+    assert verifier.verify(make_token(username="Giovanna", iat=1000.0)).username == "Giovanna"
+
+
+def test_open_principal_becomes_invalid(verifier, monkeypatch):
+    principal = verifier.verify(make_token(jti="open", exp=time.time() + 60))
+    assert verifier.is_valid(principal)
+    verifier._apply({"kind": "token", "value": "open", "until": principal.expires_at})
+    assert not verifier.is_valid(principal)
+
+    principal = verifier.verify(make_token(jti="expiring", exp=time.time() + 60))
+    monkeypatch.setattr(time, "time", lambda real=time.time: real() + 120)
+    assert not verifier.is_valid(principal)
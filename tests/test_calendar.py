@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+
+def next_available(server, monkeypatch, now, **params):
+    class Clock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    token = server.create_token("Oriana", ["pta_centro"])
+    monkeypatch.setattr(server, "datetime", Clock)
+    monkeypatch.setattr(server, "db", AsyncMongoMockClient()["calendar_test"])
+    response = TestClient(server.app).get(
+        "/api/calendar/next-available",
+        params={"ambulatorio": "pta_centro", "tipo": "PICC", **params},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 200
+    return [(slot["data"], slot["ora"]) for slot in response.json()["slots"]]
+
+
+def test_slots_already_started_today_are_skipped(server, monkeypatch):
+    # Monday 2 March 2026, 10:05
+    found = next_available(server, monkeypatch, datetime(2026, 3, 2, 10, 5), after="2026-03-02", count=3)
+    assert found == [("2026-03-02", "10:30"), ("2026-03-02", "11:00"), ("2026-03-02", "11:30")]
+
+
+def test_after_time_later_than_now_still_applies(server, monkeypatch):
+    found = next_available(server, monkeypatch, datetime(2026, 3, 2, 10, 5), after="2026-03-02T12:00", count=1)
+    assert found == [("2026-03-02", "12:30")]
+
+
+def test_other_days_start_from_the_first_slot(server, monkeypatch):
+    # After the last slot of the day the search moves to the next morning
+    found = next_available(server, monkeypatch, datetime(2026, 3, 2, 18, 0), after="2026-03-02", count=1)
+    assert found == [("2026-03-03", "08:30")]
@@ -0,0 +1,47 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import jwt
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import credentials
+from auth_context import TokenVerifier
+
+SECRET = "test-secret-of-at-least-thirty-two-bytes"
+
+
+@pytest.fixture(autouse=True)
+def cheap_bcrypt(monkeypatch):
+    monkeypatch.setattr(credentials, "BCRYPT_ROUNDS", 4)
+    monkeypatch.setattr(credentials, "_dummy_hash", None)
+
+
+def test_unknown_user_is_checked_against_a_lazy_dummy_hash():
+    db = AsyncMongoMockClient()["credentials_test"]
+    assert credentials._dummy_hash is None
+    assert asyncio.run(credentials.authenticate(db, "nessuno", "x")) is None
+    assert credentials._dummy_hash.startswith("$2b$04$")
+
+
+def test_set_password_ends_open_sessions():
+    db = AsyncMongoMockClient()["credentials_test"]
+    verifier = TokenVerifier(lambda token: jwt.decode(token, SECRET, algorithms=["HS256"]), timedelta(hours=1))
+    now = time.time()
+    # Issued a moment ago: the revocation covers tokens issued until now
+    principal = verifier.verify(jwt.encode(
+        {"sub": "Oriana", "ambulatori": ["pta_centro"], "jti": "j1", "iat": now - 1, "exp": now + 3600},
+        SECRET, algorithm="HS256"))
+
+    async def main():
+        await credentials.seed_users(db, {"Oriana": {"password": "vecchia", "ambulatori": ["pta_centro"]}})
+        refresh_token = await credentials.issue_refresh_token(db, "Oriana")
+        assert await credentials.set_password(db, verifier, "Oriana", "nuova")
+        assert not await credentials.set_password(db, verifier, "nessuno", "nuova")
+        return refresh_token
+
+    refresh_token = asyncio.run(main())
+    assert not verifier.is_valid(principal)
+    assert asyncio.run(credentials.rotate_refresh_token(db, refresh_token)) is None
+    assert asyncio.run(credentials.authenticate(db, "Oriana", "nuova"))["username"] == "Oriana"
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import events
+
+
+class FailingDB:
+    """watch() raises the given errors in turn, then blocks like an idle stream."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    def watch(self, pipeline, **options):
+        self.calls.append(options)
+        db = self
+
+        class Stream:
+            async def __aenter__(self):
+                if db.errors:
+                    raise db.errors.pop(0)
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                await asyncio.Event().wait()
+
+        return Stream()
+
+
+def run_watch(db, bus, seconds=0.05):
+    async def main():
+        task = asyncio.create_task(events.watch(db, bus))
+        await asyncio.sleep(seconds)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def no_wait(monkeypatch):
+    monkeypatch.setattr(events, "WATCH_RETRY_SECONDS", 0)
+
+
+def test_standalone_server_returns():
+    db = FailingDB(OperationFailure("not a replica set", code=events.NO_REPLICA_SET))
+    asyncio.run(events.watch(db, events.EventBus()))
+    assert len(db.calls) == 1
+
+
+def test_retries_without_pre_images_and_no_resync():
+    bus = events.EventBus()
+    queue = bus.subscribe(["pta_centro"])
+    db = FailingDB(OperationFailure(
+        "BSON field '$changeStream.fullDocumentBeforeChange' is an unknown field.", code=40415))
+    run_watch(db, bus)
+    assert "full_document_before_change" in db.calls[0]
+    assert "full_document_before_change" not in db.calls[1]
+    assert bus.changestream
+    assert queue.empty()
+
+
+def test_repeated_failures_to_open_do_not_resync():
+    bus = events.EventBus()
+    queue = bus.subscribe(["pta_centro"])
+    db = FailingDB(*[OperationFailure("boom", code=8000) for _ in range(3)])
+    run_watch(db, bus)
+    assert len(db.calls) == 4
+    assert queue.empty()
+
+
+def test_notify_publishes_only_without_change_stream():
+    bus = events.EventBus()
+    queue = bus.subscribe(["pta_centro"])
+    appointment = {"id": "a1", "ambulatorio": "pta_centro"}
+    bus.changestream = True
+    bus.notify("appointments", "insert", appointment)
+    assert queue.empty()
+    bus.changestream = False
+    bus.notify("appointments", "insert", appointment)
+    assert queue.get_nowait()["id"] == "a1"
+
+
+def test_stream_ends_once_unauthorized(monkeypatch):
+    monkeypatch.setattr(events, "HEARTBEAT_SECONDS", 0.01)
+    bus = events.EventBus()
+    valid = [True]
+
+    async def main():
+        body = events.stream(bus, ["pta_centro"], lambda: valid[0])
+        assert (await body.__anext__()).startswith(b"retry:")
+        assert await body.__anext__() == b": ping\n\n"
+        bus.publish("pta_centro", {"collection": "appointments", "op": "insert", "id": "a1"})
+        assert b'"id":"a1"' in await body.__anext__()
+        valid[0] = False
+        assert await body.__anext__() == events.UNAUTHORIZED
+        with pytest.raises(StopAsyncIteration):
+            await body.__anext__()
+        assert not bus.subscribers["pta_centro"]
+
+    asyncio.run(main())
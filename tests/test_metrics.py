@@ -0,0 +1,17 @@
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.mark.parametrize("configured, headers, status", [
+    (None, {}, 404),
+    (None, {"Authorization": "Bearer anything"}, 404),
+    ("scrape-secret", {}, 401),
+    ("scrape-secret", {"Authorization": "Bearer wrong"}, 401),
+    ("scrape-secret", {"Authorization": "Bearer scrape-secret"}, 200),
+])
+def test_metrics_need_the_token(server, monkeypatch, configured, headers, status):
+    monkeypatch.setattr(server, "METRICS_TOKEN", configured)
+    response = TestClient(server.app).get("/api/metrics", headers=headers)
+    assert response.status_code == status
+    if status == 200:
+        assert b"http_request_duration_seconds" in response.content
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import date, datetime, timezone
+
+import orjson
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import pagination
+from pagination import decode_cursor, encode_cursor, keyset_filter
+
+PATIENTS_SORT = (("cognome", 1), ("id", 1))
+
+
+def test_cursor_round_trip():
+    values = ["D'Angelo", "7f1c", None]
+    token = encode_cursor(values)
+    assert "=" not in token
+    assert decode_cursor(token, (("a", 1), ("b", 1), ("c", 1))) == values
+
+
+@pytest.mark.parametrize("token", [
+    "garbage!",
+    "",
+    encode_cursor(["only-one"]),
+    encode_cursor(["a", "b", "c"]),
+    pagination.base64.urlsafe_b64encode(b'{"cognome": "Rossi"}').decode(),
+])
+def test_malformed_cursor_raises(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, PATIENTS_SORT)
+
+
+def test_keyset_filter_ascending_and_descending():
+    assert keyset_filter(PATIENTS_SORT, ["Rossi", "p1"]) == {"$or": [
+        {"cognome": {"$gt": "Rossi"}},
+        {"cognome": "Rossi", "id": {"$gt": "p1"}},
+    ]}
+    assert keyset_filter((("data", -1), ("id", 1)), ["2026-03-02", "a"]) == {"$or": [
+        {"data": {"$lt": "2026-03-02"}},
+        {"data": "2026-03-02", "id": {"$gt": "a"}},
+    ]}
+
+
+def test_field_projection():
+    default = {"_id": 0}
+    assert pagination.field_projection(None, ["nome"], ["id"], default) is default
+    assert pagination.field_projection("nome, ", ["nome"], ["id"], default) == {"_id": 0, "id": 1, "nome": 1}
+    with pytest.raises(ValueError, match="password"):
+        pagination.field_projection("nome,password", ["nome"], ["id"], default)
+
+
+def test_pages_with_equal_sort_keys_cover_everything_once():
+    db = AsyncMongoMockClient()["pagination_test"]
+    # Many patients share the cognome: only the id tells them apart
+    patients = [{"id": f"p{i:02d}", "cognome": "Rossi" if i % 3 else "Bianchi", "ambulatorio": "pta_centro"}
+                for i in range(20)]
+
+    async def main():
+        await db.patients.insert_many([dict(p) for p in patients])
+        seen, cursor, pages = [], None, 0
+        while True:
+            docs, cursor = await pagination.fetch_page(
+                db.patients, {"ambulatorio": "pta_centro"}, {"_id": 0}, PATIENTS_SORT, 3, cursor)
+            seen += [doc["id"] for doc in docs]
+            pages += 1
+            if cursor is None:
+                return seen, pages
+
+    seen, pages = asyncio.run(main())
+    expected = [p["id"] for p in sorted(patients, key=lambda p: (p["cognome"], p["id"]))]
+    assert seen == expected
+    assert pages == 7
+
+
+def test_last_full_page_has_no_cursor():
+    db = AsyncMongoMockClient()["pagination_test"]
+
+    async def main():
+        await db.patients.insert_many([{"id": f"p{i}", "cognome": "Rossi"} for i in range(3)])
+        return await pagination.fetch_page(db.patients, {}, {"_id": 0}, PATIENTS_SORT, 3)
+
+    docs, cursor = asyncio.run(main())
+    assert len(docs) == 3 and cursor is None
+
+
+def test_ndjson_lines_match_the_json_responses():
+    class Cursor:
+        def __init__(self, docs):
+            self.docs = iter(docs)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return next(self.docs)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    doc = {"nome": "Niccolò", "data": date(2026, 3, 2), "at": datetime(2026, 3, 2, 8, 30, tzinfo=timezone.utc)}
+
+    async def collect():
+        return [line async for line in pagination.ndjson_lines(Cursor([doc, {"n": 1}]))]
+
+    lines = asyncio.run(collect())
+    assert lines[0] == orjson.dumps(doc) + b"\n"
+    assert orjson.loads(lines[0])["nome"] == "Niccolò"
+    assert lines[1] == b'{"n":1}\n'
+
+
+def test_malformed_cursor_is_a_400(server):
+    from fastapi.testclient import TestClient
+
+    token = server.create_token("Oriana", ["pta_centro"])
+    response = TestClient(server.app).get(
+        "/api/patients", params={"ambulatorio": "pta_centro", "cursor": "not-a-cursor"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Cursor non valido"}
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from bson.regex import Regex
+from mongomock_motor import AsyncMongoMockClient
+
+import patient_search
+from patient_search import build_query, keys_for, normalise, rank, search_fields
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Niccolò", "niccolo"),
+    ("FRANÇOIS", "francois"),
+    ("Àlvarez Núñez", "alvarez nunez"),
+    (None, ""),
+])
+def test_normalise_strips_accents_and_case(text, expected):
+    assert normalise(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("D'Angelo", ["d", "angelo", "dangelo"]),
+    ("D’Angelo", ["d", "angelo", "dangelo"]),
+    ("De Luca", ["de", "luca", "deluca"]),
+    ("Lo Iacono-Cefalù", ["lo", "iacono", "cefalu", "loiacono" + "cefalu"]),
+    ("Rossi", ["rossi"]),
+    ("", []),
+])
+def test_keys_for_multi_word_names(text, expected):
+    assert keys_for(text) == expected
+
+
+def test_search_fields():
+    fields = search_fields({"nome": "Maria Rosa", "cognome": "D'Angelo", "codice_fiscale": "rss mra 80a01 h501u"})
+    assert fields == {
+        "search_keys": ["angelo", "d", "dangelo", "maria", "mariarosa", "rosa"],
+        "codice_fiscale_norm": "RSSMRA80A01H501U",
+    }
+    assert search_fields({"nome": "Anna", "cognome": "Rossi"})["codice_fiscale_norm"] is None
+
+
+def test_build_query_prefixes_every_term():
+    assert build_query("Ros") == {"search_keys": Regex("^ros")}
+    assert build_query("d'ang ma") == {"$and": [
+        {"search_keys": Regex("^d")}, {"search_keys": Regex("^ang")}, {"search_keys": Regex("^ma")},
+    ]}
+    assert build_query("'  -") is None
+
+
+def test_build_query_codice_fiscale():
+    assert build_query("rssmra80a01h501u") == {"$or": [
+        {"search_keys": Regex("^rssmra80a01h501u")},
+        {"codice_fiscale_norm": "RSSMRA80A01H501U"},
+    ]}
+
+
+def test_search_updates_and_reindex():
+    assert patient_search.search_updates({"nome": "Anna", "cognome": "Rossi"}) == {"search_keys": ["anna", "rossi"]}
+    assert patient_search.search_updates({"nome": "Anna"}) == {}
+    assert patient_search.needs_reindex({"nome": "Anna"})
+    assert not patient_search.needs_reindex({"nome": "Anna", "cognome": "Rossi"})
+    assert patient_search.search_updates({"codice_fiscale": ""}) == {"codice_fiscale_norm": None}
+
+
+def test_rank_orders_matches():
+    patients = [
+        {"id": "1", "nome": "Rossi", "cognome": "Bianchi"},
+        {"id": "2", "nome": "Mario", "cognome": "Rossini"},
+        {"id": "3", "nome": "Anna", "cognome": "Rossi"},
+        {"id": "4", "nome": "Luca", "cognome": "Rossi", "codice_fiscale": "RSSLCU80A01H501U"},
+        {"id": "5", "nome": "Anna", "cognome": "Àrossi"},
+    ]
+    # Exact cognome, then cognome prefix, then exact nome, then the rest; ties by cognome, nome
+    assert [p["id"] for p in rank(patients, "rossi")] == ["3", "4", "2", "1", "5"]
+    assert [p["id"] for p in rank(patients, "RSSLCU80A01H501U")][0] == "4"
+
+
+def test_rank_accented_and_apostrophised_terms():
+    patients = [
+        {"id": "1", "nome": "Nicolò", "cognome": "D'Angelo"},
+        {"id": "2", "nome": "Angela", "cognome": "Russo"},
+    ]
+    assert [p["id"] for p in rank(patients, "dangelo")] == ["1", "2"]
+    assert [p["id"] for p in rank(patients, "nicolo d'angelo")] == ["1", "2"]
+
+
+def test_ensure_indexed_only_touches_patients_without_keys():
+    db = AsyncMongoMockClient()["patient_search_test"]
+
+    async def main():
+        await db.patients.insert_many([
+            {"id": "old", "nome": "Anna", "cognome": "D'Angelo"},
+            {"id": "new", "nome": "Luca", "cognome": "Rossi", "search_keys": ["kept"]},
+        ])
+        first = await patient_search.ensure_indexed(db)
+        second = await patient_search.ensure_indexed(db)
+        docs = {doc["id"]: doc async for doc in db.patients.find({}, {"_id": 0})}
+        return first, second, docs
+
+    first, second, docs = asyncio.run(main())
+    assert (first, second) == (1, 0)
+    assert docs["old"]["search_keys"] == ["angelo", "anna", "d", "dangelo"]
+    assert docs["new"]["search_keys"] == ["kept"]
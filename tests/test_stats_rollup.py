@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import stats_rollup
+
+
+def appointment(id, data="2026-03-02", tipo="MED", patient_id="p1", prestazioni=("medicazione_semplice",),
+                created_at="2026-03-01T08:00:00+00:00"):
+    return {"id": id, "ambulatorio": "pta_centro", "data": data, "tipo": tipo, "patient_id": patient_id,
+            "prestazioni": list(prestazioni), "created_at": created_at}
+
+
+def rollups(appointments):
+    """The stats_daily documents that the $inc of ``appointments`` produce."""
+    docs = {}
+    for key, inc in stats_rollup._inc_for(appointments, 1).items():
+        ambulatorio, data, tipo = key.split("|", 2)
+        doc = docs.setdefault(key, {"ambulatorio": ambulatorio, "data": data, "tipo": tipo,
+                                    "accessi": 0, "prestazioni": {}, "pazienti": {}})
+        for path, value in inc.items():
+            if "." in path:
+                group, name = path.split(".", 1)
+                doc[group][name] = doc[group].get(name, 0) + value
+            else:
+                doc[path] += value
+    return list(docs.values())
+
+
+@pytest.mark.parametrize("name", ["medicazione_semplice", "cvc.picc", "$set", "50%", "a.b.%2E", ""])
+def test_field_round_trip(name):
+    field = stats_rollup._field(name)
+    assert "." not in field and not field.startswith("$")
+    assert stats_rollup._name(field) == name
+
+
+def test_summarise_totals_and_monthly_detail():
+    days = rollups([
+        appointment("a1", data="2026-03-02", patient_id="p1", prestazioni=["x", "y"]),
+        appointment("a2", data="2026-03-03", patient_id="p1", prestazioni=["x"]),
+        appointment("a3", data="2026-04-01", patient_id="p2", prestazioni=["x"]),
+    ])
+    stats = stats_rollup.summarise(days)
+    assert stats["totale_accessi"] == 3
+    assert stats["pazienti_unici"] == 2
+    assert stats["prestazioni"] == {"x": 3, "y": 1}
+    assert stats["dettaglio_mensile"] == {
+        "2026-03": {"accessi": 2, "prestazioni": {"x": 2, "y": 1}, "pazienti_unici": 1},
+        "2026-04": {"accessi": 1, "prestazioni": {"x": 1}, "pazienti_unici": 1},
+    }
+
+
+def test_summarise_ignores_counters_back_at_zero():
+    day = rollups([appointment("a1", patient_id="p1", prestazioni=["x"])])[0]
+    # A cancelled booking leaves its counters at zero
+    day["pazienti"]["p2"] = 0
+    day["prestazioni"]["y"] = 0
+    empty = {**day, "data": "2026-03-03", "accessi": 0}
+    stats = stats_rollup.summarise([day, empty])
+    assert stats["totale_accessi"] == 1
+    assert stats["pazienti_unici"] == 1
+    assert stats["prestazioni"] == {"x": 1}
+
+
+def test_summarise_restores_dotted_prestazioni():
+    stats = stats_rollup.summarise(rollups([appointment("a1", prestazioni=["cvc.picc"])]))
+    assert stats["prestazioni"] == {"cvc.picc": 1}
+    assert stats["dettaglio_mensile"]["2026-03"]["prestazioni"] == {"cvc.picc": 1}
+
+
+def test_rebuild_counts_history_and_replays_bookings_after_the_mark():
+    db = AsyncMongoMockClient()["rollup_test"]
+
+    async def main():
+        await db.appointments.insert_many([
+            appointment("old1"), appointment("old2", patient_id="p2"),
+            {k: v for k, v in appointment("legacy").items() if k != "created_at"},
+            # Created while the rebuild runs: after the high-water mark
+            appointment("new", created_at="2999-01-01T00:00:00+00:00"),
+        ])
+        await db.stats_daily.insert_one({"_id": "stale", "ambulatorio": "pta_centro", "data": "2026-03-02",
+                                         "tipo": "MED", "accessi": 99})
+        documents = await stats_rollup.rebuild(db)
+        days = await stats_rollup.load_days(db, "pta_centro", "2026-03-01", "2026-04-01")
+        return documents, days
+
+    documents, days = asyncio.run(main())
+    assert documents == 1
+    stats = stats_rollup.summarise(days)
+    assert stats["totale_accessi"] == 4
+    assert stats["pazienti_unici"] == 2
@@ -0,0 +1,129 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import sync
+from pagination import encode_cursor
+
+PROJECTIONS = {"appointments": {"_id": 0}, "patients": {"_id": 0}}
+NOW = datetime.now(timezone.utc)
+STAMP = (NOW - timedelta(days=1)).isoformat()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["sync_test"]
+
+
+async def drain(db, position, limit, projections=PROJECTIONS):
+    """Every page of one sync round: the ids sent per collection, and the pages."""
+    seen = {name: [] for name in projections}
+    deleted = {name: [] for name in projections}
+    pages = []
+    while True:
+        result = await sync.changes(db, projections, ["pta_centro"], position, limit=limit)
+        pages.append(result)
+        for name, part in result["collections"].items():
+            seen[name] += [doc["id"] for doc in part["updated"]]
+            deleted[name] += part["deleted"]
+        position = sync.parse_token(result["token"])
+        if not result["more"]:
+            return seen, deleted, pages
+        assert len(pages) < 100, "sync does not progress"
+
+
+def test_no_token_is_a_full_download():
+    assert sync.parse_token(None) == sync.SyncPosition()
+    assert sync.parse_token("") == sync.SyncPosition()
+
+
+@pytest.mark.parametrize("token", ["garbage", encode_cursor(["a", "b"]),
+                                   encode_cursor([1, "2026-01-01", None]),
+                                   encode_cursor([None, "2026-01-01", {"patients": [None]}])])
+def test_invalid_tokens_raise(token):
+    with pytest.raises(ValueError):
+        sync.parse_token(token)
+
+
+def test_token_older_than_tombstones_resets():
+    old = (datetime.now(timezone.utc) - timedelta(days=sync.TOMBSTONE_DAYS + 1)).isoformat()
+    assert sync.parse_token(encode_cursor([old, old, None])) == sync.SyncPosition()
+
+
+def test_documents_sharing_updated_at_page_through(db):
+    """2000+ documents with one updated_at (after backfill) must not stall the sync."""
+    docs = [{"id": f"a{i:03d}", "ambulatorio": "pta_centro", "updated_at": STAMP} for i in range(25)]
+    docs.append({"id": "other", "ambulatorio": "villa_ginestre", "updated_at": STAMP})
+    run(db.appointments.insert_many(docs))
+    seen, _, pages = run(drain(db, sync.SyncPosition(), limit=10))
+    assert seen["appointments"] == [f"a{i:03d}" for i in range(25)]
+    assert len(pages) == 3
+    assert pages[0]["reset"] and not pages[1]["reset"]
+
+
+def test_delta_round_pages_deletions_and_resumes_from_round_start(db):
+    run(db.appointments.insert_many([
+        {"id": "old", "ambulatorio": "pta_centro", "updated_at": (NOW - timedelta(days=5)).isoformat()},
+        *({"id": f"n{i}", "ambulatorio": "pta_centro", "updated_at": STAMP} for i in range(3)),
+    ]))
+    run(db.tombstones.insert_many([
+        {"collection": "appointments", "id": f"d{i}", "ambulatorio": "pta_centro", "deleted_at": STAMP}
+        for i in range(5)
+    ]))
+    since = (NOW - timedelta(days=2)).isoformat()
+    before = datetime.now(timezone.utc)
+    seen, deleted, pages = run(drain(db, sync.SyncPosition(since, since, None), limit=2))
+    assert seen["appointments"] == ["n0", "n1", "n2"]
+    assert deleted["appointments"] == [f"d{i}" for i in range(5)]
+    assert all(len(page["collections"]["appointments"]["deleted"]) <= 2 for page in pages)
+    # The next round starts OVERLAP before the first page of this one
+    first, last = sync.parse_token(pages[0]["token"]), sync.parse_token(pages[-1]["token"])
+    assert last.pending is None
+    assert first.started_at >= before.isoformat()
+    assert last.since == (datetime.fromisoformat(first.started_at) - sync.OVERLAP).isoformat()
+
+
+def test_consecutive_rounds_advance(db):
+    run(db.appointments.insert_one({"id": "a1", "ambulatorio": "pta_centro", "updated_at": STAMP}))
+    first = run(sync.changes(db, PROJECTIONS, ["pta_centro"], sync.SyncPosition()))
+    assert first["reset"]
+    assert [doc["id"] for doc in first["collections"]["appointments"]["updated"]] == ["a1"]
+
+    second = run(sync.changes(db, PROJECTIONS, ["pta_centro"], sync.parse_token(first["token"])))
+    assert not second["reset"] and not second["more"]
+    assert all(not part["updated"] and not part["deleted"] for part in second["collections"].values())
+    assert sync.parse_token(second["token"]).since > sync.parse_token(first["token"]).since
+    assert second["token"] != first["token"]
+
+    # A change after the second round is sent by the third only
+    run(db.appointments.update_one({"id": "a1"}, {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}))
+    third = run(sync.changes(db, PROJECTIONS, ["pta_centro"], sync.parse_token(second["token"])))
+    assert [doc["id"] for doc in third["collections"]["appointments"]["updated"]] == ["a1"]
+
+
+def test_completed_collections_are_skipped_while_others_page(db):
+    run(db.patients.insert_one({"id": "p1", "ambulatorio": "pta_centro", "updated_at": STAMP}))
+    run(db.appointments.insert_many([
+        {"id": f"a{i}", "ambulatorio": "pta_centro", "updated_at": STAMP} for i in range(5)
+    ]))
+    seen, _, _ = run(drain(db, sync.SyncPosition(), limit=2))
+    assert seen["patients"] == ["p1"]
+    assert seen["appointments"] == [f"a{i}" for i in range(5)]
+
+
+def test_backfill_only_fills_missing_updated_at(db):
+    run(db.patients.insert_many([
+        {"id": "p1", "ambulatorio": "pta_centro", "created_at": STAMP},
+        {"id": "p2", "ambulatorio": "pta_centro"},
+        {"id": "p3", "ambulatorio": "pta_centro", "created_at": STAMP, "updated_at": NOW.isoformat()},
+    ]))
+    assert run(sync.backfill(db))["patients"] == 2
+    assert run(sync.backfill(db))["patients"] == 0
+    docs = {doc["id"]: doc["updated_at"] for doc in run(db.patients.find({}).to_list(None))}
+    assert docs == {"p1": STAMP, "p2": "1970-01-01T00:00:00+00:00", "p3": NOW.isoformat()}
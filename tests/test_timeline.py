@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+import timeline
+from pagination import encode_cursor
+
+SOURCES = [
+    timeline.Source("appuntamento", "appointments", "data", "ora"),
+    timeline.Source("scheda_med", "schede_medicazione_med", "data_compilazione"),
+    timeline.Source("foto", "photos", "data"),
+]
+APPOINTMENTS, SCHEDE, PHOTOS = SOURCES
+
+
+def matches(query: dict, doc: dict) -> bool:
+    """Evaluate the subset of the query language before_filter produces."""
+    if "$or" in query:
+        return any(matches(branch, doc) for branch in query["$or"])
+    for field, condition in query.items():
+        if field == "_id":
+            return False
+        if isinstance(condition, dict):
+            if not doc.get(field) < condition["$lt"]:
+                return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+@pytest.mark.parametrize("source", SOURCES)
+def test_before_filter_agrees_with_event_key(source):
+    dates, times, ids = ["2026-03-01", "2026-03-02"], ["08:30", "09:00"], ["a", "b"]
+    docs = [{"data": d, "data_compilazione": d, "ora": t, "id": i} for d in dates for t in times for i in ids]
+    keys = [timeline.event_key(s, doc) for s in SOURCES for doc in docs]
+    for key in keys:
+        for doc in docs:
+            expected = timeline.event_key(source, doc) < key
+            assert matches(timeline.before_filter(source, key), doc) == expected, (key, doc)
+
+
+def test_before_filter_excludes_the_whole_source_when_it_sorts_after():
+    # A key on the same date as a photo but of a tipo sorting earlier
+    key = ("2026-03-02", "", "appuntamento", "zzz")
+    assert timeline.before_filter(PHOTOS, key) == {"$or": [{"data": {"$lt": "2026-03-02"}}]}
+
+
+@pytest.fixture
+def db():
+    database = AsyncMongoMockClient()["timeline_test"]
+    docs = {
+        "appointments": [
+            {"id": f"a{i}", "patient_id": "p1", "data": d, "ora": o}
+            for i, (d, o) in enumerate([("2026-03-02", "08:30"), ("2026-03-02", "08:30"),
+                                        ("2026-03-02", "15:00"), ("2026-03-01", "09:00")])
+        ],
+        "schede_medicazione_med": [
+            {"id": f"s{i}", "patient_id": "p1", "data_compilazione": d}
+            for i, d in enumerate(["2026-03-02", "2026-03-02", "2026-02-28"])
+        ],
+        "photos": [{"id": f"f{i}", "patient_id": "p1", "data": "2026-03-02"} for i in range(3)],
+    }
+
+    async def seed():
+        for collection, items in docs.items():
+            await database[collection].insert_many(items)
+    asyncio.run(seed())
+    return database
+
+
+def all_pages(db, limit):
+    async def main():
+        events, cursor = [], None
+        while True:
+            page, cursor = await timeline.fetch_page(db, SOURCES, {"patient_id": "p1"}, limit, cursor)
+            assert len(page) <= limit
+            events += page
+            if cursor is None:
+                return events
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 50])
+def test_pages_merge_sources_newest_first_without_gaps(db, limit):
+    events = all_pages(db, limit)
+    keys = [(e["data"], e["ora"] or "", e["tipo"], e["id"]) for e in events]
+    assert keys == sorted(keys, reverse=True)
+    assert len(set(keys)) == len(keys) == 10
+    assert events[0] == {"tipo": "appuntamento", "data": "2026-03-02", "ora": "15:00", "id": "a2",
+                         "record": {"id": "a2", "patient_id": "p1", "data": "2026-03-02", "ora": "15:00"}}
+
+
+def test_invalid_cursor_raises(db):
+    with pytest.raises(ValueError):
+        asyncio.run(timeline.fetch_page(db, SOURCES, {}, 10, "nope"))
+    with pytest.raises(ValueError):
+        asyncio.run(timeline.fetch_page(db, SOURCES, {}, 10, encode_cursor(["2026-03-02"])))